@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
 NotiMail
-Version: 2.0.1
+Version: 2.1.0
 Author: Stefano Marinelli <stefano@dragas.it>
 License: BSD 3-Clause License
 
@@ -39,10 +39,11 @@ configured before running the script.
 
 import imaplib
 import email
-import requests
+from urllib.parse import urlsplit
 import configparser
 import time
 import socket
+import ssl
 import sqlite3
 import datetime
 import signal
@@ -50,124 +51,530 @@ import sys
 import logging
 import argparse
 import threading
+import contextlib
+import functools
+import importlib.util
+import itertools
+import random
 import os
 import select
-from email import policy
-from email.parser import BytesParser
-from threading import Lock
-from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
-
-# Creiamo una socket pair globale per gestire lo shutdown
-shutdown_sock_r, shutdown_sock_w = socket.socketpair()
-shutdown_sock_r.setblocking(0)
-shutdown_sock_w.setblocking(0)
-
-# Conditional import of Apprise
-try:
-    import apprise
-    apprise_available = True
-except ImportError:
-    apprise_available = False
-
-# Conditional import of Flask
-try:
-    from flask import Flask, jsonify, request
-    flask_available = True
-except ImportError:
-    flask_available = False
-
-# Conditional import of Prometheus client
+import json
+import subprocess
+import tempfile
+import shutil
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import re
 try:
-    from prometheus_client import start_http_server, Counter, Histogram
-    from prometheus_client import Gauge, Summary
-    prometheus_available = True
+    from re import _parser as sre_parse
 except ImportError:
-    prometheus_available = False
-
-# Argument parsing to get the config file path
-parser = argparse.ArgumentParser(description='NotiMail Notification Service.')
-parser.add_argument('-c', '--config', type=str, default='config.ini', help='Path to the configuration file.')
-parser.add_argument('--print-config', action='store_true', help='Print the configuration options from config.ini')
-parser.add_argument('--test-config', action='store_true', help='Test the configuration options to ensure they work properly')
-parser.add_argument('--list-folders', action='store_true', help='List all IMAP folders of the configured mailboxes')
-args = parser.parse_args()
-
-# Read configuration
+    # Python < 3.11
+    import sre_parse
+from email import policy
+from email.header import decode_header, make_header
+from email.parser import BytesParser, BytesHeaderParser
+from email.utils import parseaddr
+from threading import Lock
+from array import array
+from collections import OrderedDict, deque
+from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler, WatchedFileHandler
+
+# Socket pair used to interrupt the blocking selects at shutdown, created by multi_account_main
+shutdown_sock_r = shutdown_sock_w = None
+# Set together with the wake-up byte, so monitors stop reconnecting once shutdown has started
+shutdown_event = threading.Event()
+# Set by SIGHUP: the engine reloads the configuration from its own thread, see MultiIMAPHandler.reload
+reload_requested = threading.Event()
+
+def module_available(name):
+    """Whether an optional dependency is installed, without paying for its import."""
+    return importlib.util.find_spec(name) is not None
+
+# Optional dependencies, imported only where the configuration uses them
+apprise_available = module_available('apprise')
+flask_available = module_available('flask')
+prometheus_available = module_available('prometheus_client')
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='NotiMail Notification Service.')
+    parser.add_argument('-c', '--config', type=str, default='config.ini', help='Path to the configuration file.')
+    parser.add_argument('--print-config', action='store_true', help='Print the configuration options from config.ini')
+    parser.add_argument('--test-config', action='store_true', help='Test the configuration options to ensure they work properly')
+    parser.add_argument('--list-folders', action='store_true', help='List all IMAP folders of the configured mailboxes')
+    parser.add_argument('--jobs', type=int, default=10, help='Accounts and providers checked at the same time by --test-config and --list-folders')
+    parser.add_argument('--json', action='store_true', help='Print the report of --test-config or --list-folders as JSON')
+    # Used by the supervisor to start its workers: "index/count"
+    parser.add_argument('--worker', type=str, default=None, help=argparse.SUPPRESS)
+    return parser
+
+# Set by configure()
+args = None
 config = configparser.ConfigParser()
-config.read(args.config)
 
 def validate_config(config):
     required_sections = ['GENERAL']
     if not any(section.startswith('EMAIL') for section in config.sections()):
         raise ValueError("At least one EMAIL section is required.")
+    for section in config.sections():
+        if section.startswith('EMAIL'):
+            missing = [option for option in ('EmailUser', 'EmailPass', 'Host') if option not in config[section]]
+            if missing:
+                raise ValueError(f"{section} has no {', '.join(missing)}.")
     # Add more validation as needed
 
-validate_config(config)
-
-# Logging setup using configuration (or default if not set)
-log_file_location = config.get('GENERAL', 'LogFileLocation', fallback='notimail.log')
-log_rotation_type = config.get('GENERAL', 'LogRotationType', fallback='size')
-log_rotation_size = config.getint('GENERAL', 'LogRotationSize', fallback=10485760)  # 10MB
-log_rotation_interval = config.getint('GENERAL', 'LogRotationInterval', fallback=1)  # 1 day
-log_backup_count = config.getint('GENERAL', 'LogBackupCount', fallback=5)
-
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-if log_rotation_type == 'size':
-    handler = RotatingFileHandler(log_file_location, maxBytes=log_rotation_size, backupCount=log_backup_count)
-elif log_rotation_type == 'time':
-    handler = TimedRotatingFileHandler(log_file_location, when='midnight', interval=log_rotation_interval, backupCount=log_backup_count)
-else:
-    raise ValueError(f"Invalid LogRotationType: {log_rotation_type}")
-
-formatter = logging.Formatter('%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-
-logging.info("Module availability:")
-logging.info(f" - Apprise available: {apprise_available}")
-logging.info(f" - Flask available: {flask_available}")
-logging.info(f" - Prometheus client available: {prometheus_available}")
-
-# Start Prometheus metrics server if available and configured
-prometheus_host = config.get('GENERAL', 'PrometheusHost', fallback=None)
-prometheus_port = config.getint('GENERAL', 'PrometheusPort', fallback=None)
+def parse_worker_count(value):
+    if value.strip().lower() == 'auto':
+        return os.cpu_count() or 1
+    return max(1, int(value))
+
+# With Workers > 1 this process is a supervisor: the EMAIL sections are shared among worker processes
+# started with --worker, which report their status and metrics through files in runtime_dir
+worker_index = None
+worker_count = 1
+supervisor_mode = False
+runtime_dir = None
+
+def setup_workers():
+    global worker_index, worker_count, supervisor_mode, runtime_dir
+    worker_count = parse_worker_count(config.get('GENERAL', 'Workers', fallback='1'))
+    if args.worker:
+        worker_index, worker_count = (int(part) for part in args.worker.split('/'))
+    supervisor_mode = (worker_index is None and worker_count > 1
+                       and not (args.print_config or args.test_config or args.list_folders))
+    if supervisor_mode:
+        runtime_dir = tempfile.mkdtemp(prefix='notimail-')
+    else:
+        runtime_dir = os.environ.get('NOTIMAIL_RUNTIME_DIR')
+
+# Logging setup using configuration (or default if not set), see setup_logging()
+log_file_location = 'notimail.log'
+log_rotation_type = 'size'
+log_rotation_size = 10485760  # 10MB
+log_rotation_interval = 1  # 1 day
+log_backup_count = 5
+handler = None
+
+class LogWatcher(logging.Handler):
+    """Wake the /logs/stream followers up as soon as this process writes to the log."""
+    def __init__(self):
+        super().__init__()
+        self.condition = threading.Condition()
+        self.version = 0
+
+    def emit(self, record):
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, version, timeout):
+        """Wait for a log write after `version`, or `timeout` seconds. Returns the current version."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+log_watcher = LogWatcher()
+
+def setup_logging():
+    global log_file_location, log_rotation_type, log_rotation_size, log_rotation_interval, log_backup_count, handler
+    log_file_location = config.get('GENERAL', 'LogFileLocation', fallback=log_file_location)
+    log_rotation_type = config.get('GENERAL', 'LogRotationType', fallback=log_rotation_type)
+    log_rotation_size = config.getint('GENERAL', 'LogRotationSize', fallback=log_rotation_size)
+    log_rotation_interval = config.getint('GENERAL', 'LogRotationInterval', fallback=log_rotation_interval)
+    log_backup_count = config.getint('GENERAL', 'LogBackupCount', fallback=log_backup_count)
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+
+    if log_rotation_type not in ('size', 'time'):
+        raise ValueError(f"Invalid LogRotationType: {log_rotation_type}")
+    if worker_index is not None:
+        # The supervisor owns the log file and rotates it; workers append to it and follow the rotation
+        handler = WatchedFileHandler(log_file_location)
+        formatter = logging.Formatter(f'%(asctime)s - w{worker_index}:%(threadName)s - %(levelname)s - %(message)s')
+    else:
+        if log_rotation_type == 'size':
+            handler = RotatingFileHandler(log_file_location, maxBytes=log_rotation_size, backupCount=log_backup_count)
+        else:
+            handler = TimedRotatingFileHandler(log_file_location, when='midnight', interval=log_rotation_interval, backupCount=log_backup_count)
+        formatter = logging.Formatter('%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    # After the file handler, so the record is in the file when the followers wake up
+    logger.addHandler(log_watcher)
+
+    logging.info("Module availability:")
+    logging.info(f" - Apprise available: {apprise_available}")
+    logging.info(f" - Flask available: {flask_available}")
+    logging.info(f" - Prometheus client available: {prometheus_available}")
+
+class DummyMetric:
+    def labels(self, *args, **kwargs):
+        return self
+    def inc(self, amount=1):
+        pass
+    def observe(self, amount):
+        pass
+    def set(self, value):
+        pass
+    def time(self):
+        class DummyTimer:
+            def __enter__(self):
+                pass
+            def __exit__(self, exc_type, exc_val, exc_tb):
+                pass
+        return DummyTimer()
+
+# Replaced by the real metrics in setup_metrics() when the Prometheus server starts
+EMAILS_PROCESSED = NOTIFICATIONS_SENT = ERRORS = CACHE_HITS = CACHE_MISSES = DummyMetric()
+PROCESSING_TIME = ACCOUNT_PROCESSING_TIME = RECONNECTS = RECOVERY_TIME = DummyMetric()
+QUEUE_DEPTH = SEND_TIME = NOTIFICATIONS_DROPPED = NOTIFICATIONS_COALESCED = DummyMetric()
+CONNECTION_FAILURES = CONNECTION_STATE = NOTIFICATION_LATENCY = FETCH_BYTES = FETCH_TIME = DummyMetric()
+DB_OPERATION_TIME = HTTP_TIME = HTTP_RESPONSES = RULE_MATCHES = DummyMetric()
+metrics_enabled = False
+
+def setup_metrics():
+    """Start Prometheus metrics server if available and configured, and create the metrics."""
+    global metrics_enabled, prometheus_available
+    global EMAILS_PROCESSED, NOTIFICATIONS_SENT, PROCESSING_TIME, ERRORS, CACHE_HITS, CACHE_MISSES
+    global QUEUE_DEPTH, SEND_TIME, NOTIFICATIONS_COALESCED, NOTIFICATIONS_DROPPED, ACCOUNT_PROCESSING_TIME
+    global RECONNECTS, RECOVERY_TIME, CONNECTION_FAILURES, CONNECTION_STATE, NOTIFICATION_LATENCY
+    global FETCH_BYTES, FETCH_TIME, DB_OPERATION_TIME, HTTP_TIME, HTTP_RESPONSES, RULE_MATCHES
+    prometheus_host = config.get('GENERAL', 'PrometheusHost', fallback=None)
+    prometheus_port = config.getint('GENERAL', 'PrometheusPort', fallback=None)
+    if not (prometheus_available and prometheus_host and prometheus_port):
+        if not prometheus_available:
+            logging.info("Prometheus client library is not available. Metrics will not be exposed.")
+        else:
+            logging.info("PrometheusHost or PrometheusPort not specified. Metrics will not be exposed.")
+        return
 
-if prometheus_available and prometheus_host and prometheus_port:
+    from prometheus_client import start_http_server, Counter, Histogram, Gauge
+    from prometheus_client import CollectorRegistry, multiprocess
     try:
-        start_http_server(prometheus_port, addr=prometheus_host)
-        logging.info(f"Prometheus metrics server started on {prometheus_host}:{prometheus_port}")
-        EMAILS_PROCESSED = Counter('emails_processed_total', 'Total number of emails processed')
-        NOTIFICATIONS_SENT = Counter('notifications_sent_total', 'Total number of notifications sent')
-        PROCESSING_TIME = Histogram('email_processing_seconds', 'Time spent processing emails')
-        ERRORS = Counter('errors_total', 'Total number of errors encountered')
+        if worker_index is not None:
+            # Samples go to PROMETHEUS_MULTIPROC_DIR, set by the supervisor, which serves them all
+            pass
+        elif supervisor_mode:
+            metrics_dir = os.path.join(runtime_dir, 'metrics')
+            os.makedirs(metrics_dir)
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry, path=metrics_dir)
+            start_http_server(prometheus_port, addr=prometheus_host, registry=registry)
+            logging.info(f"Prometheus metrics server started on {prometheus_host}:{prometheus_port}, aggregating the workers")
+        else:
+            start_http_server(prometheus_port, addr=prometheus_host)
+            logging.info(f"Prometheus metrics server started on {prometheus_host}:{prometheus_port}")
     except Exception as e:
         logging.error(f"Failed to start Prometheus metrics server: {str(e)}")
         prometheus_available = False
-else:
-    if not prometheus_available:
-        logging.info("Prometheus client library is not available. Metrics will not be exposed.")
-    else:
-        logging.info("PrometheusHost or PrometheusPort not specified. Metrics will not be exposed.")
-    class DummyMetric:
-        def inc(self, amount=1):
-            pass
-        def time(self):
-            class DummyTimer:
-                def __enter__(self):
-                    pass
-                def __exit__(self, exc_type, exc_val, exc_tb):
-                    pass
-            return DummyTimer()
-    EMAILS_PROCESSED = NOTIFICATIONS_SENT = ERRORS = DummyMetric()
-    PROCESSING_TIME = DummyMetric()
-
-# Flask web interface setup
-flask_host = config.get('GENERAL', 'FlaskHost', fallback=None)
-flask_port = config.getint('GENERAL', 'FlaskPort', fallback=None)
+        return
+    metrics_enabled = True
+
+    EMAILS_PROCESSED = Counter('emails_processed_total', 'Total number of emails processed')
+    NOTIFICATIONS_SENT = Counter('notifications_sent_total', 'Total number of notifications sent')
+    PROCESSING_TIME = Histogram('email_processing_seconds', 'Time spent processing emails')
+    ERRORS = Counter('errors_total', 'Total number of errors encountered')
+    CACHE_HITS = Counter('notified_cache_hits_total', 'Duplicate checks answered by the in-memory notified UID cache')
+    CACHE_MISSES = Counter('notified_cache_misses_total', 'Duplicate checks that had to query the database')
+    QUEUE_DEPTH = Gauge('notification_queue_depth', 'Notifications waiting in the outbox', ['provider'],
+                        multiprocess_mode='livesum')
+    SEND_TIME = Histogram('notification_send_seconds', 'Time spent delivering a notification', ['provider'])
+    NOTIFICATIONS_COALESCED = Counter('notifications_coalesced_total', 'Notifications merged into a digest', ['provider'])
+    NOTIFICATIONS_DROPPED = Counter('notifications_dropped_total', 'Notifications abandoned after OutboxMaxAttempts failed attempts', ['provider'])
+    ACCOUNT_PROCESSING_TIME = Histogram('account_processing_seconds', 'Time spent processing new emails after an IDLE wake-up',
+                                        ['account', 'folder'])
+    RECONNECTS = Counter('imap_reconnects_total', 'IMAP connections re-established after being lost', ['account', 'folder'])
+    RECOVERY_TIME = Histogram('imap_recovery_seconds', 'Time from losing an IMAP connection to re-establishing it', ['account', 'folder'],
+                              buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+    CONNECTION_FAILURES = Counter('imap_connection_failures_total', 'Lost IMAP connections and failed connection attempts',
+                                  ['account', 'folder', 'reason'])
+    CONNECTION_STATE = Gauge('imap_connection_state', 'Set to 1 for the current state of each IMAP connection',
+                             ['account', 'folder', 'state'], multiprocess_mode='livesum')
+    NOTIFICATION_LATENCY = Histogram('notification_latency_seconds', 'Time from the server announcing new email to the provider accepting the notification',
+                                     ['account', 'provider'], buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, 3600))
+    FETCH_BYTES = Counter('imap_fetch_bytes_total', 'Bytes received in answer to FETCH commands', ['account', 'folder'])
+    FETCH_TIME = Histogram('imap_fetch_seconds', 'Duration of FETCH commands', ['account', 'folder'])
+    DB_OPERATION_TIME = Histogram('db_operation_seconds', 'Duration of database operations, waiting for the database lock included',
+                                  ['operation'], buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+    HTTP_TIME = Histogram('provider_http_seconds', 'Duration of the HTTP requests of the notification providers', ['provider'])
+    HTTP_RESPONSES = Counter('provider_http_responses_total', 'HTTP responses received by the notification providers, by status code '
+                             '("error" when no response was received)', ['provider', 'code'])
+    RULE_MATCHES = Counter('rule_matches_total', 'Emails matched by a notification rule', ['rule', 'action'])
+
+# Flask web interface setup, see start_services()
+flask_host = None
+flask_port = None
+app = None
+
+class Subscription:
+    """The events waiting for one subscriber of the EventBus, at most `size` of them.
+
+    When the subscriber doesn't keep up, the oldest events are dropped and counted in `dropped`:
+    publishing never waits for a subscriber.
+    """
+    def __init__(self, bus, size, types=None):
+        self.bus = bus
+        self.size = size
+        self.types = types
+        self.events = deque()
+        self.dropped = 0
+
+    def get(self, timeout):
+        """Wait up to `timeout` seconds for events; return (events, number dropped since the last call)."""
+        with self.bus.condition:
+            self.bus.condition.wait_for(lambda: self.events or self.dropped, timeout)
+            events, self.events = list(self.events), deque()
+            dropped, self.dropped = self.dropped, 0
+        return events, dropped
 
-if flask_available and flask_host and flask_port:
+    def close(self):
+        self.bus.unsubscribe(self)
+
+class EventBus:
+    """Publish what happens in this process (new email, notifications sent or failed, connection states)
+    to the /events streams and to in-process listeners such as the StatusBoard.
+
+    Listeners run in the publishing thread and must be quick; subscribers get a bounded buffer each.
+    """
+    def __init__(self, buffer_size=1000):
+        self.buffer_size = buffer_size
+        self.condition = threading.Condition()
+        self.subscriptions = []
+        self.listeners = []
+        self.last_id = 0
+
+    def listen(self, callback):
+        self.listeners.append(callback)
+
+    def subscribe(self, types=None):
+        subscription = Subscription(self, self.buffer_size, types)
+        with self.condition:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.condition:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def publish(self, event_type, **data):
+        event = {'type': event_type, 'time': time.time()}
+        event.update(data)
+        self.publish_event(event)
+
+    def publish_event(self, event):
+        with self.condition:
+            self.last_id += 1
+            event['id'] = self.last_id
+            for subscription in self.subscriptions:
+                if subscription.types and event['type'] not in subscription.types:
+                    continue
+                if len(subscription.events) >= subscription.size:
+                    subscription.events.popleft()
+                    subscription.dropped += 1
+                subscription.events.append(event)
+            if self.subscriptions:
+                self.condition.notify_all()
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logging.error(f"Event listener failed: {str(e)}")
+
+# Types of the events published on the EventBus
+EVENT_TYPES = ('mail_arrived', 'notification_sent', 'notification_failed', 'connection_state', 'catch_up')
+
+event_bus = EventBus()
+
+class StatusBoard:
+    """The /status of every mailbox, updated by the connection_state events instead of being rebuilt
+    from the handlers on every request. The JSON answer is cached until something changes."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (account, connection) -> status, in the order the connections started
+        self.entries = {}
+        self.version = 0
+        self.cached = None
+
+    def on_event(self, event):
+        if event['type'] == 'connection_state':
+            self.update(event['account'], event['connection'], event['status'])
+        elif event['type'] == 'catch_up':
+            self.catch_up(event)
+
+    def catch_up(self, event):
+        """Show the progress of a catch-up in the status of the connection watching the folder, until it's done."""
+        with self.lock:
+            for key, status in list(self.entries.items()):
+                if key[0] != event['account'] or event['folder'] not in status['folders']:
+                    continue
+                # A new dict: the current one may be queued for subscribers or in a snapshot being serialized
+                status = dict(status)
+                if event['done'] < event['total']:
+                    status['catch_up'] = {name: event[name] for name in ('folder', 'policy', 'done', 'total')}
+                else:
+                    status.pop('catch_up', None)
+                self.entries[key] = status
+                self.version += 1
+
+    def update(self, account, connection, status):
+        with self.lock:
+            self.entries[(account, connection)] = status
+            self.version += 1
+
+    def remove(self, account, connection):
+        with self.lock:
+            if self.entries.pop((account, connection), None) is not None:
+                self.version += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.entries.values())
+
+    def json(self):
+        with self.lock:
+            if self.cached is None or self.cached[0] != self.version:
+                self.cached = (self.version, json.dumps({'accounts': list(self.entries.values())}))
+            return self.cached[1]
+
+status_board = StatusBoard()
+event_bus.listen(status_board.on_event)
+
+def handler_status(handler):
+    return {
+        'email_user': handler.email_user,
+        'folder': handler.folder,
+        'folders': handler.folders,
+        'state': handler.state,
+        'connected': handler.mail is not None,
+        'reconnects': handler.reconnects,
+        'last_check': handler.last_check.strftime("%Y-%m-%d %H:%M:%S") if handler.last_check else None,
+        'last_processing_seconds': handler.last_processing_seconds
+    }
+
+def collect_status():
+    """Status of every monitored mailbox: from this process, or from the status files of the workers."""
+    if not supervisor_mode:
+        return status_board.snapshot()
+    accounts = []
+    for index in range(worker_count):
+        try:
+            with open(os.path.join(runtime_dir, f'worker-{index}.json')) as f:
+                report = json.load(f)
+        except (OSError, ValueError):
+            continue
+        # A worker that stopped reporting is down, whatever its last report says
+        stale = time.time() - report['time'] > 3 * STATUS_INTERVAL
+        for account in report['accounts']:
+            account['worker'] = index
+            account['connected'] = account['connected'] and not stale
+            accounts.append(account)
+    return accounts
+
+# Most lines /logs returns at once
+LOG_TAIL_MAX_LINES = 10000
+
+LOG_TIME_RE = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d')
+
+def log_line_time(line):
+    """The timestamp of a log line as written ('YYYY-MM-DD HH:MM:SS', which sorts like the time itself),
+    None for the continuation lines of a multi-line record (e.g. a traceback)."""
+    match = LOG_TIME_RE.match(line)
+    return match.group() if match else None
+
+def parse_since(value):
+    """The `since` parameter of /logs: seconds since the epoch, or a local ISO date and time."""
+    try:
+        return datetime.datetime.fromtimestamp(float(value))
+    except ValueError:
+        return datetime.datetime.fromisoformat(value)
+
+def reverse_lines(f, block_size=65536):
+    """Yield the lines of a binary file from the last to the first, reading it backwards in blocks."""
+    position = f.seek(0, os.SEEK_END)
+    remainder = b''
+    while position > 0:
+        step = min(block_size, position)
+        position -= step
+        f.seek(position)
+        lines = (f.read(step) + remainder).split(b'\n')
+        # The first piece may be the end of a line that starts in the previous block
+        remainder = lines.pop(0)
+        for line in reversed(lines):
+            yield line
+    yield remainder
+
+def tail_log(path, count=100, since=None):
+    """The last `count` lines of the log, only those written at or after `since` (a datetime) when given.
+
+    Only the end of the file is read, whatever its size. Continuation lines belong to the record above them.
+    """
+    if since is not None:
+        since = since.strftime('%Y-%m-%d %H:%M:%S')
+    selected = []
+    continuation = []
+    with open(path, 'rb') as f:
+        lines = reverse_lines(f)
+        # The file normally ends with a newline, leaving an empty last piece
+        first = next(lines, b'')
+        if first:
+            lines = itertools.chain([first], lines)
+        for raw in lines:
+            line = raw.decode('utf-8', 'replace').rstrip('\r')
+            if since is not None:
+                stamp = log_line_time(line)
+                if stamp is None:
+                    continuation.append(line)
+                    continue
+                if stamp < since:
+                    break
+                selected.extend(continuation)
+                continuation = []
+            selected.append(line)
+            if len(selected) >= count:
+                break
+    return list(reversed(selected[:count]))
+
+def follow_log(path, timeout=1):
+    """Yield the lines appended to the log from now on, reopening it when it is rotated or truncated.
+
+    Yields None whenever `timeout` seconds pass without new lines, so the caller can send keep-alives.
+    Writes by this process wake the follower right away; writes by other processes (the workers of the
+    supervisor) are noticed within `timeout` seconds.
+    """
+    f = open(path, 'rb')
+    f.seek(0, os.SEEK_END)
+    pending = b''
+    version = log_watcher.version
+    try:
+        while True:
+            data = f.read(65536)
+            if data:
+                lines = (pending + data).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    yield line.decode('utf-8', 'replace').rstrip('\r')
+                continue
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                current = None
+            if current is not None and (current.st_ino != os.fstat(f.fileno()).st_ino or current.st_size < f.tell()):
+                # Rotated (the old file is renamed, a new one created) or truncated: start over on the new file
+                f.close()
+                f = open(path, 'rb')
+                pending = b''
+                continue
+            new_version = log_watcher.wait(version, timeout)
+            if new_version == version:
+                yield None
+            version = new_version
+    finally:
+        f.close()
+
+def create_app():
+    """The Flask web interface: /status, /logs, /logs/stream, /events and /config."""
+    from flask import Flask, Response, jsonify, request, stream_with_context
     app = Flask(__name__)
 
     @app.route('/status')
@@ -175,18 +582,13 @@ if flask_available and flask_host and flask_port:
         api_key = request.args.get('api_key')
         configured_api_key = config.get('GENERAL', 'APIKey', fallback=None)
         if api_key == configured_api_key and api_key is not None:
-            status_info = {'accounts': []}
-            for handler in multi_handler.handlers:
-                account_status = {
-                    'email_user': handler.email_user,
-                    'folder': handler.folder,
-                    'connected': handler.mail is not None,
-                    'last_check': handler.last_check.strftime("%Y-%m-%d %H:%M:%S") if handler.last_check else None
-                }
-                status_info['accounts'].append(account_status)
+            if not supervisor_mode:
+                return status_board.json(), 200, {'Content-Type': 'application/json'}
+            status_info = {'accounts': collect_status()}
             return jsonify(status_info)
         else:
-            all_connected = all(handler.mail is not None for handler in multi_handler.handlers)
+            accounts = collect_status()
+            all_connected = bool(accounts) and all(account['connected'] for account in accounts)
             if all_connected:
                 return jsonify({'status': 'OK'}), 200
             else:
@@ -198,15 +600,79 @@ if flask_available and flask_host and flask_port:
         configured_api_key = config.get('GENERAL', 'APIKey', fallback=None)
         if api_key == configured_api_key and api_key is not None:
             try:
-                with open(log_file_location, 'r') as f:
-                    logs = f.readlines()
-                    last_n_lines = logs[-100:]
-                return ''.join(last_n_lines), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+                count = min(int(request.args.get('lines', 100)), LOG_TAIL_MAX_LINES)
+                since = request.args.get('since')
+                since = parse_since(since) if since else None
+            except (ValueError, OverflowError, OSError):
+                return "Invalid lines or since parameter", 400
+            try:
+                lines = tail_log(log_file_location, count, since) if count > 0 else []
+                return ''.join(line + '\n' for line in lines), 200, {'Content-Type': 'text/plain; charset=utf-8'}
             except Exception as e:
                 return f"Failed to read log file: {str(e)}", 500
         else:
             return "Unauthorized", 401
 
+    @app.route('/logs/stream')
+    def logs_stream():
+        """Server-Sent Events: one `data:` event per log line, starting with the last `lines` (default 0) lines."""
+        api_key = request.args.get('api_key')
+        configured_api_key = config.get('GENERAL', 'APIKey', fallback=None)
+        if api_key != configured_api_key or api_key is None:
+            return "Unauthorized", 401
+        try:
+            count = min(int(request.args.get('lines', 0)), LOG_TAIL_MAX_LINES)
+        except ValueError:
+            return "Invalid lines parameter", 400
+
+        def events():
+            if count > 0:
+                for line in tail_log(log_file_location, count):
+                    yield f"data: {line}\n\n"
+            idle = 0
+            for line in follow_log(log_file_location):
+                if line is None:
+                    idle += 1
+                    # A comment now and then, so proxies keep the connection and closed clients are noticed
+                    if idle % 15 == 0:
+                        yield ": keep-alive\n\n"
+                    continue
+                idle = 0
+                yield f"data: {line}\n\n"
+
+        return Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    @app.route('/events')
+    def events_stream():
+        """Server-Sent Events from the EventBus, optionally only the comma separated `types`."""
+        api_key = request.args.get('api_key')
+        configured_api_key = config.get('GENERAL', 'APIKey', fallback=None)
+        if api_key != configured_api_key or api_key is None:
+            return "Unauthorized", 401
+        types = set(filter(None, request.args.get('types', '').split(',')))
+        if types - set(EVENT_TYPES):
+            return f"Unknown event types: {', '.join(sorted(types - set(EVENT_TYPES)))}", 400
+        subscription = event_bus.subscribe(types)
+
+        def events():
+            try:
+                # Opens the stream right away, and tells the client how long to wait before reconnecting
+                yield "retry: 5000\n\n"
+                while True:
+                    events, dropped = subscription.get(15)
+                    if dropped:
+                        yield f"event: overflow\ndata: {json.dumps({'dropped': dropped})}\n\n"
+                    if not events and not dropped:
+                        yield ": keep-alive\n\n"
+                    for event in events:
+                        yield f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+            finally:
+                subscription.close()
+
+        return Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
     @app.route('/config', methods=['GET'])
     def get_config():
         api_key = request.args.get('api_key')
@@ -225,21 +691,130 @@ if flask_available and flask_host and flask_port:
             return jsonify(config_dict)
         else:
             return "Unauthorized", 401
-else:
-    if not flask_available:
+
+    return app
+
+def start_services():
+    """Start the Prometheus metrics server and create the web interface, when configured."""
+    global flask_host, flask_port, app
+    setup_metrics()
+    flask_host = config.get('GENERAL', 'FlaskHost', fallback=None)
+    flask_port = config.getint('GENERAL', 'FlaskPort', fallback=None)
+    if flask_available and flask_host and flask_port:
+        app = create_app()
+    elif not flask_available:
         logging.info("Flask is not available. Web interface is disabled.")
     else:
         logging.info("FlaskHost or FlaskPort not specified. Web interface will not be started.")
-    app = None
+
+class NotifiedCache:
+    """Bounded LRU cache, with TTL, of the (account, folder, uid) keys already notified.
+
+    While every notified row of the database fits in the cache (it was warmed completely and
+    nothing has been evicted for lack of space since), a miss is a definitive "not notified"
+    and the database doesn't need to be queried at all.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.complete = False
+        self.lock = Lock()
+
+    def warm(self, rows, complete):
+        with self.lock:
+            for account, folder, uid, timestamp in rows:
+                self.entries[(account, folder, uid)] = timestamp
+                self.entries.move_to_end((account, folder, uid), last=False)
+            self.complete = complete and len(self.entries) <= self.max_size
+            self.trim()
+
+    def add(self, account, folder, uids, timestamp=None):
+        timestamp = timestamp or time.time()
+        with self.lock:
+            for uid in uids:
+                self.entries[(account, folder, uid)] = timestamp
+                self.entries.move_to_end((account, folder, uid))
+            self.trim()
+
+    def discard(self, account, folder, uids):
+        with self.lock:
+            for uid in uids:
+                self.entries.pop((account, folder, uid), None)
+
+    def trim(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.complete = False
+
+    def lookup(self, account, folder, uid):
+        """Return True or False when the cache knows the answer, None when the database must be asked."""
+        now = time.time()
+        with self.lock:
+            # Rows written before the folder was part of the key have an empty folder
+            for key in ((account, folder, uid), (account, '', uid)):
+                timestamp = self.entries.get(key)
+                if timestamp is None:
+                    continue
+                if now - timestamp > self.ttl:
+                    # The row itself stays until the retention purge: only the database knows from now on
+                    del self.entries[key]
+                    self.complete = False
+                    continue
+                self.entries.move_to_end(key)
+                return True
+            return False if self.complete else None
+
+    def expire(self, cutoff):
+        with self.lock:
+            for key in [key for key, timestamp in self.entries.items() if timestamp < cutoff]:
+                del self.entries[key]
+
+    def forget_folder(self, account, folder):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == account and key[1] == folder]:
+                del self.entries[key]
+
+def db_operation(method):
+    """Record the duration of a DatabaseHandler method in db_operation_seconds."""
+    @functools.wraps(method)
+    def timed(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            DB_OPERATION_TIME.labels(operation=method.__name__).observe(time.monotonic() - start)
+    return timed
 
 class DatabaseHandler:
     def __init__(self, db_name=None):
         if db_name is None:
             db_name = config.get('GENERAL', 'DataBaseLocation', fallback="processed_emails.db")
-        self.connection = sqlite3.connect(db_name)
+        synchronous = config.get('GENERAL', 'DataBaseSynchronous', fallback='NORMAL').upper()
+        if synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise ValueError(f"Invalid DataBaseSynchronous: {synchronous}")
+        # "rows": a processed_emails row per notified UID; "ranges": processed_ranges, runs of consecutive UIDs
+        self.uid_storage = config.get('GENERAL', 'UIDStorage', fallback='rows').lower()
+        if self.uid_storage not in ('rows', 'ranges'):
+            raise ValueError(f"Invalid UIDStorage: {self.uid_storage}")
+        # A single connection is shared by every monitoring thread, all access goes through self.lock
+        self.connection = sqlite3.connect(db_name, timeout=30, check_same_thread=False)
         self.cursor = self.connection.cursor()
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute(f"PRAGMA synchronous={synchronous}")
         self.create_table()
         self.update_schema_if_needed()
+        self.migrate_uid_storage()
+        # (account, folder) having ranges stored without a UIDVALIDITY, which every lookup of the folder must check too
+        self.loose_ranges = set()
+        if self.uid_storage == 'ranges':
+            self.cursor.execute("SELECT DISTINCT email_account, folder FROM processed_ranges WHERE uidvalidity = 0")
+            self.loose_ranges = set(self.cursor.fetchall())
+        self.cache = NotifiedCache(config.getint('GENERAL', 'CacheSize', fallback=10000),
+                                   config.getint('GENERAL', 'CacheTTL', fallback=config.getint('GENERAL', 'RetentionDays', fallback=7) * 86400))
+        self.warm_cache()
 
     def __enter__(self):
         return self
@@ -247,15 +822,76 @@ class DatabaseHandler:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+    @contextlib.contextmanager
+    def batch(self):
+        """Group the writes done inside the block into a single transaction."""
+        with self.lock:
+            self.batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.connection.rollback()
+                raise
+            self.batch_depth -= 1
+            self.commit()
+
+    def commit(self):
+        if self.batch_depth == 0:
+            with DB_OPERATION_TIME.labels(operation='commit').time():
+                self.connection.commit()
+
     def create_table(self):
         self.cursor.execute('''
         CREATE TABLE IF NOT EXISTS processed_emails (
             email_account TEXT,
+            folder TEXT,
             uid TEXT,
             notified INTEGER,
-            processed_date TEXT,
-            PRIMARY KEY(email_account, uid)
+            processed_at INTEGER,
+            PRIMARY KEY(email_account, folder, uid)
+        )''')
+        # UIDStorage = ranges: the notified UIDs of a folder as disjoint ranges, 0 for an unknown UIDVALIDITY
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS processed_ranges (
+            email_account TEXT,
+            folder TEXT,
+            uidvalidity INTEGER,
+            first_uid INTEGER,
+            last_uid INTEGER,
+            processed_at INTEGER,
+            PRIMARY KEY(email_account, folder, uidvalidity, first_uid)
+        ) WITHOUT ROWID''')
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_processed_ranges_processed_at ON processed_ranges(processed_at)")
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS folder_state (
+            email_account TEXT,
+            folder TEXT,
+            uidvalidity INTEGER,
+            last_uid INTEGER,
+            highestmodseq INTEGER,
+            PRIMARY KEY(email_account, folder)
         )''')
+        self.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            provider TEXT,
+            email_account TEXT,
+            mail_from TEXT,
+            mail_subject TEXT,
+            attempts INTEGER DEFAULT 0,
+            created_at INTEGER,
+            next_attempt_at REAL,
+            claimed INTEGER DEFAULT 0,
+            last_error TEXT,
+            detected_at REAL,
+            priority INTEGER,
+            accepted TEXT,
+            held INTEGER DEFAULT 0
+        )''')
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(kind, next_attempt_at)")
         self.connection.commit()
 
     def update_schema_if_needed(self):
@@ -265,120 +901,1079 @@ class DatabaseHandler:
             self.cursor.execute("ALTER TABLE processed_emails ADD COLUMN email_account TEXT DEFAULT 'unknown'")
             self.cursor.execute("CREATE UNIQUE INDEX idx_email_account_uid ON processed_emails(email_account, uid)")
             self.connection.commit()
-
-    def add_email(self, email_account, uid, notified):
-        date_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.cursor.execute("INSERT OR REPLACE INTO processed_emails (email_account, uid, notified, processed_date) VALUES (?, ?, ?, ?)",
-                            (email_account, uid, notified, date_str))
+            columns.append('email_account')
+        if 'folder' not in columns or 'processed_at' not in columns:
+            # UIDs are only unique per folder and dates are stored as epochs: rebuild the table.
+            # Rows written before the folder was part of the key don't know it and are kept with an empty one.
+            folder = 'folder' if 'folder' in columns else "''"
+            self.cursor.execute("ALTER TABLE processed_emails RENAME TO processed_emails_legacy")
+            self.cursor.execute("DROP INDEX IF EXISTS idx_email_account_uid")
+            self.create_table()
+            self.cursor.execute("INSERT OR IGNORE INTO processed_emails (email_account, folder, uid, notified, processed_at) "
+                                f"SELECT email_account, {folder}, uid, notified, CAST(strftime('%s', processed_date, 'utc') AS INTEGER) "
+                                "FROM processed_emails_legacy")
+            self.cursor.execute("DROP TABLE processed_emails_legacy")
+            self.connection.commit()
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_processed_emails_processed_at ON processed_emails(processed_at)")
+        self.cursor.execute("PRAGMA table_info(folder_state)")
+        if 'highestmodseq' not in [column[1] for column in self.cursor.fetchall()]:
+            self.cursor.execute("ALTER TABLE folder_state ADD COLUMN highestmodseq INTEGER")
+        self.cursor.execute("PRAGMA table_info(outbox)")
+        columns = [column[1] for column in self.cursor.fetchall()]
+        if 'detected_at' not in columns:
+            self.cursor.execute("ALTER TABLE outbox ADD COLUMN detected_at REAL")
+        if 'priority' not in columns:
+            self.cursor.execute("ALTER TABLE outbox ADD COLUMN priority INTEGER")
+        if 'accepted' not in columns:
+            self.cursor.execute("ALTER TABLE outbox ADD COLUMN accepted TEXT")
+        if 'held' not in columns:
+            self.cursor.execute("ALTER TABLE outbox ADD COLUMN held INTEGER DEFAULT 0")
         self.connection.commit()
 
-    def is_email_notified(self, email_account, uid):
-        self.cursor.execute("SELECT * FROM processed_emails WHERE email_account = ? AND uid = ? AND notified = 1", (email_account, uid))
-        return bool(self.cursor.fetchone())
+    def migrate_uid_storage(self):
+        """Move the notified UIDs to the table of the configured UIDStorage when the other one has some."""
+        source = 'processed_emails' if self.uid_storage == 'ranges' else 'processed_ranges'
+        self.cursor.execute(f"SELECT 1 FROM {source} LIMIT 1")
+        if self.cursor.fetchone() is None:
+            return
+        start = time.monotonic()
+        if self.uid_storage == 'ranges':
+            # Sorted by folder and UID, so consecutive UIDs can be merged while streaming
+            rows = self.connection.execute(
+                "SELECT p.email_account, p.folder, COALESCE(s.uidvalidity, 0), CAST(p.uid AS INTEGER), p.processed_at "
+                "FROM processed_emails p LEFT JOIN folder_state s ON s.email_account = p.email_account AND s.folder = p.folder "
+                "WHERE p.notified = 1 AND p.uid <> '' AND p.uid NOT GLOB '*[^0-9]*' ORDER BY 1, 2, 3, 4")
+            with self.batch():
+                self.cursor.executemany("INSERT INTO processed_ranges (email_account, folder, uidvalidity, first_uid, last_uid, processed_at) "
+                                        "VALUES (?, ?, ?, ?, ?, ?)", merge_uid_ranges(rows))
+                stored = self.cursor.rowcount
+                self.cursor.execute("DELETE FROM processed_emails")
+                migrated = self.cursor.rowcount
+        else:
+            ranges = self.connection.execute("SELECT email_account, folder, first_uid, last_uid, processed_at FROM processed_ranges")
+            with self.batch():
+                self.cursor.executemany("INSERT OR IGNORE INTO processed_emails (email_account, folder, uid, notified, processed_at) VALUES (?, ?, ?, 1, ?)",
+                                        ((account, folder, str(uid), processed_at) for account, folder, first, last, processed_at in ranges
+                                         for uid in range(first, last + 1)))
+                stored = self.cursor.rowcount
+                self.cursor.execute("DELETE FROM processed_ranges")
+                migrated = self.cursor.rowcount
+        logging.info(f"UIDStorage is {self.uid_storage}: moved {migrated} entries of {source} to {stored} in {time.monotonic() - start:.1f}s")
+
+    def warm_cache(self):
+        if self.uid_storage == 'ranges':
+            # Lookups are a single index seek: the cache only keeps the recent UIDs it is given
+            return
+        limit = self.cache.max_size
+        with self.lock:
+            self.cursor.execute("SELECT email_account, folder, uid, processed_at FROM processed_emails WHERE notified = 1 "
+                                "ORDER BY processed_at DESC LIMIT ?", (limit + 1,))
+            rows = self.cursor.fetchall()
+        entries = [(account, folder, uid, processed_at or time.time()) for account, folder, uid, processed_at in rows[:limit]]
+        self.cache.warm(entries, complete=len(rows) <= limit)
+        logging.info(f"Notified UID cache warmed with {len(entries)} entries (complete: {self.cache.complete})")
+
+    def add_email(self, email_account, folder, uid, notified):
+        self.add_emails(email_account, folder, [uid], notified)
+
+    @db_operation
+    def add_emails(self, email_account, folder, uids, notified, uidvalidity=None):
+        now = int(time.time())
+        with self.lock:
+            if self.uid_storage == 'ranges':
+                self.update_ranges(email_account, folder, uidvalidity or 0, sorted({int(uid) for uid in uids}), notified, now)
+            else:
+                self.cursor.executemany("INSERT OR REPLACE INTO processed_emails (email_account, folder, uid, notified, processed_at) VALUES (?, ?, ?, ?, ?)",
+                                        [(email_account, folder, uid, notified, now) for uid in uids])
+            self.commit()
+        if notified:
+            self.cache.add(email_account, folder, uids)
+        else:
+            self.cache.discard(email_account, folder, uids)
+
+    def update_ranges(self, email_account, folder, uidvalidity, uids, notified, now):
+        """Add sorted UIDs to the ranges of a folder, merging the ranges they join, or remove them when not `notified`."""
+        key = (email_account, folder, uidvalidity)
+        if not uidvalidity:
+            self.loose_ranges.add((email_account, folder))
+        for first, last in uid_runs(uids):
+            # The ranges touching first - 1 to last + 1: at most one starting before first, and those starting inside
+            self.cursor.execute("SELECT first_uid, last_uid, processed_at FROM processed_ranges WHERE email_account = ? AND folder = ? "
+                                "AND uidvalidity = ? AND first_uid < ? ORDER BY first_uid DESC LIMIT 1", key + (first,))
+            touching = [row for row in self.cursor.fetchall() if row[1] >= first - 1]
+            self.cursor.execute("SELECT first_uid, last_uid, processed_at FROM processed_ranges WHERE email_account = ? AND folder = ? "
+                                "AND uidvalidity = ? AND first_uid BETWEEN ? AND ?", key + (first, last + 1))
+            touching += self.cursor.fetchall()
+            self.cursor.executemany("DELETE FROM processed_ranges WHERE email_account = ? AND folder = ? AND uidvalidity = ? AND first_uid = ?",
+                                    [key + (start,) for start, _, _ in touching])
+            if notified:
+                kept = [(min([first] + [start for start, _, _ in touching]), max([last] + [end for _, end, _ in touching]), now)]
+            else:
+                # Only what lies outside first to last remains
+                kept = [(start, min(end, first - 1), processed_at) for start, end, processed_at in touching if start < first]
+                kept += [(max(start, last + 1), end, processed_at) for start, end, processed_at in touching if end > last]
+            self.cursor.executemany("INSERT INTO processed_ranges (email_account, folder, uidvalidity, first_uid, last_uid, processed_at) "
+                                    "VALUES (?, ?, ?, ?, ?, ?)", [key + row for row in kept])
+
+    def in_ranges(self, email_account, folder, uid, uidvalidity):
+        uid = int(uid)
+        keys = [(email_account, folder, uidvalidity or 0)]
+        # Ranges stored without a UIDVALIDITY, or migrated from rows written before the folder was part of the key
+        for loose in ((email_account, folder), (email_account, '')):
+            if loose in self.loose_ranges and loose + (0,) not in keys:
+                keys.append(loose + (0,))
+        for key in keys:
+            # The range starting at or before uid, found with one seek in the primary key
+            self.cursor.execute("SELECT last_uid FROM processed_ranges WHERE email_account = ? AND folder = ? AND uidvalidity = ? "
+                                "AND first_uid <= ? ORDER BY first_uid DESC LIMIT 1", key + (uid,))
+            row = self.cursor.fetchone()
+            if row is not None and row[0] >= uid:
+                return True
+        return False
+
+    def is_email_notified(self, email_account, folder, uid, uidvalidity=None):
+        cached = self.cache.lookup(email_account, folder, uid)
+        if cached is not None:
+            CACHE_HITS.inc()
+            return cached
+        CACHE_MISSES.inc()
+        # Served by the primary key index; sqlite3 keeps the prepared statement in its cache
+        with DB_OPERATION_TIME.labels(operation='is_email_notified').time(), self.lock:
+            if self.uid_storage == 'ranges':
+                notified = self.in_ranges(email_account, folder, uid, uidvalidity)
+            else:
+                self.cursor.execute("SELECT 1 FROM processed_emails WHERE email_account = ? AND folder IN (?, '') AND uid = ? AND notified = 1 LIMIT 1",
+                                    (email_account, folder, uid))
+                notified = self.cursor.fetchone() is not None
+        if notified:
+            self.cache.add(email_account, folder, [uid])
+        return notified
+
+    @db_operation
+    def get_folder_state(self, email_account, folder):
+        with self.lock:
+            self.cursor.execute("SELECT uidvalidity, last_uid, highestmodseq FROM folder_state WHERE email_account = ? AND folder = ?",
+                                (email_account, folder))
+            return self.cursor.fetchone()
+
+    @db_operation
+    def set_folder_state(self, email_account, folder, uidvalidity, last_uid, highestmodseq=None):
+        """Store the UID state of a folder; without a new HIGHESTMODSEQ the stored one is kept."""
+        with self.lock:
+            self.cursor.execute("INSERT INTO folder_state (email_account, folder, uidvalidity, last_uid, highestmodseq) VALUES (?, ?, ?, ?, ?) "
+                                "ON CONFLICT(email_account, folder) DO UPDATE SET uidvalidity = excluded.uidvalidity, "
+                                "last_uid = excluded.last_uid, highestmodseq = COALESCE(excluded.highestmodseq, highestmodseq)",
+                                (email_account, folder, uidvalidity, last_uid, highestmodseq))
+            self.commit()
+
+    @db_operation
+    def reset_folder(self, email_account, folder):
+        with self.batch():
+            self.cursor.execute("DELETE FROM processed_emails WHERE email_account = ? AND folder = ?", (email_account, folder))
+            self.cursor.execute("DELETE FROM processed_ranges WHERE email_account = ? AND folder = ?", (email_account, folder))
+            self.cursor.execute("DELETE FROM folder_state WHERE email_account = ? AND folder = ?", (email_account, folder))
+        self.loose_ranges.discard((email_account, folder))
+        self.cache.forget_folder(email_account, folder)
+
+    @db_operation
+    def add_outbox(self, provider, email_account, mail_from, mail_subject, detected_at=None, priority=None, held=False):
+        """Queue a notification; a `held` one waits for the digest of its coalescing window and is not delivered."""
+        now = time.time()
+        with self.lock:
+            self.cursor.execute("INSERT INTO outbox (kind, provider, email_account, mail_from, mail_subject, created_at, next_attempt_at, detected_at, priority, held) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (provider.name, provider.key, email_account, mail_from, mail_subject, int(now), now, detected_at, priority, int(held)))
+            self.commit()
+            return self.cursor.lastrowid
+
+    @db_operation
+    def held_outbox(self, provider_key, email_account):
+        """The notifications held for the digest of a coalescing window: (id, mail_from, mail_subject, detected_at, priority)."""
+        with self.lock:
+            self.cursor.execute("SELECT id, mail_from, mail_subject, detected_at, priority FROM outbox "
+                                "WHERE held = 1 AND provider = ? AND email_account IS ? ORDER BY id", (provider_key, email_account))
+            return self.cursor.fetchall()
+
+    @db_operation
+    def held_outbox_windows(self, accounts=None):
+        """The (provider, email_account) pairs with held notifications, e.g. left by a run that stopped before its digest."""
+        owned, params = self.outbox_filter(accounts)
+        with self.lock:
+            self.cursor.execute(f"SELECT DISTINCT provider, email_account FROM outbox WHERE held = 1 AND {owned}", params)
+            return self.cursor.fetchall()
+
+    @db_operation
+    def release_held_outbox(self, ids):
+        """Deliver held notifications as they are."""
+        with self.batch():
+            self.cursor.executemany("UPDATE outbox SET held = 0, next_attempt_at = ? WHERE id = ?",
+                                    [(time.time(), row_id) for row_id in ids])
+
+    @db_operation
+    def merge_held_outbox(self, ids, provider, email_account, mail_from, mail_subject, detected_at=None, priority=None):
+        """Replace held notifications with their digest in a single transaction."""
+        with self.batch():
+            self.cursor.executemany("DELETE FROM outbox WHERE id = ?", [(row_id,) for row_id in ids])
+            return self.add_outbox(provider, email_account, mail_from, mail_subject, detected_at, priority)
+
+    def outbox_filter(self, accounts):
+        """SQL condition restricting the outbox to the rows of `accounts`, every row when None.
+
+        A None entry in `accounts` stands for the rows that belong to no account, like script errors.
+        """
+        if accounts is None:
+            return "1", ()
+        names = [account for account in accounts if account is not None]
+        clause = f"email_account IN ({', '.join('?' * len(names))})"
+        if None in accounts:
+            clause = f"({clause} OR email_account IS NULL)"
+        return clause, tuple(names)
+
+    @db_operation
+    def claim_outbox(self, kind, limit, lease, accounts=None):
+        """Return up to `limit` due notifications of a provider type, hiding them from other workers for `lease` seconds."""
+        now = time.time()
+        owned, params = self.outbox_filter(accounts)
+        with self.batch():
+            self.cursor.execute("SELECT id, provider, email_account, mail_from, mail_subject, attempts, detected_at, priority, accepted FROM outbox "
+                                f"WHERE kind = ? AND next_attempt_at <= ? AND held = 0 AND {owned} ORDER BY next_attempt_at, id LIMIT ?",
+                                (kind, now) + params + (limit,))
+            rows = self.cursor.fetchall()
+            if rows:
+                self.cursor.executemany("UPDATE outbox SET next_attempt_at = ?, claimed = 1 WHERE id = ?",
+                                        [(now + lease, row[0]) for row in rows])
+        return rows
+
+    @db_operation
+    def renew_outbox(self, ids, lease):
+        """Keep claimed rows hidden from other workers for another `lease` seconds while their batch is delivered."""
+        with self.batch():
+            self.cursor.executemany("UPDATE outbox SET next_attempt_at = ? WHERE id = ? AND claimed = 1",
+                                    [(time.time() + lease, row_id) for row_id in ids])
+
+    @db_operation
+    def release_outbox(self, ids=None, accounts=None):
+        """Make claimed rows due again: the given ones, or all those of `accounts` when a previous run died holding a claim."""
+        with self.batch():
+            if ids is None:
+                owned, params = self.outbox_filter(accounts)
+                self.cursor.execute(f"UPDATE outbox SET next_attempt_at = ?, claimed = 0 WHERE claimed = 1 AND {owned}",
+                                    (time.time(),) + params)
+            else:
+                self.cursor.executemany("UPDATE outbox SET next_attempt_at = ?, claimed = 0 WHERE id = ?",
+                                        [(time.time(), row_id) for row_id in ids])
+
+    @db_operation
+    def finish_outbox(self, delivered, failed=None, retry_at=None, error=None, dropped=(), released=(), accepted=None):
+        """Record the outcome of a batch in a single transaction.
+
+        `delivered` and `dropped` rows are removed and `released` ones (claimed but not attempted) become due
+        again. When the `failed` row's provider is failing, every row of that provider is postponed to `retry_at`,
+        and `accepted` lists the targets that took the failed row's notification, so that they are not sent it again.
+        """
+        with self.batch():
+            removed = [(row_id,) for row_id in list(delivered) + list(dropped)]
+            if removed:
+                self.cursor.executemany("DELETE FROM outbox WHERE id = ?", removed)
+            if released:
+                self.release_outbox(released)
+            if failed is not None:
+                row_id, provider_key = failed
+                self.cursor.execute("UPDATE outbox SET attempts = attempts + 1, last_error = ?, accepted = COALESCE(?, accepted) WHERE id = ?",
+                                    (error, '\n'.join(accepted) if accepted else None, row_id))
+                self.cursor.execute("UPDATE outbox SET next_attempt_at = ?, claimed = 0 WHERE provider = ?", (retry_at, provider_key))
+
+    def outbox_kinds(self, accounts=None):
+        owned, params = self.outbox_filter(accounts)
+        with self.lock:
+            self.cursor.execute(f"SELECT DISTINCT kind FROM outbox WHERE {owned}", params)
+            return [row[0] for row in self.cursor.fetchall()]
+
+    @db_operation
+    def outbox_depth(self, kind, due_only=False, accounts=None):
+        owned, params = self.outbox_filter(accounts)
+        with self.lock:
+            if due_only:
+                self.cursor.execute(f"SELECT COUNT(*) FROM outbox WHERE kind = ? AND next_attempt_at <= ? AND held = 0 AND {owned}",
+                                    (kind, time.time()) + params)
+            else:
+                self.cursor.execute(f"SELECT COUNT(*) FROM outbox WHERE kind = ? AND {owned}", (kind,) + params)
+            return self.cursor.fetchone()[0]
 
-    def delete_old_emails(self, days=7):
-        date_limit_str = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
-        self.cursor.execute("DELETE FROM processed_emails WHERE processed_date < ?", (date_limit_str,))
-        self.connection.commit()
+    @db_operation
+    def delete_old_emails(self, days=7, chunk_size=1000):
+        """Delete the rows older than `days`, a chunk per transaction so that processing can interleave.
+
+        With UIDStorage = ranges, the ranges that weren't extended for `days`.
+        """
+        cutoff = int(time.time() - days * 86400)
+        deleted = 0
+        while True:
+            with self.lock:
+                if self.uid_storage == 'ranges':
+                    self.cursor.execute("DELETE FROM processed_ranges WHERE (email_account, folder, uidvalidity, first_uid) IN "
+                                        "(SELECT email_account, folder, uidvalidity, first_uid FROM processed_ranges WHERE processed_at < ? LIMIT ?)",
+                                        (cutoff, chunk_size))
+                else:
+                    self.cursor.execute("DELETE FROM processed_emails WHERE rowid IN "
+                                        "(SELECT rowid FROM processed_emails WHERE processed_at < ? LIMIT ?)", (cutoff, chunk_size))
+                count = self.cursor.rowcount
+                self.commit()
+            deleted += count
+            if count < chunk_size:
+                break
+        self.cache.expire(cutoff)
+        return deleted
 
     def close(self):
-        self.connection.close()
+        with self.lock:
+            self.connection.close()
+
+shared_database = None
+shared_database_lock = Lock()
+
+def get_database():
+    """Return the database handler shared by every mailbox, opening it on first use."""
+    global shared_database
+    with shared_database_lock:
+        if shared_database is None:
+            shared_database = DatabaseHandler()
+        return shared_database
+
+class RetentionScheduler(threading.Thread):
+    """Purge old processed emails periodically, away from the IMAP processing path."""
+    def __init__(self, days, interval, chunk_size):
+        super().__init__(name="retention", daemon=True)
+        self.days = days
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                start = time.monotonic()
+                deleted = get_database().delete_old_emails(self.days, self.chunk_size)
+                if deleted:
+                    logging.info(f"Retention: deleted {deleted} processed emails older than {self.days} days in {time.monotonic() - start:.2f}s")
+            except Exception as e:
+                logging.error(f"Retention run failed: {str(e)}")
+                ERRORS.inc()
+
+    def stop(self):
+        self.stopped.set()
+
+# Header fields requested when FetchMode is "headers"
+HEADER_FIELDS = ('FROM', 'SUBJECT', 'MESSAGE-ID', 'DATE')
+FETCH_UID_RE = re.compile(rb'UID (\d+)')
+FETCH_FLAGS_RE = re.compile(rb'FLAGS \(([^)]*)\)')
+
+def uid_runs(numbers):
+    """The runs of consecutive numbers in a sorted list, as [first, last] pairs."""
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ranges
+
+def merge_uid_ranges(rows):
+    """Merge (account, folder, uidvalidity, uid, processed_at) rows, sorted, into ranges of consecutive UIDs."""
+    current = None
+    for account, folder, uidvalidity, uid, processed_at in rows:
+        if current is not None and current[:3] == [account, folder, uidvalidity] and uid <= current[4] + 1:
+            current[4] = max(current[4], uid)
+            current[5] = max(current[5] or 0, processed_at or 0)
+            continue
+        if current is not None:
+            yield tuple(current)
+        current = [account, folder, uidvalidity, uid, uid, processed_at]
+    if current is not None:
+        yield tuple(current)
+
+def format_uid_set(uids):
+    """Compress a list of UIDs into an IMAP sequence set, e.g. 1:3,7,9:10."""
+    return ','.join(str(start) if start == end else f"{start}:{end}" for start, end in uid_runs(sorted(int(uid) for uid in uids)))
+
+def is_seen(fetch_response):
+    match = FETCH_FLAGS_RE.search(fetch_response)
+    return bool(match) and b'\\Seen' in match.group(1)
+
+def decode_header_value(value):
+    if value is None:
+        return None
+    value = ''.join(str(value).splitlines())
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+# Notification priorities, as in ntfy: each provider maps them to its own scale
+PRIORITIES = {'min': 1, 'low': 2, 'default': 3, 'high': 4, 'urgent': 5}
+# Backreferences can't be moved into a combined regex, see RuleSet
+BACKREFERENCE_RE = re.compile(r'\\[1-9]|\(\?P=')
+# Besides the lower case, what re.IGNORECASE matches with an ASCII letter (and "İ".lower() is two characters)
+CASE_FOLD = str.maketrans({'\u0130': 'i', '\u0131': 'i', '\u017f': 's'})
+REPEATS = tuple(getattr(sre_parse, name) for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT') if hasattr(sre_parse, name))
+
+def fold_case(value):
+    return value.translate(CASE_FOLD).lower()
+
+def required_literals(pattern):
+    r"""The ASCII strings, in lower case, found in every text a compiled regex matches: ["invoice #", " "] for
+    r'^invoice #\d+ (paid|overdue)?'. Alternatives, optional parts and character classes are left out."""
+    literals, run = [], []
+
+    def flush():
+        if run:
+            literals.append(''.join(run))
+            run.clear()
+
+    def walk(items):
+        for op, value in items:
+            if op is sre_parse.LITERAL and value < 128:
+                run.append(chr(value).lower())
+            elif op is sre_parse.SUBPATTERN:
+                # A group is part of the sequence: its literals continue the current run
+                walk(value[-1])
+            elif op in REPEATS and value[0] >= 1:
+                flush()
+                walk(value[2])
+                flush()
+            else:
+                flush()
+
+    try:
+        walk(sre_parse.parse(pattern.pattern, pattern.flags))
+    except Exception:
+        return []
+    flush()
+    return literals
+
+def parse_priority(value):
+    value = value.strip().lower()
+    if value in PRIORITIES:
+        return PRIORITIES[value]
+    if value.isdigit() and 1 <= int(value) <= 5:
+        return int(value)
+    raise ValueError(f"invalid Priority '{value}', use min, low, default, high, urgent or 1 to 5")
+
+def split_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+class Rule:
+    """A [RULE:name] section: conditions on the folder, sender and header fields of an email, and what to do with it.
+
+    Every condition given must match: Folder and FromDomain are lists (a domain also matches its subdomains),
+    From, Subject and Header.<field> are regexes searched case-insensitively. Action is "notify" (the default,
+    optionally only through the Providers listed and with a Priority) or "suppress".
+    """
+    def __init__(self, section, position):
+        options = dict(config.items(section, raw=True))
+        self.name = section.split(':', 1)[1]
+        self.position = position
+        self.accounts = set(split_list(options.get('accounts', '')))
+        self.folders = {folder.lower() for folder in split_list(options.get('folder', ''))}
+        self.domains = {domain.lower().lstrip('@.') for domain in split_list(options.get('fromdomain', ''))}
+        # Field (lower case header name) -> compiled regex
+        self.patterns = {}
+        for key, value in options.items():
+            if key in ('from', 'subject') or key.startswith('header.'):
+                field = key[len('header.'):] if key.startswith('header.') else key
+                try:
+                    self.patterns[field] = re.compile(value, re.IGNORECASE)
+                except re.error as e:
+                    raise ValueError(f"invalid {key} regex in [{section}]: {str(e)}")
+        if not (self.folders or self.domains or self.patterns):
+            raise ValueError(f"[{section}] has no condition")
+        self.action = options.get('action', 'notify').strip().lower()
+        if self.action not in ('notify', 'suppress'):
+            raise ValueError(f"invalid Action '{self.action}' in [{section}], use 'notify' or 'suppress'")
+        # Provider types ("gotify") or sections ("gotify:account1"), None for every provider of the account
+        self.providers = frozenset(provider.lower() for provider in split_list(options.get('providers', ''))) or None
+        self.priority = parse_priority(options['priority']) if 'priority' in options else None
+
+    def applies_to(self, account_name):
+        return not self.accounts or account_name in self.accounts
+
+    def matches(self, folder, domains, fields):
+        if self.folders and folder not in self.folders:
+            return False
+        if self.domains and self.domains.isdisjoint(domains):
+            return False
+        for field, pattern in self.patterns.items():
+            if pattern.search(fields.get(field) or '') is None:
+                return False
+        return True
+
+    def selects(self, provider):
+        """Whether a notification matched by this rule goes through `provider`."""
+        return (self.providers is None or provider.name in self.providers
+                or provider.key.split(':', 1)[1].lower() in self.providers)
+
+def compile_rules():
+    """The [RULE:name] sections, in the order of the configuration file. Raises ValueError for an invalid one."""
+    return [Rule(section, position) for position, section in enumerate(section for section in config.sections() if section.startswith('RULE:'))]
+
+class RuleSet:
+    r"""The rules of an account, compiled so that matching an email costs a few lookups per field and only runs the
+    regexes of the rules that can match, however many rules there are.
+
+    The first rule that matches, in the order of the configuration file, wins. Each rule is indexed once, by its most
+    selective condition: its FromDomain domains; else a three character piece (trigram) of a literal that its regexes
+    require, e.g. "voi" for r'^invoice #\d+'; else its Folder. Matching an email looks up its sender's domains, the
+    trigrams of its header fields and its folder, and only tries the rules found. The regexes of the few remaining
+    rules are combined into one alternation per field: when it finds nothing, none of them can match.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.by_domain = {}
+        # Field -> trigram -> rules
+        self.by_literal = {}
+        self.by_folder = {}
+        literals = {rule: self.trigrams(rule) for rule in rules if not rule.domains}
+        # Index each rule by its trigram used by the fewest rules, so that common words don't gather large groups
+        frequency = {}
+        for trigrams in literals.values():
+            for trigram in set(trigrams):
+                frequency[trigram] = frequency.get(trigram, 0) + 1
+        others = []
+        for rule in rules:
+            if rule.domains:
+                for domain in rule.domains:
+                    self.by_domain.setdefault(domain, []).append(rule)
+            elif literals[rule]:
+                field, trigram = min(literals[rule], key=lambda trigram: frequency[trigram])
+                self.by_literal.setdefault(field, {}).setdefault(trigram, []).append(rule)
+            elif rule.folders:
+                for folder in rule.folders:
+                    self.by_folder.setdefault(folder, []).append(rule)
+            else:
+                others.append(rule)
+        patterns = {}
+        for rule in others:
+            for field, pattern in rule.patterns.items():
+                if self.combinable(pattern):
+                    patterns.setdefault(field, []).append(pattern.pattern)
+        self.prefilters = {field: re.compile('|'.join(f'(?:{pattern})' for pattern in group), re.IGNORECASE)
+                           for field, group in patterns.items()}
+        # The other rules grouped by the fields that must pass their prefilter, in order within each group
+        self.groups = {}
+        for rule in others:
+            fields = frozenset(field for field, pattern in rule.patterns.items() if field in self.prefilters and self.combinable(pattern))
+            self.groups.setdefault(fields, []).append(rule)
+        # Header fields to fetch besides HEADER_FIELDS
+        self.header_fields = sorted({field.upper() for rule in rules for field in rule.patterns} - set(HEADER_FIELDS))
+
+    @staticmethod
+    def trigrams(rule):
+        """The (field, trigram) pairs of the literals required by the regexes of a rule: any of them is enough to find it."""
+        return [(field, literal[index:index + 3]) for field, pattern in rule.patterns.items()
+                for literal in required_literals(pattern) for index in range(len(literal) - 2)]
+
+    @staticmethod
+    def combinable(pattern):
+        """Whether a regex means the same inside an alternation: no backreferences, named groups or inline global flags."""
+        if pattern.groupindex or BACKREFERENCE_RE.search(pattern.pattern):
+            return False
+        try:
+            re.compile(f'(?:{pattern.pattern})')
+        except re.error:
+            return False
+        return True
+
+    def match(self, folder, sender, fields):
+        """The first rule matching an email, or None. `fields` maps lower case header names to their decoded value."""
+        folder = folder.lower()
+        domain = parseaddr(sender or '')[1].rpartition('@')[2].lower()
+        # The domain and every parent domain: mail.example.com, example.com, com
+        parts = domain.split('.')
+        domains = {'.'.join(parts[index:]) for index in range(len(parts))} if domain else set()
+        candidates = []
+        for name in domains:
+            candidates += self.by_domain.get(name, ())
+        for field, index in self.by_literal.items():
+            value = fold_case(fields.get(field) or '')
+            for trigram in {value[position:position + 3] for position in range(len(value) - 2)}:
+                candidates += index.get(trigram, ())
+        candidates += self.by_folder.get(folder, ())
+        if self.groups:
+            passed = {field for field, prefilter in self.prefilters.items() if prefilter.search(fields.get(field) or '')}
+            for required, rules in self.groups.items():
+                if required <= passed:
+                    candidates += rules
+        for rule in sorted(set(candidates), key=lambda rule: rule.position):
+            if rule.matches(folder, domains, fields):
+                return rule
+        return None
+
+# What a catch-up does with the backlog, see EmailProcessor.catch_up()
+CATCH_UP_POLICIES = ('notify', 'baseline', 'last', 'summary')
 
 class EmailProcessor:
-    def __init__(self, mail, email_account, notifier):
+    def __init__(self, mail, email_account, notifier, folder="inbox", uidvalidity=None, uidnext=None, db_handler=None,
+                 highestmodseq=None, changed=None, detected_at=None, rules=None):
         self.mail = mail
+        self.db_handler = db_handler
         self.email_account = email_account
         self.notifier = notifier
+        self.folder = folder
+        self.uidvalidity = uidvalidity
+        self.uidnext = uidnext
+        # Only known right after SELECT: the folder's HIGHESTMODSEQ and, with QRESYNC, the UIDs changed since our state
+        self.highestmodseq = highestmodseq
+        self.changed = changed
+        # When the server announced the new email, for the notification_latency_seconds metric
+        self.detected_at = detected_at
+        self.fetch_mode = config.get('GENERAL', 'FetchMode', fallback='headers').lower()
+        self.chunk_size = max(1, config.getint('GENERAL', 'FetchChunkSize', fallback=100))
+        # A pass finding more than catch_up_threshold emails works through them as a backlog, see catch_up()
+        self.catch_up_threshold = config.getint('GENERAL', 'CatchUpThreshold', fallback=500)
+        self.catch_up_window = max(1, config.getint('GENERAL', 'CatchUpWindow', fallback=500))
+        self.catch_up_policy = config.get('GENERAL', 'CatchUpPolicy', fallback='notify').lower()
+        self.catch_up_last = max(1, config.getint('GENERAL', 'CatchUpLast', fallback=10))
+        # The RuleSet of the account, None when no rule applies to it
+        self.rules = rules
+        # Header fields used by the rules, fetched along with HEADER_FIELDS
+        self.extra_fields = rules.header_fields if rules else []
 
     def fetch_unseen_emails(self):
         status, messages = self.mail.uid('search', None, "UNSEEN")
         return messages[0].split()
 
+    def fetch_new_emails(self, last_uid):
+        status, messages = self.mail.uid('search', None, f"UID {last_uid + 1}:*")
+        # "n:*" always matches the highest UID, even when it is lower than n
+        return [message for message in messages[0].split() if int(message) > last_uid]
+
     def parse_email(self, raw_email):
         return BytesParser(policy=policy.default).parsebytes(raw_email)
 
+    def parse_headers(self, raw_headers):
+        # Only the requested header fields are present, so skip the full policy.default tree
+        headers = BytesHeaderParser(policy=policy.compat32).parsebytes(raw_headers)
+        return {field: decode_header_value(headers.get(field)) for field in ('From', 'Subject', 'Message-ID', 'Date', *self.extra_fields)}
+
+    def fetch(self, uid_set, query):
+        start = time.monotonic()
+        _, data = self.mail.uid('fetch', uid_set, query)
+        FETCH_TIME.labels(account=self.email_account, folder=self.folder).observe(time.monotonic() - start)
+        size = sum(len(part[0]) + len(part[1]) if isinstance(part, tuple) else len(part) for part in data if part)
+        FETCH_BYTES.labels(account=self.email_account, folder=self.folder).inc(size)
+        return data
+
+    def fetch_full(self, uids):
+        for uid in uids:
+            msg = self.fetch(uid, '(FLAGS BODY.PEEK[])')
+            for response_part in msg:
+                if isinstance(response_part, tuple):
+                    email_message = self.parse_email(response_part[1])
+                    headers = {field: email_message.get(field) for field in ('From', 'Subject', 'Message-ID', 'Date', *self.extra_fields)}
+                    yield uid, headers, is_seen(response_part[0])
+
+    def fetch_headers(self, uids):
+        query = f"(UID FLAGS BODY.PEEK[HEADER.FIELDS ({' '.join(HEADER_FIELDS + tuple(self.extra_fields))})])"
+        for start in range(0, len(uids), self.chunk_size):
+            chunk = uids[start:start + self.chunk_size]
+            data = self.fetch(format_uid_set(chunk), query)
+            pending = None
+            for response_part in data:
+                if isinstance(response_part, tuple):
+                    match = FETCH_UID_RE.search(response_part[0])
+                    if match:
+                        yield match.group(1).decode(), self.parse_headers(response_part[1]), is_seen(response_part[0])
+                    else:
+                        pending = response_part
+                elif pending is not None and isinstance(response_part, bytes):
+                    # Some servers send the UID (and FLAGS) after the header literal
+                    match = FETCH_UID_RE.search(response_part)
+                    if match:
+                        seen = is_seen(pending[0]) or is_seen(response_part)
+                        yield match.group(1).decode(), self.parse_headers(pending[1]), seen
+                    pending = None
+
+    def fetch_messages(self, uids):
+        return self.fetch_full(uids) if self.fetch_mode == 'full' else self.fetch_headers(uids)
+
     def process(self):
         logging.info("Fetching the latest email...")
-        with DatabaseHandler() as db_handler:
-            for message in self.fetch_unseen_emails():
-                uid = message.decode('utf-8')
-                if db_handler.is_email_notified(self.email_account, uid):
-                    logging.info(f"Email UID {uid} already processed and notified, skipping...")
+        db_handler = self.db_handler or get_database()
+        state = db_handler.get_folder_state(self.email_account, self.folder)
+        if state and self.uidvalidity is not None and state[0] != self.uidvalidity:
+            logging.warning(f"[{self.email_account} - {self.folder}] UIDVALIDITY changed from {state[0]} to {self.uidvalidity}, "
+                            "forgetting the processed UIDs of this folder")
+            db_handler.reset_folder(self.email_account, self.folder)
+            state = None
+
+        if state and self.highestmodseq is not None and state[2] == self.highestmodseq:
+            logging.info(f"[{self.email_account} - {self.folder}] No changes since the last session (HIGHESTMODSEQ {self.highestmodseq})")
+            return
+
+        if state and self.changed is not None:
+            # QRESYNC already told us which messages changed since our state, no need to search
+            last_uid = state[1]
+            candidates = [uid for uid in self.changed if int(uid) > last_uid]
+        elif state:
+            # Only look at what arrived after the last UID we have seen
+            last_uid = state[1]
+            candidates = self.fetch_new_emails(last_uid)
+        else:
+            logging.info(f"[{self.email_account} - {self.folder}] No UID state yet, checking all unseen emails")
+            last_uid = self.uidnext - 1 if self.uidnext else 0
+            candidates = self.fetch_unseen_emails()
+
+        if self.catch_up_threshold and len(candidates) > self.catch_up_threshold:
+            self.catch_up(db_handler, candidates, last_uid)
+        else:
+            self.process_uids(db_handler, candidates, last_uid)
+
+    def process_uids(self, db_handler, candidates, last_uid, highestmodseq=True):
+        """Notify the candidate UIDs not notified yet, then record them and the folder state up to last_uid.
+
+        With last_uid None the folder state is left alone: the emails are ahead of a catch-up still in progress.
+        highestmodseq is the one saved with the state, self.highestmodseq when True; a window of a catch-up saves
+        none, as the rest of the backlog is still to do.
+        """
+        if highestmodseq is True:
+            highestmodseq = self.highestmodseq
+        uids = []
+        for message in candidates:
+            uid = message.decode('utf-8')
+            if last_uid is not None:
+                last_uid = max(last_uid, int(uid))
+            if db_handler.is_email_notified(self.email_account, self.folder, uid, self.uidvalidity):
+                logging.info(f"Email UID {uid} already processed and notified, skipping...")
+                continue
+            uids.append(uid)
+
+        notified = []
+        already_read = 0
+        completed = False
+        try:
+            for uid, headers, seen in self.fetch_messages(uids):
+                if seen:
+                    # Already read on another client before we got to it
+                    already_read += 1
                     continue
+                self.notify(uid, headers)
+                notified.append(uid)
+            completed = True
+            if already_read:
+                logging.info(f"[{self.email_account} - {self.folder}] {already_read} new email(s) already read on another client, not notified")
+        finally:
+            # One transaction for the whole pass; even an interrupted pass records what was already sent
+            with db_handler.batch():
+                if notified:
+                    db_handler.add_emails(self.email_account, self.folder, notified, 1, self.uidvalidity)
+                if completed and last_uid is not None and self.uidvalidity is not None:
+                    db_handler.set_folder_state(self.email_account, self.folder, self.uidvalidity, last_uid, highestmodseq)
+
+    def notify(self, uid, headers):
+        with PROCESSING_TIME.time():
+            sender = headers.get('From')
+            subject = headers.get('Subject')
+            logging.info(f"Processing Email - UID: {uid}, Sender: {sender}, Subject: {subject}")
+            rule = self.match_rule(headers)
+            event_bus.publish('mail_arrived', account=self.email_account, folder=self.folder, uid=uid,
+                              sender=sender, subject=subject, rule=rule.name if rule else None)
+            try:
+                if rule is not None and rule.action == 'suppress':
+                    logging.info(f"Email UID {uid} suppressed by rule {rule.name}")
+                else:
+                    self.notifier.send_notification(sender, subject, self.email_account, self.detected_at,
+                                                    rule.priority if rule else None, rule)
+                    NOTIFICATIONS_SENT.inc()
+            except Exception as e:
+                logging.error(f"Failed to send notification: {str(e)}")
+                ERRORS.inc()
+            EMAILS_PROCESSED.inc()
+
+    def catch_up(self, db_handler, candidates, last_uid):
+        """Work through a backlog (first start, long outage) of more than CatchUpThreshold emails.
+
+        The backlog is kept as an array of UIDs and handled CatchUpWindow emails at a time: only one window of
+        headers is in memory, the folder state is saved after each window so an interrupted catch-up resumes
+        where it stopped, and emails arriving meanwhile are notified between two windows rather than after the
+        whole backlog. CatchUpPolicy decides what happens to the backlog itself: "notify" every email, nothing
+        ("baseline"), only the CatchUpLast most recent unread ones ("last"), or a single "summary" notification.
+        """
+        policy = self.catch_up_policy
+        uids = array('L', sorted({int(uid) for uid in candidates}))
+        total = len(uids)
+        # UIDs above it arrived after the catch-up started. HIGHESTMODSEQ is only saved once the backlog is done:
+        # saved earlier, a reconnection would find "no changes" and never get to the rest of it
+        self.live_uid = max(last_uid, uids[-1])
+        logging.info(f"[{self.email_account} - {self.folder}] Catching up on {total} emails (UIDs {uids[0]} to {uids[-1]}), policy {policy}")
+        self.report_catch_up(policy, 0, total)
+        recent = self.latest_unread(db_handler, uids) if policy == 'last' else []
+        summary = {'count': 0, 'senders': {}}
+        if policy in ('baseline', 'last') and self.uidvalidity is not None:
+            # Nothing to fetch: the folder state alone skips the whole backlog
+            self.record_baseline(db_handler, uids)
+        else:
+            start = time.monotonic()
+            for offset in range(0, total, self.catch_up_window):
+                window = uids[offset:offset + self.catch_up_window]
+                self.process_live(db_handler)
+                if policy == 'notify':
+                    self.process_uids(db_handler, [b'%d' % uid for uid in window], window[-1], None)
+                else:
+                    if policy == 'summary':
+                        self.summarize(window, summary)
+                    self.record_baseline(db_handler, window)
+                done = offset + len(window)
+                elapsed = time.monotonic() - start
+                logging.info(f"[{self.email_account} - {self.folder}] Catch-up ({policy}): {done}/{total} emails, "
+                             f"{done / elapsed if elapsed else done:.0f} emails/s")
+                if done < total:
+                    self.report_catch_up(policy, done, total)
+        for uid, headers in recent:
+            self.notify(uid, headers)
+        if recent:
+            db_handler.add_emails(self.email_account, self.folder, [uid for uid, _ in recent], 1, self.uidvalidity)
+        if summary['count']:
+            self.send_summary(summary)
+        self.process_live(db_handler)
+        if self.uidvalidity is not None:
+            db_handler.set_folder_state(self.email_account, self.folder, self.uidvalidity, self.live_uid, self.highestmodseq)
+        logging.info(f"[{self.email_account} - {self.folder}] Catch-up of {total} emails completed")
+        self.report_catch_up(policy, total, total)
+
+    def process_live(self, db_handler):
+        """Notify the emails that arrived since the catch-up started, ahead of the rest of the backlog."""
+        fresh = self.fetch_new_emails(self.live_uid)
+        if fresh:
+            self.live_uid = max(int(uid) for uid in fresh)
+            self.process_uids(db_handler, fresh, None)
+
+    def record_baseline(self, db_handler, window):
+        """Mark a window of the backlog as handled without notifying it."""
+        if self.uidvalidity is not None:
+            db_handler.set_folder_state(self.email_account, self.folder, self.uidvalidity, window[-1])
+        else:
+            # Without a UIDVALIDITY there is no folder state: only the notified UIDs keep them from being notified again
+            db_handler.add_emails(self.email_account, self.folder, [str(uid) for uid in window], 1)
+
+    def latest_unread(self, db_handler, uids):
+        """The headers of the CatchUpLast most recent unread emails of the backlog not notified yet, oldest first."""
+        recent = []
+        end = len(uids)
+        while end > 0 and len(recent) < self.catch_up_last:
+            window = [str(uid) for uid in uids[max(0, end - self.catch_up_window):end]
+                      if not db_handler.is_email_notified(self.email_account, self.folder, str(uid), self.uidvalidity)]
+            end -= self.catch_up_window
+            fetched = [(uid, headers) for uid, headers, seen in self.fetch_messages(window) if not seen]
+            recent = fetched[-(self.catch_up_last - len(recent)):] + recent
+        return recent
+
+    def summarize(self, window, summary):
+        for uid, headers, seen in self.fetch_messages([str(uid) for uid in window]):
+            if seen:
+                continue
+            rule = self.match_rule(headers)
+            if rule is not None and rule.action == 'suppress':
+                continue
+            name, address = parseaddr(headers.get('From') or '')
+            sender = name or address or 'Unknown Sender'
+            summary['count'] += 1
+            summary['senders'][sender] = summary['senders'].get(sender, 0) + 1
+
+    def send_summary(self, summary):
+        top = sorted(summary['senders'].items(), key=lambda item: item[1], reverse=True)[:3]
+        subject = f"{summary['count']} unread emails in {self.folder}" + (f" for {self.email_account}" if self.email_account else "")
+        body = "Top senders: " + ", ".join(f"{sender} ({count})" for sender, count in top)
+        try:
+            self.notifier.send_notification(body, subject, self.email_account, self.detected_at)
+            NOTIFICATIONS_SENT.inc()
+        except Exception as e:
+            logging.error(f"Failed to send the catch-up summary: {str(e)}")
+            ERRORS.inc()
+
+    def report_catch_up(self, policy, done, total):
+        event_bus.publish('catch_up', account=self.email_account, folder=self.folder, policy=policy, done=done, total=total)
+
+    def match_rule(self, headers):
+        if self.rules is None:
+            return None
+        fields = {field.lower(): str(value) for field, value in headers.items() if value is not None}
+        rule = self.rules.match(self.folder, headers.get('From'), fields)
+        if rule is not None:
+            RULE_MATCHES.labels(rule=rule.name, action=rule.action).inc()
+        return rule
+
+class HTTPSessions:
+    """Keep-alive requests sessions, one per server, shared by every provider that posts to it."""
+    def __init__(self, pool_size=10, timeout=(5, 30)):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.sessions = {}
+        self.lock = Lock()
+        self.traces = threading.local()
+
+    def session_for(self, url):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount(f"{parts.scheme}://", adapter)
+                self.sessions[key] = session
+            return session
+
+    @contextlib.contextmanager
+    def trace(self):
+        """Collect the requests posted by this thread meanwhile, with their status and duration (see --test-config)."""
+        self.traces.requests = []
+        try:
+            yield self.traces.requests
+        finally:
+            self.traces.requests = None
+
+    def post(self, url, provider='http', **kwargs):
+        """POST through the pooled session of the server, recording the latency and status code for `provider`."""
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.monotonic()
+        code = 'error'
+        try:
+            response = self.session_for(url).post(url, **kwargs)
+            code = str(response.status_code)
+            return response
+        finally:
+            seconds = time.monotonic() - start
+            HTTP_TIME.labels(provider=provider).observe(seconds)
+            HTTP_RESPONSES.labels(provider=provider, code=code).inc()
+            if getattr(self.traces, 'requests', None) is not None:
+                # Without the query string, which may hold a token
+                parts = urlsplit(url)
+                self.traces.requests.append({'url': f"{parts.scheme}://{parts.netloc}{parts.path}", 'status': code,
+                                             'ms': round(seconds * 1000, 1)})
+
+# Replaced by configure() with the configured pool size and timeouts
+http_sessions = HTTPSessions()
+
+class TokenBucket:
+    """Token bucket rate limiter: `rate` notifications per minute with bursts of up to `burst`."""
+    def __init__(self, rate, burst):
+        self.rate = rate / 60.0
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = Lock()
 
-                _, msg = self.mail.uid('fetch', message, '(BODY.PEEK[])')
-                for response_part in msg:
-                    if isinstance(response_part, tuple):
-                        with PROCESSING_TIME.time():
-                            email_message = self.parse_email(response_part[1])
-                            sender = email_message.get('From')
-                            subject = email_message.get('Subject')
-                            logging.info(f"Processing Email - UID: {uid}, Sender: {sender}, Subject: {subject}")
-                            try:
-                                self.notifier.send_notification(sender, subject)
-                                NOTIFICATIONS_SENT.inc()
-                            except Exception as e:
-                                logging.error(f"Failed to send notification: {str(e)}")
-                                ERRORS.inc()
-                            db_handler.add_email(self.email_account, uid, 1)
-                            EMAILS_PROCESSED.inc()
-
-            db_handler.delete_old_emails()
+    def acquire(self):
+        """Take a token, sleeping until one is available. Returns the time waited."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+class PartialDelivery(Exception):
+    """Raised by a provider with several targets when only some of them accepted the notification."""
+
+    def __init__(self, accepted, failed):
+        super().__init__(f"{len(failed)} of {len(accepted) + len(failed)} targets failed: {', '.join(failed)}")
+        self.accepted = accepted
 
 class NotificationProvider:
-    def send_notification(self, mail_from, mail_subject):
+    name = 'provider'
+    # Identifies the provider in the outbox across restarts, e.g. "ntfy:NTFY:account1"
+    key = None
+    # Delivery settings, read from the provider's configuration section by configure_delivery()
+    coalesce_window = 0
+    coalesce_threshold = 3
+    rate_limiter = None
+
+    def send_notification(self, mail_from, mail_subject, priority=None):
+        """Send the notification, returning True when the service accepted it.
+
+        `priority` is set by notification rules, from 1 (min) to 5 (urgent) like ntfy; None for the default.
+        A provider sending to several targets raises PartialDelivery when only some of them accepted it, and
+        takes a `skip` argument with the targets to leave out when the outbox retries it.
+        """
         raise NotImplementedError("Subclasses must implement this method")
 
-if apprise_available:
-    class AppriseNotificationProvider(NotificationProvider):
-        def __init__(self, apprise_config):
-            self.apprise = apprise.Apprise()
-            for service_url in apprise_config:
-                self.apprise.add(service_url.strip())
-
-        def send_notification(self, mail_from, mail_subject):
-            mail_subject = mail_subject if mail_subject is not None else "No Subject"
-            mail_from = mail_from if mail_from is not None else "Unknown Sender"
-            message = f"{mail_from}"
-            if not self.apprise.notify(title=mail_subject, body=message):
-                logging.error("Failed to send notification via Apprise.")
-else:
-    pass  # Apprise is not available; skip defining the provider
+class AppriseNotificationProvider(NotificationProvider):
+    name = 'apprise'
+
+    def __init__(self, apprise_config):
+        # Only created when apprise is available and an APPRISE section is configured
+        import apprise
+        self.apprise = apprise.Apprise()
+        for service_url in apprise_config:
+            self.apprise.add(service_url.strip())
+
+    def send_notification(self, mail_from, mail_subject, priority=None):
+        mail_subject = mail_subject if mail_subject is not None else "No Subject"
+        mail_from = mail_from if mail_from is not None else "Unknown Sender"
+        message = f"{mail_from}"
+        if not self.apprise.notify(title=mail_subject, body=message):
+            logging.error("Failed to send notification via Apprise.")
+            return False
+        return True
 
 class NTFYNotificationProvider(NotificationProvider):
+    name = 'ntfy'
+
     def __init__(self, ntfy_data):
         self.ntfy_data = ntfy_data
 
-    def send_notification(self, mail_from, mail_subject):
+    def send_notification(self, mail_from, mail_subject, priority=None, skip=()):
+        # Imported on first use, like the sessions, so the command line doesn't pay for it
+        import requests
         mail_subject = mail_subject if mail_subject is not None else "No Subject"
         mail_from = mail_from if mail_from is not None else "Unknown Sender"
         encoded_from = mail_from.encode('utf-8')
         encoded_subject = mail_subject.encode('utf-8')
 
+        accepted, failed = [], []
         for ntfy_url, token in self.ntfy_data:
+            if ntfy_url in skip:
+                continue
             headers = {"Title": encoded_subject}
+            if priority is not None:
+                headers["Priority"] = str(priority)
             if token:
                 headers["Authorization"] = f"Bearer {token}"
             try:
-                response = requests.post(ntfy_url, data=encoded_from, headers=headers)
+                response = http_sessions.post(ntfy_url, self.name, data=encoded_from, headers=headers)
                 if response.status_code == 200:
                     logging.info(f"Notification sent successfully to {ntfy_url} via ntfy")
+                    accepted.append(ntfy_url)
                 else:
                     logging.error(f"Failed to send notification to {ntfy_url} via NTFY. Status Code: {response.status_code}")
                     ERRORS.inc()
+                    failed.append(ntfy_url)
             except requests.RequestException as e:
                 logging.error(f"An error occurred while sending notification to {ntfy_url} via NTFY: {str(e)}")
                 ERRORS.inc()
+                failed.append(ntfy_url)
             finally:
                 time.sleep(2)
+        if failed and (accepted or skip):
+            # A retry of the whole notification would send it again to the URLs that took it
+            raise PartialDelivery(list(skip) + accepted, failed)
+        return not failed
 
 class PushoverNotificationProvider(NotificationProvider):
-    def __init__(self, api_token, user_key):
+    name = 'pushover'
+
+    def __init__(self, api_token, user_key, pushover_url="https://api.pushover.net/1/messages.json"):
         self.api_token = api_token
         self.user_key = user_key
-        self.pushover_url = "https://api.pushover.net/1/messages.json"
+        self.pushover_url = pushover_url
 
-    def send_notification(self, mail_from, mail_subject):
+    def send_notification(self, mail_from, mail_subject, priority=None):
+        import requests
         mail_subject = mail_subject if mail_subject is not None else "No Subject"
         mail_from = mail_from if mail_from is not None else "Unknown Sender"
         message = f"From: {mail_from}\nSubject: {mail_subject}"
@@ -388,24 +1983,31 @@ class PushoverNotificationProvider(NotificationProvider):
             "user": self.user_key,
             "message": message
         }
+        if priority is not None:
+            # Pushover priorities go from -2 (lowest) to 2 (emergency, which needs retry/expire): stop at 1
+            data["priority"] = {1: -2, 2: -1, 3: 0, 4: 1, 5: 1}[priority]
 
         try:
-            response = requests.post(self.pushover_url, data=data)
+            response = http_sessions.post(self.pushover_url, self.name, data=data)
             if response.status_code == 200:
                 logging.info("Notification sent successfully via Pushover")
-            else:
-                logging.error(f"Failed to send notification via Pushover. Status Code: {response.status_code}")
-                ERRORS.inc()
+                return True
+            logging.error(f"Failed to send notification via Pushover. Status Code: {response.status_code}")
+            ERRORS.inc()
         except requests.RequestException as e:
             logging.error(f"An error occurred while sending notification via Pushover: {str(e)}")
             ERRORS.inc()
+        return False
 
 class GotifyNotificationProvider(NotificationProvider):
+    name = 'gotify'
+
     def __init__(self, gotify_url, gotify_token):
         self.gotify_url = gotify_url
         self.gotify_token = gotify_token
 
-    def send_notification(self, mail_from, mail_subject):
+    def send_notification(self, mail_from, mail_subject, priority=None):
+        import requests
         mail_subject = mail_subject if mail_subject is not None else "No Subject"
         mail_from = mail_from if mail_from is not None else "Unknown Sender"
         message = f"From: {mail_from}\nSubject: {mail_subject}"
@@ -413,120 +2015,1348 @@ class GotifyNotificationProvider(NotificationProvider):
         payload = {
             "title": mail_subject,
             "message": message,
-            "priority": 5
+            # Gotify priorities go from 0 to 10
+            "priority": {1: 1, 2: 3, 3: 5, 4: 7, 5: 10}.get(priority, 5)
         }
         try:
-            response = requests.post(url_with_token, json=payload)
+            response = http_sessions.post(url_with_token, self.name, json=payload)
             if response.status_code == 200:
                 logging.info("Notification sent successfully via Gotify")
-            else:
-                logging.error(f"Failed to send notification via Gotify. Status Code: {response.status_code}")
-                ERRORS.inc()
+                return True
+            logging.error(f"Failed to send notification via Gotify. Status Code: {response.status_code}")
+            ERRORS.inc()
         except requests.RequestException as e:
             logging.error(f"An error occurred while sending notification via Gotify: {str(e)}")
             ERRORS.inc()
+        return False
+
+def backoff_delay(failures, base, maximum):
+    """Exponential backoff with "equal jitter": keep at least half of the delay, randomize the rest."""
+    delay = min(maximum, base * 2 ** (max(1, failures) - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class NotificationDispatcher:
+    """Deliver notifications through a durable SQLite outbox drained by a worker pool per provider type.
+
+    IMAP threads only insert rows into the outbox, so a slow provider no longer keeps a mailbox out of
+    IDLE and a failed notification is not lost: it stays in the outbox, also across restarts, until the
+    provider accepts it. Workers claim due rows in batches; when a provider fails, all of its rows are
+    postponed with exponential backoff and jitter, and the first success lets the backlog drain at once.
+    """
+    def __init__(self, db_handler, workers=2, batch_size=50, retry_base=30, retry_max=3600, max_attempts=0, lease=300,
+                 accounts=None):
+        self.db_handler = db_handler
+        # In a worker process, only the notifications of its own accounts (see DatabaseHandler.outbox_filter)
+        self.accounts = accounts
+        self.workers = workers
+        self.batch_size = batch_size
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.providers = {}
+        self.failures = {}
+        self.wakeups = {}
+        self.threads = []
+        self.windows = {}
+        self.stopping = threading.Event()
+        self.lock = Lock()
+
+    def register(self, providers):
+        with self.lock:
+            for provider in providers:
+                self.providers[provider.key] = provider
+
+    def start(self):
+        """Start the workers of every provider type that is configured or still has pending notifications."""
+        self.db_handler.release_outbox(accounts=self.accounts)
+        # Digests a previous run didn't get to send: their windows are long over
+        for provider_key, account in self.db_handler.held_outbox_windows(self.accounts):
+            self.merge_held(provider_key, account)
+        with self.lock:
+            kinds = {provider.name for provider in self.providers.values()}
+        for kind in kinds | set(self.db_handler.outbox_kinds(self.accounts)):
+            self.wakeup_for(kind).set()
+
+    def wakeup_for(self, kind):
+        with self.lock:
+            if kind not in self.wakeups:
+                self.wakeups[kind] = threading.Event()
+                for index in range(self.workers):
+                    thread = threading.Thread(target=self.worker, args=(kind, self.wakeups[kind]), name=f"{kind}-{index}", daemon=True)
+                    self.threads.append(thread)
+                    thread.start()
+            return self.wakeups[kind]
+
+    def submit(self, provider, mail_from, mail_subject, account=None, detected_at=None, priority=None):
+        if provider.coalesce_window > 0 and not self.coalesce(provider, account, mail_from, mail_subject, detected_at, priority):
+            return True
+        return self.enqueue(provider, mail_from, mail_subject, account, detected_at, priority)
+
+    def enqueue(self, provider, mail_from, mail_subject, account=None, detected_at=None, priority=None):
+        """Store a notification in the outbox. `detected_at` is the epoch at which the server announced the email."""
+        if provider.key not in self.providers:
+            self.register([provider])
+        self.db_handler.add_outbox(provider, account, mail_from, mail_subject, detected_at, priority)
+        self.wakeup_for(provider.name).set()
+        return True
+
+    def coalesce(self, provider, account, mail_from, mail_subject, detected_at=None, priority=None):
+        """Return True when the notification should go out right away, False when it was held for a digest.
+
+        The first notification for an (account, provider) pair opens a window of coalesce_window seconds:
+        up to coalesce_threshold notifications in the window are delivered as usual, the rest are held in
+        the outbox, so that a crash or restart doesn't lose them, and merged into a single digest when the
+        window closes.
+        """
+        key = (provider, account)
+        if provider.key not in self.providers:
+            self.register([provider])
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None:
+                window = self.windows[key] = {'sent': 0, 'held': 0}
+                timer = threading.Timer(provider.coalesce_window, self.flush, args=(provider, account))
+                timer.daemon = True
+                window['timer'] = timer
+                timer.start()
+            if window['sent'] < provider.coalesce_threshold:
+                window['sent'] += 1
+                return True
+            window['held'] += 1
+            # Under the lock, so that the window's flush can't miss it
+            self.db_handler.add_outbox(provider, account, mail_from, mail_subject, detected_at, priority, held=True)
+            return False
+
+    def flush(self, provider, account):
+        with self.lock:
+            window = self.windows.pop((provider, account), None)
+        if window and window['held']:
+            self.merge_held(provider.key, account)
+
+    def merge_held(self, provider_key, account):
+        """Replace the notifications held for (provider, account) with their digest, or let a single one go out."""
+        held = self.db_handler.held_outbox(provider_key, account)
+        if not held:
+            return
+        provider = self.providers.get(provider_key)
+        if len(held) == 1 or provider is None:
+            # Without its provider, the worker drops them like any notification of a provider no longer configured
+            self.db_handler.release_held_outbox([row[0] for row in held])
+            if provider is not None:
+                self.wakeup_for(provider.name).set()
+            return
+        NOTIFICATIONS_COALESCED.labels(provider=provider.name).inc(len(held))
+        senders = {}
+        for _, mail_from, _, _, _ in held:
+            name, address = parseaddr(mail_from or '')
+            sender = name or address or 'Unknown Sender'
+            senders[sender] = senders.get(sender, 0) + 1
+        top = sorted(senders.items(), key=lambda item: item[1], reverse=True)[:3]
+        subject = f"{len(held)} new emails" + (f" for {account}" if account else "")
+        body = "Top senders: " + ", ".join(f"{sender} ({count})" for sender, count in top)
+        # The digest is as late as the oldest email it reports
+        detected = [detected_at for _, _, _, detected_at, _ in held if detected_at is not None]
+        # and as urgent as the most urgent one
+        priorities = [priority for _, _, _, _, priority in held if priority is not None]
+        self.db_handler.merge_held_outbox([row[0] for row in held], provider, account, body, subject,
+                                          min(detected) if detected else None, max(priorities) if priorities else None)
+        self.wakeup_for(provider.name).set()
+
+    def retry_delay(self, provider_key):
+        return backoff_delay(self.failures.get(provider_key, 1), self.retry_base, self.retry_max)
+
+    def worker(self, kind, wakeup):
+        while not self.stopping.is_set():
+            try:
+                rows = self.db_handler.claim_outbox(kind, self.batch_size, self.lease, self.accounts)
+            except Exception as e:
+                logging.error(f"Failed to read the {kind} outbox: {str(e)}")
+                ERRORS.inc()
+                rows = []
+            QUEUE_DEPTH.labels(provider=kind).set(self.db_handler.outbox_depth(kind, accounts=self.accounts))
+            if not rows:
+                # Sleep until something is enqueued, or poll for postponed rows that became due
+                wakeup.wait(5)
+                wakeup.clear()
+                continue
+            self.deliver(kind, rows)
+
+    def deliver(self, kind, rows):
+        delivered, dropped = [], []
+        failed = retry_at = error = None
+        renewed = time.monotonic()
+        for index, (row_id, provider_key, account, mail_from, mail_subject, attempts, detected_at, priority, accepted) in enumerate(rows):
+            provider = self.providers.get(provider_key)
+            if provider is None:
+                logging.warning(f"Dropping queued notification for provider {provider_key}, which is no longer configured")
+                event_bus.publish('notification_failed', provider=provider_key, account=account, subject=mail_subject,
+                                  error="provider no longer configured", attempts=attempts, retry_in=None)
+                dropped.append(row_id)
+                continue
+            if self.stopping.is_set():
+                break
+            if provider.rate_limiter is not None:
+                provider.rate_limiter.acquire()
+            if time.monotonic() - renewed > self.lease / 2:
+                # A rate limited or slow batch outlives its lease: renew it, also for the rows already delivered,
+                # which are only removed by finish_outbox, so that the other workers don't send them again
+                self.db_handler.renew_outbox([row[0] for row in rows], self.lease)
+                renewed = time.monotonic()
+            start = time.monotonic()
+            partial = None
+            try:
+                if accepted:
+                    # Targets that took it on an earlier attempt are not sent it again
+                    ok = provider.send_notification(mail_from, mail_subject, priority, skip=accepted.split('\n')) is not False
+                else:
+                    ok = provider.send_notification(mail_from, mail_subject, priority) is not False
+                error = None if ok else "provider rejected the notification"
+            except PartialDelivery as e:
+                logging.error(f"Failed to send notification via {kind}: {str(e)}")
+                ok, error, partial = False, str(e), e.accepted
+            except Exception as e:
+                logging.error(f"Failed to send notification via {kind}: {str(e)}")
+                ERRORS.inc()
+                ok, error = False, str(e)
+            finally:
+                SEND_TIME.labels(provider=kind).observe(time.monotonic() - start)
+            if ok:
+                self.failures.pop(provider_key, None)
+                delivered.append(row_id)
+                latency = None
+                if detected_at is not None:
+                    latency = max(0, time.time() - detected_at)
+                    NOTIFICATION_LATENCY.labels(account=account or '', provider=kind).observe(latency)
+                event_bus.publish('notification_sent', provider=provider_key, account=account, subject=mail_subject,
+                                  latency=latency)
+                continue
+            if self.max_attempts and attempts + 1 >= self.max_attempts:
+                logging.error(f"Giving up on notification {row_id} via {provider_key} after {attempts + 1} attempts")
+                NOTIFICATIONS_DROPPED.labels(provider=kind).inc()
+                event_bus.publish('notification_failed', provider=provider_key, account=account, subject=mail_subject,
+                                  error=error, attempts=attempts + 1, retry_in=None)
+                dropped.append(row_id)
+                continue
+            # Postpone every row of this provider; rows of other providers in the batch are released by their lease
+            self.failures[provider_key] = self.failures.get(provider_key, 0) + 1
+            delay = self.retry_delay(provider_key)
+            failed, retry_at = (row_id, provider_key), time.time() + delay
+            logging.warning(f"Provider {provider_key} failing ({self.failures[provider_key]} in a row), retrying in {delay:.0f}s")
+            event_bus.publish('notification_failed', provider=provider_key, account=account, subject=mail_subject,
+                              error=error, attempts=attempts + 1, retry_in=round(delay, 1))
+            break
+        else:
+            index = len(rows)
+        released = [row[0] for row in rows[index:] if row[0] not in dropped and (failed is None or row[0] != failed[0])]
+        self.db_handler.finish_outbox(delivered, failed, retry_at, error, dropped, released, partial if failed else None)
+
+    def stop(self, timeout=10):
+        """Flush the coalescing windows and let the workers finish their current batch; the rest stays in the outbox."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            windows = list(self.windows.items())
+        for (provider, account), window in windows:
+            window['timer'].cancel()
+            self.flush(provider, account)
+        # Give the workers a chance to deliver what was just flushed before asking them to stop
+        with self.lock:
+            kinds = list(self.wakeups)
+        while time.monotonic() < deadline and any(self.db_handler.outbox_depth(kind, due_only=True, accounts=self.accounts) for kind in kinds):
+            time.sleep(0.2)
+        self.stopping.set()
+        for wakeup in self.wakeups.values():
+            wakeup.set()
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+# Set by multi_account_main; when None (tests, startup checks) notifications are sent synchronously
+dispatcher = None
 
 class Notifier:
     def __init__(self, providers):
         self.providers = providers
 
-    def send_notification(self, mail_from, mail_subject):
-        for provider in self.providers:
-            provider.send_notification(mail_from, mail_subject)
+    def send_notification(self, mail_from, mail_subject, account=None, detected_at=None, priority=None, rule=None):
+        """Send through every provider, or only through those selected by the rule the email matched."""
+        providers = [provider for provider in self.providers if rule is None or rule.selects(provider)]
+        if not providers:
+            logging.warning(f"Rule {rule.name} selects none of the notification providers of {account}")
+        for provider in providers:
+            if dispatcher is not None:
+                dispatcher.submit(provider, mail_from, mail_subject, account, detected_at, priority)
+            else:
+                try:
+                    provider.send_notification(mail_from, mail_subject, priority)
+                except PartialDelivery:
+                    # Without the outbox nothing is retried; the provider logged the targets that failed
+                    pass
+
+def enable_resync(mail):
+    """Enable QRESYNC, or CONDSTORE, when the server supports it. Return the enabled extension or None.
+
+    Call mail._get_capabilities() after login first: many servers only advertise their extensions then.
+    """
+    if not config.getboolean('GENERAL', 'FastResync', fallback=True):
+        return None
+    for extension in ('QRESYNC', 'CONDSTORE'):
+        if extension in mail.capabilities and 'ENABLE' in mail.capabilities:
+            try:
+                typ, _ = mail.enable(extension)
+            except imaplib.IMAP4.error as e:
+                logging.warning(f"Cannot enable {extension}: {str(e)}")
+                continue
+            if typ == 'OK':
+                return extension
+    return None
+
+def select_folder(mail, folder, state=None, resync=None):
+    """Select a folder and return its (UIDVALIDITY, UIDNEXT, HIGHESTMODSEQ, changed UIDs).
+
+    Values the server doesn't report are None. The changed UIDs are only known with QRESYNC and a stored
+    (UIDVALIDITY, last UID, HIGHESTMODSEQ) state: the server then lists the messages changed since then.
+    """
+    qresync = resync == 'QRESYNC' and state is not None and state[2] is not None
+    if qresync:
+        mail.select(f"{folder} (QRESYNC ({state[0]} {state[2]}))")
+    else:
+        mail.select(folder)
+    codes = []
+    for name in ('UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ'):
+        _, data = mail.response(name)
+        codes.append(int(data[0]) if data and data[0] and data[0].isdigit() else None)
+    # Don't leave the FETCH and VANISHED responses around for the next UID FETCH to pick up, nor the
+    # EXISTS count of the folder, which would look like new email announced later (see IMAPHandler.idle)
+    _, data = mail.response('FETCH')
+    mail.response('VANISHED')
+    mail.response('EXISTS')
+    changed = None
+    if qresync and codes[0] == state[0]:
+        changed = [match.group(1) for match in (FETCH_UID_RE.search(line) for line in data if isinstance(line, bytes)) if match]
+    return codes[0], codes[1], codes[2], changed
+
+def imap_connection_options(section):
+    """The Port and SSL options of an EMAIL section, as IMAPHandler keyword arguments."""
+    use_ssl = config[section].getboolean('SSL', fallback=True)
+    return {'port': config[section].getint('Port', fallback=993 if use_ssl else 143), 'use_ssl': use_ssl}
 
 class IMAPHandler:
-    def __init__(self, host, email_user, email_pass, folder="inbox", notifier=None):
+    def __init__(self, host, email_user, email_pass, folder="inbox", notifier=None, port=993, use_ssl=True):
         self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
         self.email_user = email_user
         self.email_pass = email_pass
         self.folder = folder
+        self.folders = [folder]
         self.notifier = notifier
         self.mail = None
         self.last_check = None
+        self.uidvalidity = None
+        self.uidnext = None
+        self.last_processing_seconds = None
+        # Seconds after which IDLE is ended even without news, None to wait indefinitely
+        self.idle_timeout = None
+        # QRESYNC, CONDSTORE or None, and the (HIGHESTMODSEQ, changed UIDs) of the last SELECT until they're used
+        self.resync = None
+        self.pending_resync = None
+        # IDLE is re-issued well before the server's 29 minute limit, checking that the connection still answers
+        self.idle_refresh = config.getint('GENERAL', 'IdleRefresh', fallback=600)
+        self.probe_timeout = config.getint('GENERAL', 'ProbeTimeout', fallback=30)
+        self.idle_tag = None
+        self.reconnects = 0
+        self.lost_at = None
+        # When the server announced new email that hasn't been processed yet, as an epoch
+        self.detected_at = None
+        # Name of the connection in the metrics labels, which must not change while it runs
+        self.connection_name = folder
+        self.state = None
+        # Set when the monitor must let go of this connection: removed by a reload, or shutdown
+        self.stopping = threading.Event()
+        # Which account and folder this is, and the settings it was opened with (see build_accounts)
+        self.key = None
+        self.signature = None
+        # The RuleSet of the account's notification rules, None without any
+        self.rules = None
+
+    def set_state(self, state):
+        """Export and publish the state of the connection, one of CONNECTION_STATES or None once stopped."""
+        self.state = state
+        for name in CONNECTION_STATES:
+            CONNECTION_STATE.labels(account=self.email_user, folder=self.connection_name, state=name).set(1 if name == state else 0)
+        event_bus.publish('connection_state', account=self.email_user, connection=self.connection_name, state=state,
+                          status=handler_status(self))
+
+    def checked(self):
+        """Record the end of an IDLE wait in the status, without publishing an event."""
+        self.last_check = datetime.datetime.now()
+        status_board.update(self.email_user, self.connection_name, handler_status(self))
+
+    def open_connection(self):
+        if self.use_ssl:
+            return imaplib.IMAP4_SSL(self.host, self.port)
+        # Plain text, password included: only meant for servers on the local host or network
+        return imaplib.IMAP4(self.host, self.port)
+
+    def mark_detected(self):
+        if self.detected_at is None:
+            self.detected_at = time.time()
 
     def connect(self):
         try:
-            self.mail = imaplib.IMAP4_SSL(self.host, 993)
+            self.mail = self.open_connection()
             self.mail.login(self.email_user, self.email_pass)
-            self.mail.select(self.folder)
+            self.mail._get_capabilities()
+            self.resync = enable_resync(self.mail)
+            state = get_database().get_folder_state(self.email_user, self.folder)
+            self.uidvalidity, self.uidnext, highestmodseq, changed = select_folder(self.mail, self.folder, state, self.resync)
+            self.pending_resync = (highestmodseq if self.resync else None, changed)
+            if state:
+                # Pick up what arrived while we were away instead of waiting for the next new email
+                self.process_emails()
         except imaplib.IMAP4.error as e:
+            # The monitor notifies the first failure of an outage, not every reconnection attempt
             logging.error(f"Cannot connect: {str(e)}")
-            if self.notifier:
-                self.notifier.send_notification("Script Error", f"Cannot connect: {str(e)}")
             raise
 
     def idle(self):
+        """IDLE until new email is announced (True), or until it's time to refresh IDLE or shut down (False).
+
+        Connection problems are raised, so the caller can reconnect.
+        """
+        if self.announced():
+            return True
         logging.info(f"[{self.email_user} - {self.folder}] IDLE mode started. Waiting for new email...")
         try:
-            tag = self.mail._new_tag().decode()
-            self.mail.send(f'{tag} IDLE\r\n'.encode('utf-8'))
-            while True:
+            self.start_idle()
+            deadline = time.monotonic() + self.idle_wait()
+            news = False
+            while not news:
                 # Attendiamo sul socket IMAP e sulla socket pair per shutdown
-                rlist, _, _ = select.select([self.mail.sock, shutdown_sock_r], [], [])
-                if shutdown_sock_r in rlist:
-                    # Riceviamo il dato di "wake-up" e usciamo dal loop
-                    shutdown_sock_r.recv(1024)
+                remaining = max(0, deadline - time.monotonic())
+                if self.input_pending() and not shutdown_event.is_set():
+                    rlist = [self.mail.sock]
+                else:
+                    rlist, _, _ = select.select([self.mail.sock, shutdown_sock_r], [], [], remaining)
+                if not rlist or shutdown_sock_r in rlist:
+                    # Il byte di "wake-up" resta nella socket pair, così si svegliano tutti i thread
                     break
-                if self.mail.sock in rlist:
-                    line = self.mail.readline()
-                    if line:
-                        if b'BYE' in line:
-                            raise ConnectionAbortedError("Received BYE from server. Trying to reconnect...")
-                        if b'EXISTS' in line:
-                            break
-            self.mail.send(b'DONE\r\n')
-            self.mail.readline()
-        except Exception as e:
-            logging.error(f"[{self.email_user}] Error in idle: {str(e)}")
+                news = self.handle_idle_line(self.read_response())
+            return self.stop_idle() or news
         finally:
             logging.info(f"[{self.email_user}] IDLE mode stopped.")
-            self.last_check = datetime.datetime.now()
+            self.checked()
+
+    def announced(self):
+        """True when new email was announced in the answer to an earlier command, e.g. a FETCH while processing.
+
+        imaplib keeps such untagged EXISTS responses to itself, and the server won't repeat them in IDLE.
+        """
+        _, data = self.mail.response('EXISTS')
+        if data and data[0] is not None:
+            return self.handle_idle_line(b'* ' + data[-1] + b' EXISTS')
+        return False
+
+    def buffered_input(self):
+        """The data imaplib already received but select() can't see: read ahead into its buffered file
+        (e.g. an EXISTS sent in the same packet as the IDLE continuation) or decrypted by the SSL layer."""
+        sock = self.mail.sock
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return self.mail.file.peek(1)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return b''
+        finally:
+            sock.settimeout(timeout)
+
+    def input_pending(self):
+        return bool(self.buffered_input())
+
+    def line_buffered(self):
+        """True when a whole response line, not announcing a literal, can be read without waiting for the network."""
+        line, newline, _ = self.buffered_input().partition(b'\n')
+        return bool(newline) and not imaplib.Literal.match(line.rstrip(b'\r'))
+
+    def read_response(self):
+        """Read a response line in IDLE, with the literals it announces (e.g. a mailbox name in a NOTIFY STATUS)."""
+        line = self.mail.readline()
+        while True:
+            literal = imaplib.Literal.match(line.rstrip(b'\r\n'))
+            if not literal:
+                return line
+            line += self.mail.read(int(literal.group('size'))) + self.mail.readline()
+
+    def idle_wait(self):
+        """Seconds before IDLE is ended even without news."""
+        if self.idle_timeout:
+            return min(self.idle_timeout, self.idle_refresh)
+        return self.idle_refresh
+
+    def start_idle(self):
+        self.idle_tag = self.mail._new_tag()
+        self.mail.send(self.idle_tag + b' IDLE\r\n')
+
+    def handle_idle_line(self, line):
+        """Return True when the line announces new email."""
+        if not line:
+            raise ConnectionAbortedError("Connection closed by the server")
+        if b'BYE' in line:
+            raise ConnectionAbortedError("Received BYE from server. Trying to reconnect...")
+        if b'EXISTS' in line:
+            self.mark_detected()
+            return True
+        return False
+
+    def stop_idle(self):
+        """End IDLE and wait for the server to confirm it, returning True if new email showed up meanwhile.
+
+        A server that doesn't answer within probe_timeout is considered gone: the socket is probably half-open.
+        """
+        news = False
+        with self.probe():
+            self.mail.send(b'DONE\r\n')
+            while True:
+                line = self.read_response()
+                if line.startswith(self.idle_tag + b' '):
+                    break
+                news = self.handle_idle_line(line) or news
+        self.mail.tagged_commands.pop(self.idle_tag, None)
+        return news
+
+    @contextlib.contextmanager
+    def probe(self):
+        """Run commands that must be answered within probe_timeout seconds."""
+        sock = self.mail.sock
+        previous = sock.gettimeout()
+        sock.settimeout(self.probe_timeout)
+        try:
+            yield
+        except socket.timeout:
+            raise ConnectionAbortedError(f"No answer from the server in {self.probe_timeout}s")
+        finally:
+            sock.settimeout(previous)
+
+    def check_connection(self):
+        """Called when IDLE ended without news: make sure the server still answers."""
+        with self.probe():
+            self.mail.noop()
+
+    def close(self):
+        """Drop the connection without waiting for the server, which may be gone."""
+        mail, self.mail = self.mail, None
+        if mail is not None:
+            try:
+                mail.shutdown()
+            except Exception:
+                pass
+
+    def take_pending_resync(self):
+        pending, self.pending_resync = self.pending_resync, None
+        return pending or (None, None)
 
     def process_emails(self):
-        processor = EmailProcessor(self.mail, self.email_user, self.notifier)
-        processor.process()
+        highestmodseq, changed = self.take_pending_resync()
+        detected_at, self.detected_at = self.detected_at, None
+        processor = EmailProcessor(self.mail, self.email_user, self.notifier, self.folder, self.uidvalidity, self.uidnext,
+                                   highestmodseq=highestmodseq, changed=changed, detected_at=detected_at, rules=self.rules)
+        start = time.monotonic()
+        try:
+            processor.process()
+        finally:
+            self.last_processing_seconds = round(time.monotonic() - start, 3)
+            ACCOUNT_PROCESSING_TIME.labels(account=self.email_user, folder=self.folder).observe(self.last_processing_seconds)
+
+STATUS_RE = re.compile(rb'(?:"((?:[^"\\]|\\.)*)"|(\S+)) \((.*)\)')
+# A mailbox name sent as a literal: {size} CRLF, then the name itself
+STATUS_LITERAL_RE = re.compile(rb'\{(\d+)\+?\}\r?\n')
+STATUS_ITEMS_RE = re.compile(rb' ?\((.*)\)')
+
+def join_literals(data):
+    """imaplib's untagged data with each literal, a (line, literal) tuple, joined back to the rest of its line."""
+    joined, pending = [], b''
+    for item in data or []:
+        if isinstance(item, tuple):
+            pending += item[0] + b'\r\n' + item[1]
+        elif pending:
+            joined.append(pending + (item or b''))
+            pending = b''
+        else:
+            joined.append(item)
+    return joined
+
+def quote_mailbox(name):
+    if name.startswith('"'):
+        return name
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def parse_status(line):
+    """Parse the data of a STATUS response into (mailbox, {item: value}), None when it doesn't look like one."""
+    if isinstance(line, str):
+        line = line.encode('utf-8')
+    literal = STATUS_LITERAL_RE.match(line)
+    if literal:
+        end = literal.end() + int(literal.group(1))
+        name, match = line[literal.end():end], STATUS_ITEMS_RE.match(line, end)
+        if not match:
+            return None
+        items = match.group(1).split()
+    else:
+        match = STATUS_RE.search(line)
+        if not match:
+            return None
+        if match.group(1) is not None:
+            name = re.sub(rb'\\(.)', rb'\1', match.group(1))
+        else:
+            name = match.group(2)
+        items = match.group(3).split()
+    return name.decode('utf-8', 'replace'), {items[i].decode().upper(): int(items[i + 1]) for i in range(0, len(items) - 1, 2)}
+
+# imaplib only accepts the commands it knows about
+imaplib.Commands.setdefault('NOTIFY', ('AUTH', 'SELECTED'))
+
+class AccountIMAPHandler(IMAPHandler):
+    """Watch every folder of an account over a single connection.
+
+    When the server supports NOTIFY (RFC 5465) it reports new email in every folder while we IDLE on one
+    of them. Otherwise we IDLE on the busiest folder and, every status_interval seconds, check the others
+    with pipelined STATUS commands. Folders with new email are then selected and processed in turn.
+    """
+    def __init__(self, host, email_user, email_pass, folders, notifier=None, status_interval=60, port=993, use_ssl=True):
+        super().__init__(host, email_user, email_pass, folders[0], notifier, port, use_ssl)
+        self.folders = list(folders)
+        # The IDLE folder is chosen at every connection
+        self.connection_name = '*'
+        self.status_interval = status_interval
+        self.notify = False
+        self.uidnexts = {}
+        self.dirty = set()
+
+    def connect(self):
+        try:
+            self.mail = self.open_connection()
+            self.mail.login(self.email_user, self.email_pass)
+            self.mail._get_capabilities()
+            self.resync = enable_resync(self.mail)
+            self.uidnexts = {}
+            # Catch up on the folders that received email since we last looked at them
+            for folder, codes in self.check_status(self.folders).items():
+                state = get_database().get_folder_state(self.email_user, folder)
+                if state is None or state[0] != codes.get('UIDVALIDITY') or state[1] < codes.get('UIDNEXT', 1) - 1:
+                    self.dirty.add(folder)
+            # IDLE where most email arrives; the highest UIDNEXT is the best hint we have
+            self.folder = max(self.folders, key=lambda folder: self.uidnexts.get(folder, 0))
+            self.select_idle_folder()
+            self.notify = 'NOTIFY' in self.mail.capabilities and self.set_notify()
+            self.idle_timeout = None if self.notify or len(self.folders) == 1 else self.status_interval
+            logging.info(f"[{self.email_user}] Watching {len(self.folders)} folder(s) from {self.folder} "
+                         f"{'with NOTIFY' if self.notify else f'with STATUS checks every {self.status_interval}s'}")
+            if self.dirty:
+                self.process_emails()
+            self.pending_resync = None
+        except imaplib.IMAP4.error as e:
+            # The monitor notifies the first failure of an outage, not every reconnection attempt
+            logging.error(f"Cannot connect: {str(e)}")
+            raise
+
+    def set_notify(self):
+        others = [quote_mailbox(folder) for folder in self.folders if folder != self.folder]
+        try:
+            typ, _ = self.mail._simple_command('NOTIFY', 'SET', '(SELECTED (MessageNew MessageExpunge))',
+                                               f"(MAILBOXES ({' '.join(others)}) (MessageNew MessageExpunge))")
+        except imaplib.IMAP4.error as e:
+            logging.warning(f"[{self.email_user}] NOTIFY rejected, falling back to STATUS checks: {str(e)}")
+            return False
+        return typ == 'OK'
+
+    def check_status(self, folders):
+        """Send one STATUS per folder without waiting for the answers, then collect them all."""
+        tags = [self.mail._command('STATUS', quote_mailbox(folder), '(UIDNEXT UIDVALIDITY)') for folder in folders]
+        for tag in tags:
+            self.mail._command_complete('STATUS', tag)
+        _, data = self.mail.response('STATUS')
+        return self.record_status(data)
+
+    def record_status(self, data):
+        """Remember the UIDNEXT of each folder in STATUS responses, marking the folders that changed."""
+        by_name = {folder.strip('"').lower(): folder for folder in self.folders}
+        result = {}
+        for line in join_literals(data):
+            parsed = parse_status(line) if line else None
+            folder = by_name.get(parsed[0].lower()) if parsed else None
+            if folder is None:
+                continue
+            codes = result[folder] = parsed[1]
+            uidnext = codes.get('UIDNEXT')
+            if folder in self.uidnexts and uidnext is not None and uidnext != self.uidnexts[folder]:
+                self.dirty.add(folder)
+                self.mark_detected()
+            if uidnext is not None:
+                self.uidnexts[folder] = uidnext
+        return result
+
+    def collect_status(self):
+        """Record the STATUS responses imaplib kept, e.g. sent by NOTIFY while processing: a SELECT discards them."""
+        _, data = self.mail.response('STATUS')
+        return self.record_status(data)
+
+    def announced(self):
+        # Folders NOTIFY reported while the last pass was busy with others
+        news = super().announced()
+        self.collect_status()
+        return news or bool(self.dirty)
+
+    def check_connection(self):
+        # The STATUS checks, or a NOOP with NOTIFY or a single folder, double as the connection probe
+        with self.probe():
+            if self.notify or len(self.folders) == 1:
+                self.mail.noop()
+            else:
+                self.check_status([folder for folder in self.folders if folder != self.folder])
+        if self.announced():
+            # Published like the passes that follow an IDLE with news
+            self.set_state('processing')
+            try:
+                self.process_emails()
+            finally:
+                self.set_state('idle')
+
+    def handle_idle_line(self, line):
+        if line and self.notify and b' STATUS ' in line:
+            # With the mailbox name as a literal, read_response() left it in the line after {size} CRLF
+            self.record_status([line.split(b' STATUS ', 1)[1]])
+            return bool(self.dirty)
+        if super().handle_idle_line(line):
+            self.dirty.add(self.folder)
+            return True
+        return False
+
+    def process_emails(self):
+        start = time.monotonic()
+        try:
+            if not self.notify and len(self.folders) > 1:
+                self.check_status([folder for folder in self.folders if folder != self.folder])
+            else:
+                # NOTIFY responses that arrived while we were not idling
+                self.collect_status()
+            selected = self.folder
+            detected_at, self.detected_at = self.detected_at, None
+            # The IDLE folder last, so it stays selected afterwards
+            for folder in sorted(self.dirty, key=lambda folder: folder == self.folder):
+                self.dirty.discard(folder)
+                folder_start = time.monotonic()
+                if folder != selected:
+                    state = get_database().get_folder_state(self.email_user, folder)
+                    self.collect_status()
+                    uidvalidity, uidnext, highestmodseq, changed = select_folder(self.mail, folder, state, self.resync)
+                    if not self.resync:
+                        highestmodseq = None
+                    selected = folder
+                else:
+                    uidvalidity, uidnext = self.uidvalidity, self.uidnext
+                    highestmodseq, changed = self.take_pending_resync()
+                EmailProcessor(self.mail, self.email_user, self.notifier, folder, uidvalidity, uidnext,
+                               highestmodseq=highestmodseq, changed=changed, detected_at=detected_at, rules=self.rules).process()
+                ACCOUNT_PROCESSING_TIME.labels(account=self.email_user, folder=folder).observe(time.monotonic() - folder_start)
+            if selected != self.folder:
+                self.select_idle_folder()
+        finally:
+            # A HIGHESTMODSEQ is only meaningful for the pass right after its SELECT
+            self.pending_resync = None
+            self.last_processing_seconds = round(time.monotonic() - start, 3)
+
+    def select_idle_folder(self):
+        state = get_database().get_folder_state(self.email_user, self.folder)
+        self.collect_status()
+        self.uidvalidity, self.uidnext, highestmodseq, changed = select_folder(self.mail, self.folder, state, self.resync)
+        self.pending_resync = (highestmodseq if self.resync else None, changed)
+        # Email that arrived here while another folder was selected is reported neither by NOTIFY, which
+        # leaves the IDLE folder out of MAILBOXES, nor by the STATUS checks, nor by IDLE: the SELECT counted it
+        moved = state is not None and self.uidnext is not None and (state[0] != self.uidvalidity or state[1] < self.uidnext - 1)
+        if moved and self.folder not in self.dirty:
+            self.dirty.add(self.folder)
+            self.mark_detected()
+
+# Values of the state label of imap_connection_state
+CONNECTION_STATES = ('connecting', 'idle', 'processing', 'reconnecting')
+
+# Errors that mean the connection is gone, as opposed to a bug or a server refusing a command
+CONNECTION_ERRORS = (ConnectionAbortedError, imaplib.IMAP4.abort, OSError, EOFError)
 
 class MultiIMAPHandler:
-    def __init__(self, accounts):
+    def __init__(self, accounts, notifiers=None):
         self.accounts = accounts
-        self.handlers = [IMAPHandler(account['Host'], account['EmailUser'], account['EmailPass'], account['Folder'], account['Notifier']) for account in accounts]
-        self.lock = Lock()
+        # The notifiers of build_accounts(), reused by reloads for the provider sections that didn't change
+        self.notifiers = notifiers or {}
+        self.reconnect_base = config.getfloat('GENERAL', 'ReconnectBase', fallback=5)
+        self.reconnect_max = config.getfloat('GENERAL', 'ReconnectMax', fallback=300)
+        self.handlers = [self.create_handler(account) for account in accounts]
+
+    def create_handler(self, account):
+        if 'Folders' in account:
+            handler = AccountIMAPHandler(account['Host'], account['EmailUser'], account['EmailPass'], account['Folders'],
+                                         account['Notifier'], account['StatusInterval'], **account.get('Connection', {}))
+        else:
+            handler = IMAPHandler(account['Host'], account['EmailUser'], account['EmailPass'], account['Folder'], account['Notifier'],
+                                  **account.get('Connection', {}))
+        handler.key = account.get('Key')
+        handler.signature = account.get('Signature')
+        handler.rules = account.get('Rules')
+        # Listed in /status from the start, not only once its monitor reports a state
+        status_board.update(handler.email_user, handler.connection_name, handler_status(handler))
+        return handler
 
     def run(self):
-        threads = []
         for handler in self.handlers:
-            thread = threading.Thread(target=self.monitor_account, args=(handler,), name=handler.email_user)
-            thread.daemon = True
-            threads.append(thread)
-            thread.start()
-        for thread in threads:
-            thread.join()
-
-    def monitor_account(self, handler):
+            self.start_monitor(handler)
+        # SIGHUP only raises reload_requested: the reload runs here, outside of the signal handler
+        while not shutdown_event.is_set():
+            if reload_requested.wait(1):
+                reload_requested.clear()
+                self.reload()
+
+    def start_monitor(self, handler, delay=0):
+        thread = threading.Thread(target=self.monitor_account, args=(handler, delay), name=handler.email_user)
+        thread.daemon = True
+        thread.start()
+
+    def stop_monitor(self, handler):
+        """Make the monitor of a handler exit, interrupting its IDLE or whatever command it's waiting for."""
+        handler.stopping.set()
+        mail = handler.mail
+        if mail is not None:
+            try:
+                mail.sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+
+    def running(self, handler):
+        return not (shutdown_event.is_set() or handler.stopping.is_set())
+
+    def monitor_account(self, handler, delay=0):
+        # Connections added by a reload don't all connect at once, see apply_reload
+        if delay:
+            handler.stopping.wait(delay)
         logging.info(f"Monitoring {handler.email_user} - Folder: {handler.folder}")
-        while True:
+        failures = 0
+        while self.running(handler):
             try:
+                handler.set_state('connecting')
                 handler.connect()
-                while True:
-                    handler.idle()
-                    with self.lock:
+                self.connected(handler, failures)
+                failures = 0
+                while self.running(handler):
+                    if handler.idle():
+                        handler.set_state('processing')
                         handler.process_emails()
-            except ConnectionAbortedError as e:
-                logging.error(str(e))
-                time.sleep(30)
+                        handler.set_state('idle')
+                    else:
+                        handler.check_connection()
             except Exception as e:
-                logging.error(f"An unexpected error occurred: {str(e)}")
-                ERRORS.inc()
-                if handler.notifier:
-                    handler.notifier.send_notification("Script Error", f"An unexpected error occurred: {str(e)}")
-                break
+                if not self.running(handler):
+                    break
+                failures += 1
+                delay = self.connection_lost(handler, e, failures)
+                if failures == 1 and handler.notifier and not isinstance(e, CONNECTION_ERRORS):
+                    handler.notifier.send_notification("Script Error", f"An unexpected error occurred: {str(e)}", handler.email_user)
+                handler.stopping.wait(delay)
+        self.stopped(handler)
+
+    def stopped(self, handler):
+        """Called when the monitor of a handler exits."""
+        if shutdown_event.is_set():
+            # The shutdown handler logs out every connection
+            handler.set_state(None)
+            return
+        # Removed by a reload while the other connections go on
+        handler.close()
+        if not any((other.email_user, other.connection_name) == (handler.email_user, handler.connection_name) for other in self.handlers):
+            handler.set_state(None)
+            status_board.remove(handler.email_user, handler.connection_name)
+        logging.info(f"[{handler.email_user} - {handler.folder}] Stopped monitoring")
+
+    def connected(self, handler, failures):
+        if failures:
+            recovery = time.monotonic() - handler.lost_at
+            handler.reconnects += 1
+            RECONNECTS.labels(account=handler.email_user, folder=handler.connection_name).inc()
+            RECOVERY_TIME.labels(account=handler.email_user, folder=handler.connection_name).observe(recovery)
+            logging.info(f"[{handler.email_user} - {handler.folder}] Reconnected after {recovery:.1f}s ({failures} attempt(s))")
+        handler.set_state('idle')
+
+    def connection_lost(self, handler, error, failures):
+        """Log the failure, drop the connection and return how long to wait before reconnecting."""
+        if failures == 1:
+            handler.lost_at = time.monotonic()
+        if isinstance(error, CONNECTION_ERRORS):
+            logging.error(f"[{handler.email_user} - {handler.folder}] Connection lost: {str(error)}")
+            reason = 'connection'
+        else:
+            logging.error(f"An unexpected error occurred: {str(error)}")
+            ERRORS.inc()
+            reason = 'error'
+        CONNECTION_FAILURES.labels(account=handler.email_user, folder=handler.connection_name, reason=reason).inc()
+        handler.close()
+        handler.set_state('reconnecting')
+        delay = backoff_delay(failures, self.reconnect_base, self.reconnect_max)
+        logging.info(f"[{handler.email_user} - {handler.folder}] Reconnecting in {delay:.1f}s (attempt {failures})")
+        return delay
+
+    def request_reload(self):
+        reload_requested.set()
+
+    def reload(self):
+        accounts = self.prepare_reload()
+        if accounts is not None:
+            self.apply_reload(*accounts)
+
+    def prepare_reload(self):
+        """Read the configuration file again and return the accounts and notifiers it describes,
+        or None when it can't be used (the current configuration is then kept)."""
+        return reload_configuration(lambda: build_accounts(monitored_sections(), self.notifiers))
+
+    def apply_reload(self, accounts, notifiers):
+        """Move from the current connections to those of `accounts`.
+
+        Only the connections that are new, or whose settings changed, are opened, and only those that are
+        gone or changed are closed: the others stay in IDLE, at most with a new notifier. The new ones
+        connect one after the other, ReloadConnectRate per second, so a reload adding many mailboxes
+        doesn't log into every server at once.
+        """
+        current = {handler.key: handler for handler in self.handlers}
+        kept, started = [], []
+        for account in accounts:
+            handler = current.get(account['Key'])
+            if handler is not None and handler.signature == account['Signature']:
+                # The same Notifier object unless the provider sections it's built from changed
+                handler.notifier = account['Notifier']
+                handler.rules = account.get('Rules')
+                kept.append(handler)
+            else:
+                started.append(self.create_handler(account))
+        kept_ids = {id(handler) for handler in kept}
+        stopped = [handler for handler in self.handlers if id(handler) not in kept_ids]
+        rebuilt = [notifier for key, notifier in notifiers.items() if notifier is not None and self.notifiers.get(key) is not notifier]
+        self.accounts, self.notifiers = accounts, notifiers
+        self.handlers = kept + started
+        if dispatcher is not None:
+            for notifier in rebuilt:
+                dispatcher.register(notifier.providers)
+            dispatcher.accounts = owned_accounts(accounts)
+            register_unowned_providers()
+        for handler in stopped:
+            self.stop_monitor(handler)
+        rate = config.getfloat('GENERAL', 'ReloadConnectRate', fallback=5)
+        for position, handler in enumerate(started):
+            self.start_monitor(handler, (position + random.random()) / rate if rate > 0 else 0)
+        logging.info(f"Configuration applied: {len(started)} connection(s) started, {len(stopped)} stopped, "
+                     f"{len(kept)} unchanged, {len(rebuilt)} notifier(s) rebuilt")
+
+class AsyncMultiIMAPHandler(MultiIMAPHandler):
+    """Monitor every mailbox from a single asyncio event loop instead of one thread per folder.
+
+    The IMAP connections are the same imaplib ones used by the threaded engine, so EmailProcessor,
+    the database and the notifiers behave exactly the same. Only the IDLE wait is multiplexed on the
+    loop; connecting and processing (which block) run on a bounded thread pool.
+    """
+    def __init__(self, accounts, notifiers=None, workers=None):
+        super().__init__(accounts, notifiers)
+        self.workers = workers
+        self.executor = None
+        self.loop = None
+        # handler -> monitor task, and the event that wakes it from a reconnection delay when it's stopped
+        self.tasks = {}
+        self.stops = {}
+        self.reload_task = None
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='imap')
+        stop = asyncio.Event()
+        self.loop.add_reader(shutdown_sock_r, self.on_shutdown, stop)
+        for handler in self.handlers:
+            self.start_monitor(handler)
+        if reload_requested.is_set():
+            self.reload_soon()
+        try:
+            # Like the threaded engine, run until shutdown is requested
+            await stop.wait()
+        finally:
+            self.loop.remove_reader(shutdown_sock_r)
+            tasks = list(self.tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.executor.shutdown(wait=False)
+
+    def on_shutdown(self, stop):
+        try:
+            shutdown_sock_r.recv(1024)
+        except BlockingIOError:
+            return
+        stop.set()
+
+    def start_monitor(self, handler, delay=0):
+        self.stops[handler] = asyncio.Event()
+        self.tasks[handler] = asyncio.create_task(self.monitor_account_async(handler, delay))
+
+    def stop_monitor(self, handler):
+        super().stop_monitor(handler)
+        if handler in self.stops:
+            self.stops[handler].set()
+
+    def stopped(self, handler):
+        super().stopped(handler)
+        self.tasks.pop(handler, None)
+        self.stops.pop(handler, None)
+
+    def request_reload(self):
+        # Called by the signal handler: the reload itself runs as a task of the loop
+        reload_requested.set()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.reload_soon)
+
+    def reload_soon(self):
+        if self.reload_task is None or self.reload_task.done():
+            self.reload_task = asyncio.create_task(self.reload_async())
+
+    async def reload_async(self):
+        while reload_requested.is_set():
+            reload_requested.clear()
+            # Reading the file and building the providers may block, applying the result must happen on the loop
+            accounts = await self.loop.run_in_executor(self.executor, self.prepare_reload)
+            if accounts is not None:
+                self.apply_reload(*accounts)
+
+    async def pause(self, handler, delay):
+        """Sleep for `delay` seconds, or until the monitor of the handler is stopped."""
+        try:
+            await asyncio.wait_for(self.stops[handler].wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def call(self, handler, func, *args):
+        """Run a blocking call on the pool, logging under the account name like the threaded engine."""
+        def named_call():
+            thread = threading.current_thread()
+            # Only for this call: other work runs on the same pool threads
+            previous, thread.name = thread.name, handler.email_user
+            try:
+                return func(*args)
+            finally:
+                thread.name = previous
+        return await asyncio.get_running_loop().run_in_executor(self.executor, named_call)
+
+    async def wait_readable(self, handler):
+        # Data already buffered by imaplib or decrypted by the SSL layer won't make the socket readable again
+        if handler.input_pending():
+            return
+        sock = handler.mail.sock
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_reader(sock, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            loop.remove_reader(sock)
+
+    async def idle_async(self, handler):
+        """Same contract as IMAPHandler.idle: True on new email, False when IDLE must be refreshed."""
+        if handler.announced():
+            return True
+        logging.info(f"[{handler.email_user} - {handler.folder}] IDLE mode started. Waiting for new email...")
+        try:
+            handler.start_idle()
+            deadline = time.monotonic() + handler.idle_wait()
+            news = False
+            while not news:
+                try:
+                    await asyncio.wait_for(self.wait_readable(handler), max(0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    break
+                if handler.line_buffered():
+                    # A whole line is buffered: reading it doesn't wait for the network
+                    line = handler.mail.readline()
+                else:
+                    # Only part of a line (or of a TLS record, or a literal) arrived, the rest may take up to the socket timeout
+                    line = await self.call(handler, handler.read_response)
+                news = handler.handle_idle_line(line)
+            # Waiting for the server to confirm DONE may take up to ProbeTimeout, keep it off the loop
+            return await self.call(handler, handler.stop_idle) or news
+        finally:
+            logging.info(f"[{handler.email_user}] IDLE mode stopped.")
+            handler.checked()
+
+    async def monitor_account_async(self, handler, delay=0):
+        try:
+            # Connections added by a reload don't all connect at once, see apply_reload
+            if delay:
+                await self.pause(handler, delay)
+            logging.info(f"Monitoring {handler.email_user} - Folder: {handler.folder}")
+            failures = 0
+            while self.running(handler):
+                try:
+                    handler.set_state('connecting')
+                    await self.call(handler, handler.connect)
+                    self.connected(handler, failures)
+                    failures = 0
+                    while self.running(handler):
+                        if await self.idle_async(handler):
+                            handler.set_state('processing')
+                            await self.call(handler, handler.process_emails)
+                            handler.set_state('idle')
+                        else:
+                            await self.call(handler, handler.check_connection)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if not self.running(handler):
+                        break
+                    failures += 1
+                    delay = self.connection_lost(handler, e, failures)
+                    if failures == 1 and handler.notifier and not isinstance(e, CONNECTION_ERRORS):
+                        await self.call(handler, handler.notifier.send_notification, "Script Error", f"An unexpected error occurred: {str(e)}",
+                                        handler.email_user)
+                    await self.pause(handler, delay)
+        finally:
+            self.stopped(handler)
+
+# Seconds between two status reports of a worker process
+STATUS_INTERVAL = 5
+
+def shard_sections(sections, index, count):
+    """The EMAIL sections monitored by worker `index` out of `count`: a round robin over the sorted names."""
+    return [section for position, section in enumerate(sorted(sections)) if position % count == index]
+
+def assigned_sections(sections, index, count):
+    """The share of worker `index` in the assignment written by the supervisor (see Supervisor.assign), which
+    keeps every section on the same worker across reloads. Without it, shard_sections."""
+    try:
+        with open(os.path.join(runtime_dir, 'sections.json')) as f:
+            assignment = json.load(f)
+    except (TypeError, OSError, ValueError):
+        return shard_sections(sections, index, count)
+    return [section for section in sorted(sections) if assignment.get(section) == index]
+
+class StatusReporter(threading.Thread):
+    """In a worker process, publish the status of its mailboxes for the supervisor and exit if the supervisor dies."""
+    def __init__(self, index, interval=STATUS_INTERVAL):
+        super().__init__(name='status', daemon=True)
+        self.index = index
+        self.interval = interval
+        self.path = os.path.join(runtime_dir, f'worker-{index}.json')
+        self.supervisor = os.getppid()
+
+    def run(self):
+        while True:
+            if os.getppid() != self.supervisor:
+                logging.error("The supervisor is gone, shutting down")
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            try:
+                self.write()
+            except Exception as e:
+                logging.error(f"Failed to write the worker status: {str(e)}")
+            if shutdown_event.wait(self.interval):
+                return
+
+    def write(self):
+        report = {'worker': self.index, 'pid': os.getpid(), 'time': time.time(),
+                  'accounts': status_board.snapshot()}
+        # Write then rename, so the supervisor never reads half a file
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(report, f)
+        os.replace(self.path + '.tmp', self.path)
+
+class EventForwarder(threading.Thread):
+    """In a worker process, pass the events of its EventBus on to the supervisor, which serves /events."""
+    def __init__(self, fd):
+        super().__init__(name='events', daemon=True)
+        self.stream = os.fdopen(fd, 'w')
+        # Subscribed right away, so the first connection states aren't missed
+        self.subscription = event_bus.subscribe()
+
+    def run(self):
+        while True:
+            events, dropped = self.subscription.get(STATUS_INTERVAL)
+            if dropped:
+                logging.warning(f"The supervisor is not keeping up, {dropped} event(s) dropped")
+            try:
+                for event in events:
+                    self.stream.write(json.dumps(event) + '\n')
+                self.stream.flush()
+            except (OSError, ValueError):
+                # The supervisor is gone; the StatusReporter shuts the worker down
+                self.subscription.close()
+                return
+
+class Supervisor:
+    """Share the EMAIL sections among worker processes and keep them running.
+
+    Each worker is this script started again with --worker index/count, monitoring its share of the
+    sections (see assign). The supervisor restarts crashed workers with a growing delay, forwards
+    SIGTERM and SIGHUP, and serves /status and /metrics for all of them from the files the workers write
+    in runtime_dir, and /events from the events they send through a pipe. The workers share the SQLite database in WAL mode but never write the same rows:
+    each one owns its accounts and their outbox entries, and only worker 0 runs the retention.
+    """
+    def __init__(self, count):
+        self.count = count
+        self.processes = {}
+        self.started = {}
+        self.crashes = {}
+        self.restart_at = {}
+        self.metrics_dir = os.path.join(runtime_dir, 'metrics')
+        self.stopping = threading.Event()
+        # EMAIL section -> index of the worker monitoring it
+        self.assignment = {}
+
+    def assign(self, sections):
+        """Share the EMAIL sections among the workers, in runtime_dir/sections.json.
+
+        At startup this is a round robin over the sorted names. On reload the sections keep their worker, and
+        new ones go to the workers with fewest sections: adding a mailbox must not move the others around.
+        """
+        assignment = {section: index for section, index in self.assignment.items() if section in sections}
+        for section in sorted(sections):
+            if section not in assignment:
+                loads = [0] * self.count
+                for index in assignment.values():
+                    loads[index] += 1
+                assignment[section] = loads.index(min(loads))
+        self.assignment = assignment
+        path = os.path.join(runtime_dir, 'sections.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(assignment, f)
+        os.replace(path + '.tmp', path)
+
+    def spawn(self, index):
+        env = dict(os.environ, NOTIMAIL_RUNTIME_DIR=runtime_dir)
+        if os.path.isdir(self.metrics_dir):
+            env['PROMETHEUS_MULTIPROC_DIR'] = self.metrics_dir
+        command = [sys.executable, os.path.abspath(__file__), '-c', args.config, '--worker', f'{index}/{self.count}']
+        read_fd, write_fd = os.pipe()
+        env['NOTIMAIL_EVENTS_FD'] = str(write_fd)
+        try:
+            process = subprocess.Popen(command, env=env, pass_fds=(write_fd,))
+        finally:
+            os.close(write_fd)
+        threading.Thread(target=self.forward_events, args=(index, os.fdopen(read_fd)), name=f'events-{index}', daemon=True).start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+        logging.info(f"Started worker {index} (pid {process.pid})")
+
+    def forward_events(self, index, stream):
+        """Publish the events of a worker until it exits."""
+        with stream:
+            for line in stream:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                event['worker'] = index
+                event_bus.publish_event(event)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        logging.info(f"Supervisor started with {self.count} worker process(es). Press Ctrl+C to stop it at any time.")
+        self.assign(monitored_sections())
+        for index in range(self.count):
+            self.spawn(index)
+        if flask_available and app:
+            threading.Thread(target=run_flask_app, daemon=True).start()
+        while not self.stopping.is_set():
+            self.check_workers()
+            self.rotate_log()
+            self.stopping.wait(1)
+        self.shutdown()
+
+    def rotate_log(self):
+        # The workers only append to the log file (and reopen it once rotated), so the supervisor rotates it
+        handler.acquire()
+        try:
+            if handler.shouldRollover(logging.makeLogRecord({'msg': ''})):
+                handler.doRollover()
+        finally:
+            handler.release()
+
+    def check_workers(self):
+        for index, process in list(self.processes.items()):
+            if process is None:
+                if time.monotonic() >= self.restart_at[index]:
+                    self.spawn(index)
+            elif process.poll() is not None:
+                self.worker_exited(index, process)
+
+    def worker_exited(self, index, process):
+        if os.path.isdir(self.metrics_dir):
+            from prometheus_client import multiprocess
+            multiprocess.mark_process_dead(process.pid, self.metrics_dir)
+        # A worker that ran for a while before failing starts a new series of restarts
+        if time.monotonic() - self.started[index] > 60:
+            self.crashes[index] = 0
+        self.crashes[index] = self.crashes.get(index, 0) + 1
+        delay = backoff_delay(self.crashes[index], 1, 60)
+        logging.error(f"Worker {index} (pid {process.pid}) exited with code {process.returncode}, restarting it in {delay:.1f}s")
+        ERRORS.inc()
+        self.processes[index] = None
+        self.restart_at[index] = time.monotonic() + delay
+
+    def signal_workers(self, signum):
+        for process in self.processes.values():
+            if process is not None and process.poll() is None:
+                try:
+                    process.send_signal(signum)
+                except OSError:
+                    pass
+
+    def stop(self, signum, frame):
+        if not self.stopping.is_set():
+            logging.info("Shutdown signal received. Stopping the workers...")
+            self.stopping.set()
+
+    def reload(self, signum, frame):
+        logging.info("Received SIGHUP signal. Reloading configuration and forwarding it to the workers...")
+        if reload_configuration():
+            self.assign(monitored_sections())
+            self.signal_workers(signal.SIGHUP)
+
+    def shutdown(self, timeout=30):
+        self.signal_workers(signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        for index, process in self.processes.items():
+            if process is None:
+                continue
+            try:
+                process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logging.warning(f"Worker {index} did not stop in {timeout}s, killing it")
+                process.kill()
+                process.wait()
+        shutil.rmtree(runtime_dir, ignore_errors=True)
+        logging.info("Cleanup complete. Exiting.")
+
+# The engine, set by multi_account_main
+multi_handler = None
+shutting_down = False
 
 def shutdown_handler(signum, frame):
+    global shutting_down
+    # A second SIGTERM (e.g. sent to the whole process group) must not interrupt the cleanup in progress
+    if shutting_down:
+        return
+    shutting_down = True
     logging.info("Shutdown signal received. Cleaning up...")
     try:
         # Inviamo un byte attraverso la socket pair per sbloccare la select
+        shutdown_event.set()
         shutdown_sock_w.send(b'\x00')
         for handler in multi_handler.handlers:
+            handler.stopping.set()
             if handler.mail is not None:
                 # Forziamo la chiusura del socket IMAP per interrompere eventuali operazioni bloccanti
                 try:
@@ -536,28 +3366,76 @@ def shutdown_handler(signum, frame):
                 handler.mail.logout()
     except Exception as e:
         logging.error(f"Error during logout: {str(e)}")
+    if dispatcher is not None:
+        logging.info("Delivering queued notifications...")
+        dispatcher.stop()
     logging.info("Cleanup complete. Exiting.")
     sys.exit(0)
 
 def reload_config_handler(signum, frame):
     logging.info("Received SIGHUP signal. Reloading configuration...")
-    reload_configuration()
+    # The engine applies it from its own thread (or as soon as it starts), not inside the signal handler
+    if multi_handler is not None:
+        multi_handler.request_reload()
+    else:
+        reload_requested.set()
+
+def reload_configuration(prepare=None):
+    """Replace the configuration with a fresh read of the file, so removed sections and options go away too.
 
-def reload_configuration():
+    `prepare` is called with the new configuration in place and may reject it by raising ValueError. Return
+    what it returns (True without it), or None when the file can't be used and the current configuration is kept.
+    Whatever fails while reading or preparing it, the running configuration stays in place.
+    """
     global config
-    config.read(args.config)
+    previous = config
+    try:
+        # Read aside: the other threads keep using the current configuration meanwhile
+        new_config = configparser.ConfigParser()
+        if not new_config.read(args.config):
+            raise ValueError(f"cannot read {args.config}")
+        validate_config(new_config)
+        config = new_config
+        result = prepare() if prepare else True
+    except (configparser.Error, ValueError) as e:
+        config = previous
+        logging.error(f"Configuration not reloaded, keeping the current one: {str(e)}")
+        return None
+    except Exception as e:
+        config = previous
+        logging.exception(f"Configuration not reloaded, keeping the current one: unexpected {type(e).__name__}: {str(e)}")
+        return None
     logging.info("Configuration reloaded.")
-    # Implement logic to update handlers and notifiers if necessary
+    return result
+
+def configure_delivery(provider, section):
+    """Apply the coalescing and rate limiting options of a provider section."""
+    options = config[section]
+    provider.key = f"{provider.name}:{section}"
+    provider.coalesce_window = options.getfloat('CoalesceWindow', fallback=0)
+    provider.coalesce_threshold = options.getint('CoalesceThreshold', fallback=3)
+    rate_limit = options.getfloat('RateLimit', fallback=0)
+    if rate_limit > 0:
+        provider.rate_limiter = TokenBucket(rate_limit, options.getint('RateBurst', fallback=max(1, int(rate_limit // 6))))
+    return provider
+
+PROVIDER_SECTIONS = ('NTFY', 'PUSHOVER', 'GOTIFY', 'APPRISE')
+
+def provider_sections(account_name=None):
+    """The notification provider sections of an account ("GOTIFY:name"), or the global ones without it."""
+    if account_name:
+        # Only include sections specific to this account
+        return [section for section in config.sections() if section.startswith(PROVIDER_SECTIONS) and section.endswith(f":{account_name}")]
+    # Exclude account-specific sections
+    return [section for section in config.sections() if section.startswith(PROVIDER_SECTIONS) and ':' not in section]
+
+def provider_signature(account_name=None):
+    """The content of the provider sections of an account (or the global ones): equal signatures, equal providers."""
+    return (account_name, tuple((section, tuple(config[section].items())) for section in provider_sections(account_name)))
 
 def parse_notification_providers(account_name=None):
     providers = []
-    # Determine which sections to read based on account_name
-    if account_name:
-        # Only include sections specific to this account
-        sections_to_check = [section for section in config.sections() if section.endswith(f":{account_name}")]
-    else:
-        # Exclude account-specific sections
-        sections_to_check = [section for section in config.sections() if ':' not in section]
+    sections_to_check = provider_sections(account_name)
 
     # NTFY providers
     ntfy_sections = [s for s in sections_to_check if s.startswith('NTFY')]
@@ -571,7 +3449,7 @@ def parse_notification_providers(account_name=None):
                 token = config[section].get(token_key, None)
                 ntfy_data.append((url, token))
     if ntfy_data:
-        providers.append(NTFYNotificationProvider(ntfy_data))
+        providers.append(configure_delivery(NTFYNotificationProvider(ntfy_data), ntfy_sections[0]))
 
     # Pushover provider
     pushover_sections = [s for s in sections_to_check if s.startswith('PUSHOVER')]
@@ -579,7 +3457,8 @@ def parse_notification_providers(account_name=None):
         if 'ApiToken' in config[section] and 'UserKey' in config[section]:
             api_token = config[section]['ApiToken']
             user_key = config[section]['UserKey']
-            providers.append(PushoverNotificationProvider(api_token, user_key))
+            pushover_url = config[section].get('Url', 'https://api.pushover.net/1/messages.json')
+            providers.append(configure_delivery(PushoverNotificationProvider(api_token, user_key, pushover_url), section))
             break
 
     # Gotify provider
@@ -588,7 +3467,7 @@ def parse_notification_providers(account_name=None):
         if 'Url' in config[section] and 'Token' in config[section]:
             gotify_url = config[section]['Url']
             gotify_token = config[section]['Token']
-            providers.append(GotifyNotificationProvider(gotify_url, gotify_token))
+            providers.append(configure_delivery(GotifyNotificationProvider(gotify_url, gotify_token), section))
             break
 
     # Apprise providers (only if apprise is available)
@@ -597,45 +3476,160 @@ def parse_notification_providers(account_name=None):
         for section in apprise_sections:
             if 'urls' in config[section]:
                 apprise_urls = config[section]['urls'].split(',')
-                providers.append(AppriseNotificationProvider(apprise_urls))
+                providers.append(configure_delivery(AppriseNotificationProvider(apprise_urls), section))
                 break
 
     return providers
 
-def multi_account_main():
-    accounts = []
-    # Parse global notification providers
-    global_providers = parse_notification_providers()
-    if global_providers:
-        global_notifier = Notifier(global_providers)
-    else:
-        global_notifier = None
+def monitored_sections():
+    """The EMAIL sections monitored by this process: all of them, or the share of a worker."""
+    email_sections = [section for section in config.sections() if section.startswith("EMAIL:")]
+    if worker_index is not None:
+        return assigned_sections(email_sections, worker_index, worker_count)
+    return email_sections
+
+def build_accounts(email_sections, notifiers=None):
+    """The connections to open for `email_sections`, as MultiIMAPHandler accounts, and the notifiers they use.
+
+    Notifiers are keyed by provider_signature(): those already in `notifiers` (from an earlier call) are reused,
+    so a reload only rebuilds the ones whose provider sections changed. Each account also has a Key (its section
+    and folder) and a Signature (the settings of its connection), which tell a reload what changed, and the
+    RuleSet of the [RULE:name] sections that apply to it as Rules (shared by the accounts with the same rules).
+    Raises ValueError for an account without notification providers, with an invalid ConnectionMode, or for
+    an invalid rule or CatchUpPolicy.
+    """
+    catch_up_policy = config.get('GENERAL', 'CatchUpPolicy', fallback='notify').lower()
+    if catch_up_policy not in CATCH_UP_POLICIES:
+        raise ValueError(f"invalid CatchUpPolicy '{catch_up_policy}', use {', '.join(CATCH_UP_POLICIES)}.")
+    notifiers = notifiers or {}
+    used = {}
+    rules = compile_rules()
+    rule_sets = {}
+
+    def rules_for(account_name):
+        applicable = [rule for rule in rules if rule.applies_to(account_name)]
+        names = tuple(rule.name for rule in applicable)
+        if names not in rule_sets:
+            rule_sets[names] = RuleSet(applicable) if applicable else None
+        return rule_sets[names]
+
+    def notifier_for(account_name=None):
+        signature = provider_signature(account_name)
+        if signature not in used:
+            if signature in notifiers:
+                used[signature] = notifiers[signature]
+            else:
+                providers = parse_notification_providers(account_name)
+                used[signature] = Notifier(providers) if providers else None
+        return used[signature]
 
-    for section in config.sections():
+    accounts = []
+    for section in email_sections:
         if section.startswith("EMAIL:"):
             account_name = section.split(":", 1)[1]
-            folders = config[section].get('Folders', 'inbox').split(', ')
+            folders = list(dict.fromkeys(config[section].get('Folders', 'inbox').split(', ')))
+            # Account-specific notification providers are built once, so every folder shares their rate limits;
+            # otherwise the global ones are used
+            account_notifier = notifier_for(account_name) or notifier_for()
+            if account_notifier is None:
+                raise ValueError(f"No notification providers specified for account {section} and no global notification providers are available.")
+            connection_mode = config[section].get('ConnectionMode', config.get('GENERAL', 'ConnectionMode', fallback='folder')).lower()
+            if connection_mode not in ('folder', 'account'):
+                raise ValueError(f"invalid ConnectionMode '{connection_mode}' for {section}, use 'folder' or 'account'.")
+            connection = imap_connection_options(section)
+            account_rules = rules_for(account_name)
+            signature = (config[section]['Host'], config[section]['EmailUser'], config[section]['EmailPass'], tuple(sorted(connection.items())))
+            if connection_mode == 'account':
+                # A single connection watches every folder of the account
+                status_interval = config[section].getint('StatusInterval', fallback=config.getint('GENERAL', 'StatusInterval', fallback=60))
+                accounts.append({
+                    'EmailUser': config[section]['EmailUser'],
+                    'EmailPass': config[section]['EmailPass'],
+                    'Host': config[section]['Host'],
+                    'Connection': connection,
+                    'Folders': folders,
+                    'StatusInterval': status_interval,
+                    'Notifier': account_notifier,
+                    'Rules': account_rules,
+                    'Key': (section, None),
+                    'Signature': signature + (tuple(folders), status_interval)
+                })
+                continue
             for folder in folders:
                 account = {
                     'EmailUser': config[section]['EmailUser'],
                     'EmailPass': config[section]['EmailPass'],
                     'Host': config[section]['Host'],
+                    'Connection': connection,
                     'Folder': folder,
-                    'Notifier': None
+                    'Notifier': account_notifier,
+                    'Rules': account_rules,
+                    'Key': (section, folder),
+                    'Signature': signature
                 }
-                # Parse account-specific notification providers
-                account_providers = parse_notification_providers(account_name)
-                if account_providers:
-                    account['Notifier'] = Notifier(account_providers)
-                else:
-                    # Use global notifier if available
-                    if global_notifier:
-                        account['Notifier'] = global_notifier
-                    else:
-                        logging.error(f"No notification providers specified for account {section} and no global notification providers are available.")
-                        print(f"Error: No notification providers specified for account {section} and no global notification providers are available.")
-                        sys.exit(1)
                 accounts.append(account)
+    return accounts, used
+
+def owned_accounts(accounts):
+    """In a worker, the accounts whose outbox notifications it delivers: its own, and for worker 0 those of no account."""
+    if worker_index is None:
+        return None
+    return sorted({account['EmailUser'] for account in accounts}) + ([None] if worker_index == 0 else [])
+
+def register_unowned_providers():
+    """Worker 0 delivers the notifications of no account, queued through the providers of any worker:
+    register those of every account too, keeping the instances its own accounts already use."""
+    if worker_index != 0 or dispatcher is None:
+        return
+    providers = parse_notification_providers()
+    for section in config.sections():
+        if section.startswith("EMAIL:"):
+            providers += parse_notification_providers(section.split(":", 1)[1])
+    dispatcher.register([provider for provider in providers if provider.key not in dispatcher.providers])
+
+def multi_account_main():
+    if supervisor_mode:
+        email_sections = [section for section in config.sections() if section.startswith("EMAIL:")]
+        Supervisor(min(worker_count, len(email_sections))).run()
+        return
+    email_sections = monitored_sections()
+    if worker_index is not None:
+        logging.info(f"Worker {worker_index}/{worker_count} monitoring {', '.join(email_sections)}")
+
+    try:
+        accounts, notifiers = build_accounts(email_sections)
+    except ValueError as e:
+        logging.error(str(e))
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+
+    # Open the shared database (and warm its notified UID cache) before any mailbox wakes up
+    get_database()
+    if worker_index in (None, 0):
+        retention = RetentionScheduler(config.getint('GENERAL', 'RetentionDays', fallback=7),
+                                       config.getint('GENERAL', 'RetentionInterval', fallback=3600),
+                                       config.getint('GENERAL', 'RetentionChunkSize', fallback=1000))
+        retention.start()
+
+    global dispatcher
+    dispatcher = NotificationDispatcher(get_database(),
+                                        config.getint('GENERAL', 'DispatchWorkers', fallback=2),
+                                        config.getint('GENERAL', 'OutboxBatchSize', fallback=50),
+                                        config.getfloat('GENERAL', 'OutboxRetryBase', fallback=30),
+                                        config.getfloat('GENERAL', 'OutboxRetryMax', fallback=3600),
+                                        config.getint('GENERAL', 'OutboxMaxAttempts', fallback=0),
+                                        config.getfloat('GENERAL', 'OutboxLease', fallback=300),
+                                        accounts=owned_accounts(accounts))
+    for account in accounts:
+        dispatcher.register(account['Notifier'].providers)
+    register_unowned_providers()
+    dispatcher.start()
+
+    # Creiamo una socket pair per gestire lo shutdown
+    global shutdown_sock_r, shutdown_sock_w
+    shutdown_sock_r, shutdown_sock_w = socket.socketpair()
+    shutdown_sock_r.setblocking(0)
+    shutdown_sock_w.setblocking(0)
 
     # Set socket timeout
     socket.setdefaulttimeout(480)
@@ -648,7 +3642,9 @@ def multi_account_main():
     logging.info("Script started. Press Ctrl+C to stop it at any time.")
 
     # Start Flask app in a separate thread if available and configured
-    if flask_available and app:
+    if worker_index is not None:
+        logging.debug("The supervisor serves the web interface.")
+    elif flask_available and app:
         flask_thread = threading.Thread(target=run_flask_app)
         flask_thread.daemon = True
         flask_thread.start()
@@ -659,7 +3655,21 @@ def multi_account_main():
             logging.info("FlaskHost or FlaskPort not specified. Web interface will not be started.")
 
     global multi_handler
-    multi_handler = MultiIMAPHandler(accounts)
+    engine = config.get('GENERAL', 'Engine', fallback='threads').lower()
+    if engine == 'asyncio':
+        workers = config.getint('GENERAL', 'EngineWorkers', fallback=None)
+        multi_handler = AsyncMultiIMAPHandler(accounts, notifiers, workers)
+    elif engine == 'threads':
+        multi_handler = MultiIMAPHandler(accounts, notifiers)
+    else:
+        logging.error(f"Invalid Engine: {engine}")
+        print(f"Error: invalid Engine '{engine}', use 'threads' or 'asyncio'.")
+        sys.exit(1)
+    logging.info(f"Using the {engine} engine for {len(accounts)} mailbox(es)")
+    if worker_index is not None:
+        StatusReporter(worker_index).start()
+        if os.environ.get('NOTIMAIL_EVENTS_FD'):
+            EventForwarder(int(os.environ['NOTIMAIL_EVENTS_FD'])).start()
     multi_handler.run()
 
     logging.info("Logging out and closing connections...")
@@ -668,6 +3678,8 @@ def multi_account_main():
             handler.mail.logout()
     except:
         pass
+    if shared_database is not None:
+        shared_database.close()
 
 def print_config():
     for section in config.sections():
@@ -676,55 +3688,147 @@ def print_config():
             print(f"{key} = {value}")
         print()
 
-def test_config():
-    logging.info("Testing global notification providers...")
-    global_providers = parse_notification_providers()
-    if global_providers:
-        global_notifier = Notifier(global_providers)
-        try:
-            global_notifier.send_notification("Test Sender", "Test Notification from NotiMail")
-            logging.info("Test notification sent successfully via global notification providers!")
-        except Exception as e:
-            logging.error(f"Failed to send test notification via global providers. Reason: {str(e)}")
-    else:
-        logging.info("No global notification providers configured.")
+def elapsed_ms(start):
+    return round((time.monotonic() - start) * 1000, 1)
 
-    for section in config.sections():
-        if section.startswith("EMAIL:"):
-            account_name = section.split(":", 1)[1]
-            logging.info(f"Testing {section}...")
-            handler = IMAPHandler(config[section]['Host'], config[section]['EmailUser'], config[section]['EmailPass'])
+def check_account(section, with_list=False):
+    """Connect and log into an EMAIL section, timing each step, and count its folders."""
+    options = config[section]
+    result = {'section': section, 'host': options.get('Host'), 'ok': False, 'connect_ms': None, 'login_ms': None,
+              'list_ms': None, 'folders': None, 'error': None}
+    logging.info(f"Testing {section}...")
+    mail = None
+    try:
+        handler = IMAPHandler(options['Host'], options['EmailUser'], options['EmailPass'], **imap_connection_options(section))
+        start = time.monotonic()
+        mail = handler.open_connection()
+        result['connect_ms'] = elapsed_ms(start)
+        start = time.monotonic()
+        mail.login(options['EmailUser'], options['EmailPass'])
+        result['login_ms'] = elapsed_ms(start)
+        start = time.monotonic()
+        typ, folders = mail.list()
+        result['list_ms'] = elapsed_ms(start)
+        folders = [folder.decode() for folder in folders if folder]
+        result['folders'] = len(folders)
+        if with_list:
+            result['folder_list'] = folders
+        result['ok'] = typ == 'OK'
+        logging.info(f"Connection successful for {section}")
+    except Exception as e:
+        result['error'] = str(e)
+        logging.error(f"Connection failed for {section}. Reason: {str(e)}")
+    finally:
+        if mail is not None:
             try:
-                handler.connect()
-                logging.info(f"Connection successful for {section}")
-                handler.mail.logout()
-            except Exception as e:
-                logging.error(f"Connection failed for {section}. Reason: {str(e)}")
-            account_providers = parse_notification_providers(account_name)
-            if account_providers:
-                account_notifier = Notifier(account_providers)
-                try:
-                    account_notifier.send_notification("Test Sender", f"Test Notification from NotiMail - {section}")
-                    logging.info(f"Test notification sent successfully via account-specific providers for {section}!")
-                except Exception as e:
-                    logging.error(f"Failed to send test notification via account-specific providers for {section}. Reason: {str(e)}")
-            else:
-                logging.info(f"No account-specific notification providers configured for {section}.")
+                mail.logout()
+            except Exception:
+                pass
+    return result
+
+def check_provider(scope, provider, subject):
+    """Send a test notification through one provider, timing it and each of its HTTP requests."""
+    result = {'scope': scope, 'provider': provider.key, 'ok': False, 'ms': None, 'requests': [], 'error': None}
+    start = time.monotonic()
+    try:
+        with http_sessions.trace() as requests_made:
+            result['ok'] = provider.send_notification("Test Sender", subject) is not False
+        result['requests'] = requests_made
+    except Exception as e:
+        result['error'] = str(e)
+    result['ms'] = elapsed_ms(start)
+    if result['ok']:
+        logging.info(f"Test notification sent successfully via {provider.key} ({scope})!")
+    else:
+        logging.error(f"Failed to send test notification via {provider.key} ({scope}). Reason: {result['error'] or 'not delivered'}")
+    return result
+
+def run_checks(with_providers=True, with_list=False):
+    """Check every EMAIL section, and with_providers every notification provider, on a pool of args.jobs threads.
+
+    Return the report printed by print_report. The checks only wait on the network, so even a few hundred
+    accounts take about as long as the slowest ones rather than the sum of all of them.
+    """
+    # A server that never answers must not hold a check forever
+    socket.setdefaulttimeout(config.getfloat('GENERAL', 'ProbeTimeout', fallback=30))
+    sections = [section for section in config.sections() if section.startswith("EMAIL:")]
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs), thread_name_prefix='check') as pool:
+        provider_checks = []
+        if with_providers:
+            global_providers = parse_notification_providers()
+            if not global_providers:
+                logging.info("No global notification providers configured.")
+            provider_checks += [pool.submit(check_provider, 'global', provider, "Test Notification from NotiMail")
+                                for provider in global_providers]
+            for section in sections:
+                account_providers = parse_notification_providers(section.split(":", 1)[1])
+                provider_checks += [pool.submit(check_provider, section, provider, f"Test Notification from NotiMail - {section}")
+                                    for provider in account_providers]
+        account_checks = [pool.submit(check_account, section, with_list) for section in sections]
+        report = {
+            'accounts': [check.result() for check in account_checks],
+            'providers': [check.result() for check in provider_checks],
+        }
+    if with_providers:
+        try:
+            report['rules'] = {'count': len(compile_rules()), 'error': None}
+        except ValueError as e:
+            report['rules'] = {'count': None, 'error': str(e)}
+    report['jobs'] = args.jobs
+    report['duration_ms'] = elapsed_ms(start)
+    report['failures'] = sum(1 for result in report['accounts'] + report['providers'] if not result['ok'])
+    if report.get('rules', {}).get('error'):
+        report['failures'] += 1
+    return report
+
+def print_report(report):
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    def value(number):
+        return '-' if number is None else number
+    print(f"{'account':<30} {'connect ms':>10} {'login ms':>9} {'folders':>7}  result")
+    for result in report['accounts']:
+        print(f"{result['section']:<30} {value(result['connect_ms']):>10} {value(result['login_ms']):>9} {value(result['folders']):>7}  "
+              f"{'ok' if result['ok'] else 'FAILED: ' + str(result['error'])}")
+    if report['providers']:
+        print()
+        print(f"{'provider':<30} {'scope':<20} {'ms':>8}  result")
+        for result in report['providers']:
+            http = ', '.join(f"{request['status']} in {request['ms']} ms" for request in result['requests'])
+            print(f"{result['provider']:<30} {result['scope']:<20} {result['ms']:>8}  "
+                  f"{'ok' if result['ok'] else 'FAILED: ' + str(result['error'] or 'not delivered, see the log')}" + (f" (HTTP {http})" if http else ''))
+    if 'rules' in report:
+        print()
+        rules = report['rules']
+        print(f"rules: FAILED: {rules['error']}" if rules['error'] else f"rules: {rules['count']} rule(s) ok")
+    print()
+    print(f"{len(report['accounts'])} account(s), {len(report['providers'])} provider(s) checked in {report['duration_ms']} ms "
+          f"with {report['jobs']} job(s): {report['failures']} failure(s)")
+
+def test_config():
+    """--test-config: exit status 1 when a check failed."""
+    logging.info("Testing the accounts and notification providers...")
+    report = run_checks()
+    print_report(report)
     logging.info("Testing completed!")
+    return 1 if report['failures'] else 0
 
 def list_imap_folders():
-    for section in config.sections():
-        if section.startswith("EMAIL:"):
-            logging.info(f"Listing folders for {section}...")
-            handler = IMAPHandler(config[section]['Host'], config[section]['EmailUser'], config[section]['EmailPass'])
-            try:
-                handler.connect()
-                typ, folders = handler.mail.list()
-                for folder in folders:
-                    print(folder.decode())
-                handler.mail.logout()
-            except Exception as e:
-                logging.error(f"Failed to list folders for {section}. Reason: {str(e)}")
+    report = run_checks(with_providers=False, with_list=True)
+    if args.json:
+        print_report(report)
+    else:
+        for result in report['accounts']:
+            print(f"[{result['section']}]")
+            if result['ok']:
+                for folder in result['folder_list']:
+                    print(folder)
+            else:
+                print(f"Error: {result['error']}")
+            print()
+    return 1 if report['failures'] else 0
 
 def run_flask_app():
     app.run(host=flask_host, port=flask_port)
@@ -744,9 +3848,8 @@ def initial_checks():
     # Test database operations
     try:
         with DatabaseHandler() as db:
-            db.add_email("test", "test", 0)
-            db.cursor.execute("DELETE FROM processed_emails WHERE email_account=? AND uid=?", ("test", "test"))
-            db.connection.commit()
+            db.add_email("test", "test", "1", 1)
+            db.reset_folder("test", "test")
     except Exception as e:
         print("Error: unable to write to database:", e)
         logging.error("Error: unable to write to database: " + str(e))
@@ -767,13 +3870,33 @@ def initial_checks():
         sys.exit(1)
     logging.info("Initial tests completed successfully.")
 
-if __name__ == "__main__":
+def configure(argv=None):
+    """Parse the command line (sys.argv when `argv` is None), read the configuration and set up logging."""
+    global args, http_sessions
+    args = build_parser().parse_args(argv)
+    config.read(args.config)
+    validate_config(config)
+    setup_workers()
+    setup_logging()
+    event_bus.buffer_size = config.getint('GENERAL', 'EventBufferSize', fallback=1000)
+    http_sessions = HTTPSessions(config.getint('GENERAL', 'HTTPPoolSize', fallback=10),
+                                 (config.getfloat('GENERAL', 'HTTPConnectTimeout', fallback=5),
+                                  config.getfloat('GENERAL', 'HTTPReadTimeout', fallback=30)))
+
+def main(argv=None):
+    """Command line entry point. Importing NotiMail does nothing else than defining it."""
+    configure(argv)
     if args.print_config:
         print_config()
     elif args.test_config:
-        test_config()
+        return test_config()
     elif args.list_folders:
-        list_imap_folders()
+        return list_imap_folders()
     else:
-        initial_checks()
+        start_services()
+        if worker_index is None:
+            initial_checks()
         multi_account_main()
+
+if __name__ == "__main__":
+    sys.exit(main())
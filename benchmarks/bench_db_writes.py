@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Cost of recording notified emails in NotiMail's database: the old write path against the current one.
+
+The old path is replayed as NotiMail used to write: a rollback journal with SQLite's default
+synchronous mode and one commit per notified email, plus the folder state at the end of each pass.
+The current path is DatabaseHandler: WAL, DataBaseSynchronous (NORMAL by default), and each pass
+written by add_emails and set_folder_state in a single batch() transaction.
+
+Each path runs in a child process. When a C compiler is available, the children are started with
+a small LD_PRELOAD library that counts fsync() and fdatasync() calls; otherwise fsyncs are not
+reported. Linux only for the counter.
+
+    python3 benchmarks/bench_db_writes.py
+    python3 benchmarks/bench_db_writes.py --emails 5000 --pass-size 50 --set DataBaseSynchronous=FULL --json
+
+Reported for each path: inserts per second, and commits and fsyncs per 1000 notified emails.
+"""
+
+import argparse
+import configparser
+import ctypes
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+FSYNC_COUNTER = r'''
+#define _GNU_SOURCE
+#include <dlfcn.h>
+static long calls = 0;
+long fsync_calls(void) { return calls; }
+int fsync(int fd) { static int (*real)(int); if (!real) real = dlsym(RTLD_NEXT, "fsync"); calls++; return real(fd); }
+int fdatasync(int fd) { static int (*real)(int); if (!real) real = dlsym(RTLD_NEXT, "fdatasync"); calls++; return real(fd); }
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='NotiMail database write path benchmark')
+    parser.add_argument('--emails', type=int, default=1000, help='Notified emails to record')
+    parser.add_argument('--pass-size', type=int, default=10, help='Emails notified per pass')
+    parser.add_argument('--set', action='append', default=[], metavar='OPTION=VALUE',
+                        help='Extra [GENERAL] option for the current path, may be repeated')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser.add_argument('--child', choices=('old', 'current'), help=argparse.SUPPRESS)
+    parser.add_argument('--database', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def build_fsync_counter(workdir):
+    """Compile the LD_PRELOAD counter, or return None without a C compiler."""
+    source = os.path.join(workdir, 'fsync_counter.c')
+    library = os.path.join(workdir, 'fsync_counter.so')
+    with open(source, 'w') as f:
+        f.write(FSYNC_COUNTER)
+    compiler = shutil.which('cc') or shutil.which('gcc') or shutil.which('clang')
+    if compiler is None or sys.platform != 'linux':
+        return None
+    result = subprocess.run([compiler, '-shared', '-fPIC', '-O2', '-o', library, source, '-ldl'], capture_output=True)
+    return library if result.returncode == 0 else None
+
+
+def fsync_calls():
+    """fsync() and fdatasync() calls so far, None when the counter isn't preloaded."""
+    try:
+        counter = ctypes.CDLL(None).fsync_calls
+    except AttributeError:
+        return None
+    counter.restype = ctypes.c_long
+    return counter()
+
+
+def passes(args):
+    uids = [str(uid) for uid in range(1, args.emails + 1)]
+    return [uids[index:index + args.pass_size] for index in range(0, len(uids), args.pass_size)]
+
+
+def write_old(args):
+    connection = sqlite3.connect(args.database, timeout=30)
+    cursor = connection.cursor()
+    cursor.execute("CREATE TABLE processed_emails (email_account TEXT, folder TEXT, uid TEXT, notified INTEGER, "
+                   "processed_date TEXT, PRIMARY KEY(email_account, folder, uid))")
+    cursor.execute("CREATE TABLE folder_state (email_account TEXT, folder TEXT, uidvalidity INTEGER, last_uid INTEGER, "
+                   "PRIMARY KEY(email_account, folder))")
+    connection.commit()
+    commits = 0
+    fsyncs = fsync_calls()
+    start = time.perf_counter()
+    for uids in passes(args):
+        for uid in uids:
+            cursor.execute("INSERT OR REPLACE INTO processed_emails VALUES (?, ?, ?, ?, ?)",
+                           ('bench', 'inbox', uid, 1, time.strftime("%Y-%m-%d %H:%M:%S")))
+            connection.commit()
+            commits += 1
+        cursor.execute("INSERT OR REPLACE INTO folder_state VALUES (?, ?, ?, ?)", ('bench', 'inbox', 1, int(uids[-1])))
+        connection.commit()
+        commits += 1
+    elapsed = time.perf_counter() - start
+    after = fsync_calls()
+    connection.close()
+    return elapsed, commits, None if fsyncs is None else after - fsyncs
+
+
+def write_current(args):
+    import NotiMail
+    NotiMail.config = configparser.ConfigParser()
+    general = {}
+    for option in args.set:
+        key, _, value = option.partition('=')
+        general[key.strip()] = value.strip()
+    NotiMail.config['GENERAL'] = general
+    db = NotiMail.DatabaseHandler(args.database)
+    commits = []
+
+    def trace(statement):
+        if statement.startswith('COMMIT'):
+            commits.append(statement)
+    db.connection.set_trace_callback(trace)
+    fsyncs = fsync_calls()
+    start = time.perf_counter()
+    for uids in passes(args):
+        with db.batch():
+            db.add_emails('bench', 'inbox', uids, 1)
+            db.set_folder_state('bench', 'inbox', 1, int(uids[-1]))
+    elapsed = time.perf_counter() - start
+    after = fsync_calls()
+    db.close()
+    return elapsed, len(commits), None if fsyncs is None else after - fsyncs
+
+
+def run_child(path, args, workdir, library):
+    env = dict(os.environ)
+    if library:
+        env['LD_PRELOAD'] = library
+    argv = [sys.executable, os.path.abspath(__file__), '--child', path, '--database', os.path.join(workdir, f'{path}.db'),
+            '--emails', str(args.emails), '--pass-size', str(args.pass_size)] + [f'--set={option}' for option in args.set]
+    result = subprocess.run(argv, capture_output=True, text=True, env=env, cwd=workdir)
+    if result.returncode != 0:
+        raise RuntimeError(f"{path} path failed: {result.stderr.strip().splitlines()[-1:]}")
+    elapsed, commits, fsyncs = json.loads(result.stdout.strip().splitlines()[-1])
+    per_thousand = 1000 / args.emails
+    return {
+        'inserts_per_s': round(args.emails / elapsed),
+        'elapsed_ms': round(elapsed * 1000, 1),
+        'commits_per_1000': round(commits * per_thousand, 1),
+        'fsyncs_per_1000': None if fsyncs is None else round(fsyncs * per_thousand, 1),
+    }
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        print(json.dumps((write_old if args.child == 'old' else write_current)(args)))
+        return 0
+    workdir = tempfile.mkdtemp(prefix='notimail-writes-')
+    try:
+        library = build_fsync_counter(workdir)
+        results = {'emails': args.emails, 'pass_size': args.pass_size}
+        for path in ('old', 'current'):
+            results[path] = run_child(path, args, workdir, library)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{args.emails} notified emails, {args.pass_size} per pass"
+              + ("" if library else " (no C compiler: fsyncs not counted)"))
+        print(f"{'path':<8} {'inserts/s':>10} {'ms':>9} {'commits/1000':>13} {'fsyncs/1000':>12}")
+        for path in ('old', 'current'):
+            result = results[path]
+            print(f"{path:<8} {result['inserts_per_s']:>10} {result['elapsed_ms']:>9} {result['commits_per_1000']:>13} "
+                  f"{result['fsyncs_per_1000'] if result['fsyncs_per_1000'] is not None else '-':>12}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+End-to-end NotiMail benchmark, without any real mail server or push service.
+
+A fake IMAP server (fake_imap.py) and an HTTP sink impersonating ntfy, Gotify and Pushover
+(http_sink.py) run inside this process. NotiMail.py is imported, configured with a generated
+configuration pointing at them and started through multi_account_main(), so the real MultiIMAPHandler,
+EmailProcessor, Notifier and outbox dispatcher do the work. Once every connection is in IDLE,
+emails are injected at the requested rate and the run ends when the sink received a notification
+for each of them.
+
+Reported: emails/s, injection-to-notification latency (p50/p99/max), RSS and database writes.
+
+    python3 benchmarks/bench_e2e.py --accounts 20 --folders 2 --emails 2000 --rate 200
+    python3 benchmarks/bench_e2e.py --engine asyncio --mode account --set DispatchWorkers=4 --json
+
+The servers share the interpreter with NotiMail, so absolute numbers include their overhead:
+compare runs made with the same options on the same machine.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from fake_imap import FakeIMAPServer
+from http_sink import HTTPSink
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline end-to-end NotiMail benchmark')
+    parser.add_argument('--accounts', type=int, default=10, help='Number of EMAIL sections')
+    parser.add_argument('--folders', type=int, default=1, help='Folders monitored in each account')
+    parser.add_argument('--emails', type=int, default=1000, help='Emails to inject, spread over every account and folder')
+    parser.add_argument('--rate', type=float, default=0, help='Emails injected per second, 0 for a single burst')
+    parser.add_argument('--size', type=int, default=0, help='Body size of each email in bytes')
+    parser.add_argument('--provider', choices=('ntfy', 'gotify', 'pushover'), default='gotify',
+                        help='Notification provider (ntfy waits 2 seconds after each notification)')
+    parser.add_argument('--provider-delay', type=float, default=0, help='Seconds the sink waits before answering')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads')
+    parser.add_argument('--mode', choices=('folder', 'account'), default='folder', help='ConnectionMode')
+    parser.add_argument('--set', action='append', default=[], metavar='OPTION=VALUE',
+                        help='Extra [GENERAL] option for NotiMail, may be repeated')
+    parser.add_argument('--timeout', type=float, default=300, help='Seconds to wait for the notifications')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory (log, database)')
+    return parser.parse_args()
+
+
+def write_config(args, workdir, imap_port, sink):
+    general = {
+        'LogFileLocation': os.path.join(workdir, 'notimail.log'),
+        'DataBaseLocation': os.path.join(workdir, 'notimail.db'),
+        'Engine': args.engine,
+        'ConnectionMode': args.mode,
+    }
+    for option in args.set:
+        key, _, value = option.partition('=')
+        general[key.strip()] = value.strip()
+    lines = ['[GENERAL]'] + [f'{key} = {value}' for key, value in general.items()] + ['']
+    for index in range(args.accounts):
+        lines += [f'[EMAIL:bench{index}]', f'EmailUser = user{index}', 'EmailPass = bench', 'Host = 127.0.0.1',
+                  f'Port = {imap_port}', 'SSL = no', f"Folders = {', '.join(folder_names(args.folders))}", '']
+    if args.provider == 'ntfy':
+        lines += ['[NTFY]', f"Url1 = {sink.url('ntfy')}", '']
+    elif args.provider == 'gotify':
+        lines += ['[GOTIFY]', f"Url = {sink.url('gotify')}", 'Token = bench', '']
+    else:
+        lines += ['[PUSHOVER]', 'ApiToken = bench', 'UserKey = bench', f"Url = {sink.url('pushover')}", '']
+    path = os.path.join(workdir, 'bench.ini')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+    return path
+
+
+def folder_names(count):
+    return ['inbox'] + [f'folder{index}' for index in range(1, count)]
+
+
+def proc_status_kb(field):
+    """A memory figure of /proc/self/status, None where there is no /proc."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def current_rss_kb():
+    return proc_status_kb('VmRSS')
+
+
+def peak_rss_kb():
+    # The high-water mark of VmRSS: ru_maxrss is accounted differently and can be lower than rss_end_kb
+    return proc_status_kb('VmHWM')
+
+
+class WriteCounter:
+    """Count the write statements and commits run on a sqlite3 connection."""
+    def __init__(self, connection):
+        self.writes = 0
+        self.commits = 0
+        connection.set_trace_callback(self.trace)
+
+    def trace(self, statement):
+        verb = statement.lstrip().split(' ', 1)[0].upper()
+        if verb in ('INSERT', 'UPDATE', 'DELETE', 'REPLACE'):
+            self.writes += 1
+        elif verb == 'COMMIT':
+            self.commits += 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def drive(args, imap, sink, counter, results):
+    try:
+        connections = args.accounts * (1 if args.mode == 'account' else args.folders)
+        deadline = time.monotonic() + 60
+        while imap.idle_count() < connections:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Only {imap.idle_count()} of {connections} connections reached IDLE")
+            time.sleep(0.05)
+        folders = folder_names(args.folders)
+        writes, commits = counter.writes, counter.commits
+        results['rss_idle_kb'] = current_rss_kb()
+        injected = {}
+        start = time.time()
+        for index in range(args.emails):
+            if args.rate:
+                delay = start + index / args.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            subject = f"bench {index}"
+            injected[subject] = time.time()
+            imap.inject(f"user{index % args.accounts}", folders[(index // args.accounts) % len(folders)], subject, args.size)
+        received = sink.wait_for(args.emails, args.timeout)
+        with sink.lock:
+            arrivals = [(arrival, title) for arrival, _, title in sink.received]
+        latencies = [arrival - injected[title] for arrival, title in arrivals if title in injected]
+        end = max((arrival for arrival, _ in arrivals), default=time.time())
+        results.update({
+            'emails': args.emails,
+            'notified': received,
+            'duration_s': round(end - start, 3),
+            'emails_per_s': round(len(latencies) / (end - start), 1) if end > start else None,
+            'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+            'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+            'latency_max_ms': round(max(latencies) * 1000, 1) if latencies else None,
+            'rss_end_kb': current_rss_kb(),
+            'rss_peak_kb': peak_rss_kb(),
+            'db_writes': counter.writes - writes,
+            'db_commits': counter.commits - commits,
+        })
+    except Exception as e:
+        results['error'] = str(e)
+    finally:
+        # The regular shutdown path: logs out, stops the dispatcher and exits multi_account_main
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='notimail-bench-')
+    imap = FakeIMAPServer().start()
+    sink = HTTPSink(delay=args.provider_delay).start()
+    import NotiMail
+    NotiMail.configure(['-c', write_config(args, workdir, imap.port, sink)])
+    NotiMail.start_services()
+
+    counter = WriteCounter(NotiMail.get_database().connection)
+    results = {'accounts': args.accounts, 'folders': args.folders, 'engine': args.engine, 'mode': args.mode,
+               'provider': args.provider, 'rate': args.rate, 'size': args.size}
+    driver = threading.Thread(target=drive, args=(args, imap, sink, counter, results), name='bench-driver', daemon=True)
+    driver.start()
+    try:
+        NotiMail.multi_account_main()
+    except SystemExit:
+        pass
+    driver.join()
+    imap.stop()
+    sink.stop()
+
+    if args.keep:
+        results['workdir'] = workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for key, value in results.items():
+            print(f"{key:>16}: {value}")
+    return 1 if 'error' in results or results.get('notified') != args.emails else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Bytes transferred and wall time of a NotiMail pass over unseen emails, with FetchMode = headers and full.
+
+--emails unseen messages with a --size byte body are put in a folder of the fake IMAP server of
+bench_e2e.py. For each FetchMode, NotiMail's EmailProcessor processes that folder from a fresh
+database (no folder state yet, so every unseen email is a candidate) over a real imaplib
+connection, and notifies a counting sink. The fake server counts the bytes it sends and receives.
+
+    python3 benchmarks/bench_fetch.py
+    python3 benchmarks/bench_fetch.py --emails 2000 --size 50000 --set FetchChunkSize=200 --json
+
+Reported for each mode: the bytes sent by the server and by NotiMail, the wall time of the pass and
+the number of notifications, which must be the same for both modes.
+"""
+
+import argparse
+import configparser
+import imaplib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from fake_imap import FakeIMAPServer
+
+import NotiMail
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='NotiMail FetchMode benchmark')
+    parser.add_argument('--emails', type=int, default=500, help='Unseen emails in the folder')
+    parser.add_argument('--size', type=int, default=200000, help='Body size of each email in bytes')
+    parser.add_argument('--set', action='append', default=[], metavar='OPTION=VALUE',
+                        help='Extra [GENERAL] option for NotiMail, may be repeated')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    return parser.parse_args()
+
+
+class CountingNotifier:
+    """Stands in for NotiMail's Notifier: only counts the notifications."""
+    def __init__(self):
+        self.count = 0
+
+    def send_notification(self, *args, **kwargs):
+        self.count += 1
+
+
+def run(mode, args, imap, workdir):
+    NotiMail.config = configparser.ConfigParser()
+    # No catch-up: the whole folder is fetched in one pass, as the old code did
+    general = {'FetchMode': mode, 'CatchUpThreshold': '0'}
+    for option in args.set:
+        key, _, value = option.partition('=')
+        general[key.strip()] = value.strip()
+    NotiMail.config['GENERAL'] = general
+    db = NotiMail.DatabaseHandler(os.path.join(workdir, f'{mode}.db'))
+    notifier = CountingNotifier()
+    mail = imaplib.IMAP4('127.0.0.1', imap.port)
+    try:
+        mail.login('bench', 'bench')
+        uidvalidity, uidnext, _, _ = NotiMail.select_folder(mail, 'inbox')
+        processor = NotiMail.EmailProcessor(mail, 'bench', notifier, 'inbox', db_handler=db,
+                                            uidvalidity=uidvalidity, uidnext=uidnext)
+        sent, received = imap.bytes_sent, imap.bytes_received
+        start = time.perf_counter()
+        processor.process()
+        elapsed = time.perf_counter() - start
+        return {
+            'server_bytes': imap.bytes_sent - sent,
+            'client_bytes': imap.bytes_received - received,
+            'wall_s': round(elapsed, 2),
+            'notified': notifier.count,
+        }
+    finally:
+        mail.logout()
+        db.close()
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='notimail-fetch-')
+    imap = FakeIMAPServer().start()
+    try:
+        for index in range(args.emails):
+            imap.inject('bench', 'inbox', f'bench {index}', args.size)
+        results = {'emails': args.emails, 'size': args.size}
+        for mode in ('full', 'headers'):
+            results[mode] = run(mode, args, imap, workdir)
+    finally:
+        imap.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    same = results['full']['notified'] == results['headers']['notified'] == args.emails
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{args.emails} unseen emails of {args.size} bytes")
+        print(f"{'mode':<8} {'server bytes':>14} {'client bytes':>13} {'wall s':>8} {'notified':>9}")
+        for mode in ('full', 'headers'):
+            result = results[mode]
+            print(f"{mode:<8} {result['server_bytes']:>14,} {result['client_bytes']:>13,} {result['wall_s']:>8} {result['notified']:>9}")
+        if not same:
+            print("ERROR: not every email was notified in both modes")
+    return 0 if same else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
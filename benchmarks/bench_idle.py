@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Memory and CPU cost of an idle NotiMail connection, for each engine (threads and asyncio).
+
+NotiMail.py runs in a child process against the fake IMAP server of bench_e2e.py, with one EMAIL
+section per connection. Once every connection is in IDLE, the RSS of the child is read and its CPU
+time is measured over --duration seconds without any email arriving. Each engine also runs with a
+single connection, so that the interpreter's own footprint can be left out of the per-connection
+figures. Reads /proc: Linux only.
+
+    python3 benchmarks/bench_idle.py
+    python3 benchmarks/bench_idle.py --connections 1000 --duration 60 --engine asyncio --json
+
+Reported for each engine: the RSS with one and with --connections connections, the RSS added by each
+connection, and the CPU time used per connection per minute while idle.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from fake_imap import FakeIMAPServer
+from http_sink import HTTPSink
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='NotiMail idle connection benchmark')
+    parser.add_argument('--connections', type=int, default=200, help='Number of idle connections')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of idle time over which CPU is measured')
+    parser.add_argument('--engine', choices=('threads', 'asyncio', 'both'), default='both')
+    parser.add_argument('--set', action='append', default=[], metavar='OPTION=VALUE',
+                        help='Extra [GENERAL] option for NotiMail, may be repeated')
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for every connection to be in IDLE')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    return parser.parse_args()
+
+
+def write_config(workdir, connections, engine, options, imap_port, sink):
+    general = {
+        'LogFileLocation': os.path.join(workdir, 'notimail.log'),
+        'DataBaseLocation': os.path.join(workdir, 'notimail.db'),
+        'Engine': engine,
+    }
+    for option in options:
+        key, _, value = option.partition('=')
+        general[key.strip()] = value.strip()
+    lines = ['[GENERAL]'] + [f'{key} = {value}' for key, value in general.items()] + ['']
+    for index in range(connections):
+        lines += [f'[EMAIL:idle{index}]', f'EmailUser = user{index}', 'EmailPass = bench', 'Host = 127.0.0.1',
+                  f'Port = {imap_port}', 'SSL = no', '']
+    lines += ['[GOTIFY]', f"Url = {sink.url('gotify')}", 'Token = bench', '']
+    path = os.path.join(workdir, f'{engine}-{connections}.ini')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+    return path
+
+
+def rss_kb(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return None
+
+
+def cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        # The command name may contain spaces: the fields that follow come after its closing parenthesis
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def measure(engine, connections, args, imap, sink, workdir):
+    """RSS and idle CPU time of a NotiMail process monitoring `connections` mailboxes."""
+    config_path = write_config(workdir, connections, engine, args.set, imap.port, sink)
+    baseline = imap.idle_count()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'NotiMail.py'), '-c', config_path],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + args.timeout
+        while imap.idle_count() - baseline < connections:
+            if process.poll() is not None:
+                raise RuntimeError(f"NotiMail exited with status {process.returncode}")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Only {imap.idle_count() - baseline} of {connections} connections reached IDLE")
+            time.sleep(0.1)
+        # Let the start-up work (connections, first checks, outbox) settle before measuring
+        time.sleep(2)
+        start_cpu, start = cpu_seconds(process.pid), time.monotonic()
+        time.sleep(args.duration)
+        cpu = cpu_seconds(process.pid) - start_cpu
+        elapsed = time.monotonic() - start
+        return {'rss_kb': rss_kb(process.pid), 'cpu_s': round(cpu, 3), 'elapsed_s': round(elapsed, 1)}
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        # The fake server notices the closed connections asynchronously
+        deadline = time.monotonic() + 10
+        while imap.idle_count() > baseline and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+
+def main():
+    args = parse_args()
+    engines = ('threads', 'asyncio') if args.engine == 'both' else (args.engine,)
+    workdir = tempfile.mkdtemp(prefix='notimail-idle-')
+    imap = FakeIMAPServer().start()
+    sink = HTTPSink().start()
+    results = {'connections': args.connections, 'duration_s': args.duration}
+    try:
+        for engine in engines:
+            single = measure(engine, 1, args, imap, sink, workdir)
+            loaded = measure(engine, args.connections, args, imap, sink, workdir)
+            extra = max(1, args.connections - 1)
+            results[engine] = {
+                'rss_1_kb': single['rss_kb'],
+                'rss_kb': loaded['rss_kb'],
+                'rss_per_connection_kb': round((loaded['rss_kb'] - single['rss_kb']) / extra, 1),
+                'cpu_s': loaded['cpu_s'],
+                'cpu_ms_per_connection_min': round(loaded['cpu_s'] * 1000 / args.connections * 60 / loaded['elapsed_s'], 2),
+            }
+    except RuntimeError as e:
+        results['error'] = str(e)
+    finally:
+        imap.stop()
+        sink.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    elif 'error' in results:
+        print(f"Error: {results['error']}")
+    else:
+        print(f"{args.connections} idle connections, CPU measured over {args.duration} s")
+        print(f"{'engine':<8} {'RSS 1 conn KB':>14} {'RSS KB':>9} {'KB/conn':>8} {'CPU s':>7} {'CPU ms/conn/min':>16}")
+        for engine in engines:
+            result = results[engine]
+            print(f"{engine:<8} {result['rss_1_kb']:>14} {result['rss_kb']:>9} {result['rss_per_connection_kb']:>8} "
+                  f"{result['cpu_s']:>7} {result['cpu_ms_per_connection_min']:>16}")
+    return 1 if 'error' in results else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Cost of matching an email against NotiMail's notification rules, with thousands of [RULE:name] sections.
+
+The rules are generated: a mix of FromDomain lists, From and Subject regexes, Folder conditions and
+Header.<field> regexes, as a large filtering setup would have. Each email is matched with the compiled
+RuleSet used by NotiMail and with a plain scan of the rules in order, which must find the same rule.
+
+    python3 benchmarks/bench_rules.py
+    python3 benchmarks/bench_rules.py --rules 10000 --emails 20000 --json
+
+Reported: the time to compile the rules, and the mean and p99 time to match one email for both.
+"""
+
+import argparse
+import configparser
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import NotiMail
+
+WORDS = ('invoice', 'order', 'report', 'alert', 'meeting', 'newsletter', 'offer', 'build', 'deploy', 'ticket',
+         'backup', 'payment', 'weekly', 'security', 'update', 'review', 'release', 'incident', 'digest', 'reminder')
+FOLDERS = ('inbox', 'work', 'lists', 'alerts', 'archive')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='NotiMail rule matching benchmark')
+    parser.add_argument('--rules', type=int, default=5000, help='Number of generated rules')
+    parser.add_argument('--emails', type=int, default=10000, help='Number of emails to match')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    return parser.parse_args()
+
+
+def generate_config(count, rng):
+    config = configparser.ConfigParser()
+    for index in range(count):
+        kind = index % 5
+        rule = {}
+        if kind == 0:
+            rule['FromDomain'] = ', '.join(f'd{rng.randrange(count * 2)}.example.com' for _ in range(3))
+        elif kind == 1:
+            rule['From'] = rf'^user{rng.randrange(count * 4)}@'
+        elif kind == 2:
+            rule['Subject'] = rf'\b{rng.choice(WORDS)}[ -]#?{rng.randrange(count * 4)}\b'
+        elif kind == 3:
+            rule['Folder'] = rng.choice(FOLDERS)
+            rule['Subject'] = rf'^\[{rng.choice(WORDS)}-{rng.randrange(count)}\]'
+        else:
+            rule['Header.List-Id'] = rf'<list{rng.randrange(count * 4)}\.'
+        rule['Action'] = rng.choice(('notify', 'notify', 'suppress'))
+        if rule['Action'] == 'notify':
+            rule['Priority'] = rng.choice(('low', 'high', 'urgent'))
+        config[f'RULE:r{index}'] = rule
+    return config
+
+
+def generate_emails(count, rules, rng):
+    emails = []
+    for index in range(count):
+        number = rng.randrange(rules * 4)
+        sender = f'User {number} <user{number}@d{rng.randrange(rules * 2)}.example.com>'
+        subject = f'{rng.choice(WORDS)} {rng.choice(WORDS)} #{rng.randrange(rules * 4)}'
+        fields = {'from': sender, 'subject': subject, 'list-id': f'<list{rng.randrange(rules * 4)}.example.com>'}
+        emails.append((rng.choice(FOLDERS), sender, fields))
+    return emails
+
+
+def linear_match(rules, folder, sender, fields):
+    folder = folder.lower()
+    domain = NotiMail.parseaddr(sender or '')[1].rpartition('@')[2].lower()
+    parts = domain.split('.')
+    domains = {'.'.join(parts[index:]) for index in range(len(parts))} if domain else set()
+    for rule in rules:
+        if rule.matches(folder, domains, fields):
+            return rule
+    return None
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def measure(match, emails):
+    timings, found = [], []
+    for folder, sender, fields in emails:
+        start = time.perf_counter()
+        rule = match(folder, sender, fields)
+        timings.append(time.perf_counter() - start)
+        found.append(rule.name if rule else None)
+    return {
+        'mean_us': round(sum(timings) / len(timings) * 1e6, 1),
+        'p99_us': round(percentile(timings, 0.99) * 1e6, 1),
+        'matched': sum(1 for name in found if name),
+    }, found
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    NotiMail.config = generate_config(args.rules, rng)
+    emails = generate_emails(args.emails, args.rules, rng)
+
+    start = time.perf_counter()
+    rules = NotiMail.compile_rules()
+    rule_set = NotiMail.RuleSet(rules)
+    compile_ms = round((time.perf_counter() - start) * 1000, 1)
+
+    compiled, compiled_found = measure(rule_set.match, emails)
+    linear, linear_found = measure(lambda folder, sender, fields: linear_match(rules, folder, sender, fields), emails)
+    results = {
+        'rules': args.rules,
+        'emails': args.emails,
+        'compile_ms': compile_ms,
+        'ruleset': compiled,
+        'linear': linear,
+        'same_result': compiled_found == linear_found,
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{args.rules} rules compiled in {compile_ms} ms, {args.emails} emails, "
+              f"{compiled['matched']} matched a rule")
+        print(f"{'matcher':<10} {'mean us':>9} {'p99 us':>9}")
+        for name in ('ruleset', 'linear'):
+            print(f"{name:<10} {results[name]['mean_us']:>9} {results[name]['p99_us']:>9}")
+        if not results['same_result']:
+            print("ERROR: the RuleSet and the linear scan disagree")
+    return 0 if results['same_result'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
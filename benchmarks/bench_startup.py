@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Startup cost of NotiMail's command line, measured with `python -X importtime`.
+
+Each command runs in a fresh interpreter against a generated configuration (with the web interface
+and Prometheus configured, as in a typical install) pointing at the fake IMAP server and HTTP sink
+of bench_e2e.py, so --list-folders and --test-config do their real work offline.
+
+    python3 benchmarks/bench_startup.py
+    python3 benchmarks/bench_startup.py --runs 20 --json
+
+Reported for each command: median wall time, median total import time (the sum of the top-level
+entries of -X importtime), and which heavy optional modules were imported.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from fake_imap import FakeIMAPServer
+from http_sink import HTTPSink
+
+HEAVY_MODULES = ('requests', 'flask', 'prometheus_client', 'apprise')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='NotiMail command line startup benchmark')
+    parser.add_argument('--runs', type=int, default=10, help='Runs of each command')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def write_config(workdir, imap_port, sink):
+    lines = ['[GENERAL]',
+             f"LogFileLocation = {os.path.join(workdir, 'notimail.log')}",
+             f"DataBaseLocation = {os.path.join(workdir, 'notimail.db')}",
+             'APIKey = bench',
+             'FlaskHost = 127.0.0.1', f'FlaskPort = {free_port()}',
+             'PrometheusHost = 127.0.0.1', f'PrometheusPort = {free_port()}',
+             '',
+             '[EMAIL:bench]', 'EmailUser = user', 'EmailPass = bench', 'Host = 127.0.0.1',
+             f'Port = {imap_port}', 'SSL = no', '',
+             '[GOTIFY]', f"Url = {sink.url('gotify')}", 'Token = bench', '']
+    path = os.path.join(workdir, 'bench.ini')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+    return path
+
+
+def commands(config_path):
+    script = os.path.join(ROOT, 'NotiMail.py')
+    importer = (f"import sys; sys.argv = ['NotiMail.py', '-c', {config_path!r}]; "
+                f"sys.path.insert(0, {ROOT!r}); import NotiMail")
+    return {
+        'import': ['-c', importer],
+        '--help': [script, '--help'],
+        '--print-config': [script, '-c', config_path, '--print-config'],
+        '--list-folders': [script, '-c', config_path, '--list-folders'],
+        '--test-config': [script, '-c', config_path, '--test-config'],
+    }
+
+
+def parse_importtime(stderr):
+    """Total import time in ms (sum of the top-level entries) and the set of imported module names."""
+    total = 0
+    modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        if not name[1:].startswith(' '):
+            total += int(cumulative)
+    return total / 1000, modules
+
+
+def measure(argv, runs):
+    walls, imports = [], []
+    modules = set()
+    error = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime'] + argv, capture_output=True, text=True, timeout=60)
+        walls.append((time.perf_counter() - start) * 1000)
+        total, modules = parse_importtime(result.stderr)
+        imports.append(total)
+        if result.returncode != 0:
+            error = [line for line in result.stderr.splitlines() if not line.startswith('import time:')][-1:]
+    return {
+        'wall_ms': round(statistics.median(walls), 1),
+        'import_ms': round(statistics.median(imports), 1),
+        'heavy_modules': [name for name in HEAVY_MODULES if name in modules and importlib.util.find_spec(name)],
+        **({'error': error[0] if error else 'non-zero exit status'} if error is not None else {}),
+    }
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='notimail-startup-')
+    imap = FakeIMAPServer().start()
+    sink = HTTPSink().start()
+    try:
+        config_path = write_config(workdir, imap.port, sink)
+        results = {name: measure(argv, args.runs) for name, argv in commands(config_path).items()}
+    finally:
+        imap.stop()
+        sink.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'command':<16} {'wall ms':>9} {'import ms':>10}  heavy modules")
+        for name, result in results.items():
+            print(f"{name:<16} {result['wall_ms']:>9} {result['import_ms']:>10}  {', '.join(result['heavy_modules']) or '-'}"
+                  + (f"  (error: {result['error']})" if 'error' in result else ''))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Size and lookup cost of NotiMail's record of notified UIDs, with UIDStorage = rows and ranges.
+
+A database is filled through DatabaseHandler.add_emails with --uids notified UIDs spread over
+accounts and folders, in batches as the monitoring passes would write them. A fraction of the UIDs
+(--gaps) is never notified, as emails suppressed by a rule or deleted before being seen. The cache
+is disabled (CacheSize = 0) so that every lookup reaches the database.
+
+    python3 benchmarks/bench_uid_storage.py
+    python3 benchmarks/bench_uid_storage.py --uids 1000000 --gaps 0.2 --json
+
+Reported for each storage: the time to record the UIDs, the database size after a VACUUM, the
+number of rows, the mean and p99 time of is_email_notified for notified and not notified UIDs,
+and the time to migrate the rows database to ranges when opening it with UIDStorage = ranges.
+"""
+
+import argparse
+import configparser
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import NotiMail
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='NotiMail UID storage benchmark')
+    parser.add_argument('--uids', type=int, default=1000000, help='Number of UIDs in the tracked folders')
+    parser.add_argument('--accounts', type=int, default=10)
+    parser.add_argument('--folders', type=int, default=2, help='Folders per account')
+    parser.add_argument('--gaps', type=float, default=0.05, help='Fraction of the UIDs never notified')
+    parser.add_argument('--batch', type=int, default=200, help='UIDs recorded per add_emails call')
+    parser.add_argument('--lookups', type=int, default=20000, help='Lookups of each kind')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    return parser.parse_args()
+
+
+def open_database(path, storage):
+    NotiMail.config = configparser.ConfigParser()
+    NotiMail.config['GENERAL'] = {'UIDStorage': storage, 'CacheSize': '0'}
+    return NotiMail.DatabaseHandler(path)
+
+
+def generate_folders(args, rng):
+    """{(account, folder): (notified UIDs, not notified UIDs)}"""
+    folders = {}
+    per_folder = args.uids // (args.accounts * args.folders)
+    for account in range(args.accounts):
+        for folder in range(args.folders):
+            notified, skipped = [], []
+            for uid in range(1, per_folder + 1):
+                (skipped if rng.random() < args.gaps else notified).append(str(uid))
+            folders[(f'account{account}', f'folder{folder}')] = (notified, skipped)
+    return folders
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def measure_lookups(db, keys, expected):
+    timings = []
+    for account, folder, uid in keys:
+        start = time.perf_counter()
+        notified = db.is_email_notified(account, folder, uid, 1)
+        timings.append(time.perf_counter() - start)
+        if notified != expected:
+            raise SystemExit(f"{account}/{folder} UID {uid}: expected {expected}, got {notified}")
+    return {'mean_us': round(sum(timings) / len(timings) * 1e6, 1), 'p99_us': round(percentile(timings, 0.99) * 1e6, 1)}
+
+
+def database_size(db, path):
+    db.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.cursor.execute("VACUUM")
+    return os.path.getsize(path)
+
+
+def run(storage, path, folders, hits, misses, args):
+    db = open_database(path, storage)
+    start = time.perf_counter()
+    for (account, folder), (notified, _) in folders.items():
+        db.set_folder_state(account, folder, 1, int(notified[-1]))
+        for index in range(0, len(notified), args.batch):
+            db.add_emails(account, folder, notified[index:index + args.batch], 1, 1)
+    insert_s = time.perf_counter() - start
+    table = 'processed_ranges' if storage == 'ranges' else 'processed_emails'
+    db.cursor.execute(f"SELECT COUNT(*) FROM {table}")
+    rows = db.cursor.fetchone()[0]
+    result = {
+        'insert_s': round(insert_s, 1),
+        'size_mb': round(database_size(db, path) / 1e6, 2),
+        'rows': rows,
+        'hit': measure_lookups(db, hits, True),
+        'miss': measure_lookups(db, misses, False),
+    }
+    db.close()
+    return result
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    folders = generate_folders(args, rng)
+    keys = list(folders)
+    hits = [key + (rng.choice(folders[key][0]),) for key in (rng.choice(keys) for _ in range(args.lookups))]
+    misses = [key + (rng.choice(folders[key][1]),) for key in (rng.choice(keys) for _ in range(args.lookups)) if folders[key][1]]
+    workdir = tempfile.mkdtemp(prefix='notimail-uids-')
+    try:
+        results = {storage: run(storage, os.path.join(workdir, f'{storage}.db'), folders, hits, misses, args)
+                   for storage in ('rows', 'ranges')}
+        # Opening the rows database with UIDStorage = ranges migrates it
+        start = time.perf_counter()
+        open_database(os.path.join(workdir, 'rows.db'), 'ranges').close()
+        results['migration_s'] = round(time.perf_counter() - start, 1)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    results.update(uids=sum(len(notified) for notified, _ in folders.values()), folders=len(folders))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{results['uids']} notified UIDs in {results['folders']} folders, {args.gaps:.0%} never notified")
+        print(f"{'storage':<8} {'insert s':>9} {'size MB':>9} {'rows':>9} {'hit mean us':>12} {'hit p99 us':>11} "
+              f"{'miss mean us':>13} {'miss p99 us':>12}")
+        for storage in ('rows', 'ranges'):
+            result = results[storage]
+            print(f"{storage:<8} {result['insert_s']:>9} {result['size_mb']:>9} {result['rows']:>9} "
+                  f"{result['hit']['mean_us']:>12} {result['hit']['p99_us']:>11} "
+                  f"{result['miss']['mean_us']:>13} {result['miss']['p99_us']:>12}")
+        print(f"rows to ranges migration: {results['migration_s']} s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
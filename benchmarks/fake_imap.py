@@ -0,0 +1,283 @@
+"""
+A small in-process IMAP server for the NotiMail benchmarks.
+
+It implements just what NotiMail uses: LOGIN, CAPABILITY, LIST, SELECT, STATUS, NOOP, IDLE,
+UID SEARCH, UID FETCH and LOGOUT, over plain TCP. Mailboxes live in memory and are created on
+first use. inject() appends messages and pushes "* n EXISTS" to the connections idling on the
+folder right away, so the latency measured by the benchmark is NotiMail's, not a polling delay.
+Like a real server, messages that arrive while a connection is not idling are announced in the
+answer to its next command, or as soon as it starts IDLE.
+"""
+
+import re
+import socketserver
+import threading
+import time
+
+CAPABILITIES = "IMAP4rev1 IDLE UIDPLUS"
+UID_RANGE_RE = re.compile(r'^(\d+|\*)(?::(\d+|\*))?$')
+HEADER_FIELDS_RE = re.compile(r'BODY\.PEEK\[HEADER\.FIELDS \(([^)]*)\)\]', re.IGNORECASE)
+
+
+class Mailbox:
+    def __init__(self):
+        self.uidvalidity = 1
+        self.uidnext = 1
+        # [uid, flags, raw message]
+        self.messages = []
+
+
+def make_message(uid, subject, size):
+    headers = (f"From: Bench Sender <sender{uid}@example.com>\r\n"
+               f"Subject: {subject}\r\n"
+               f"Message-ID: <{uid}.{time.time()}@bench.example.com>\r\n"
+               "Date: Mon, 1 Jan 2024 00:00:00 +0000\r\n"
+               "Content-Type: text/plain\r\n")
+    return (headers + "\r\n" + "x" * size + "\r\n").encode()
+
+
+def parse_uid_set(text, highest):
+    ranges = []
+    for part in text.split(','):
+        match = UID_RANGE_RE.match(part)
+        if not match:
+            continue
+        start = highest if match.group(1) == '*' else int(match.group(1))
+        end = start if match.group(2) is None else (highest if match.group(2) == '*' else int(match.group(2)))
+        ranges.append((min(start, end), max(start, end)))
+    return ranges
+
+
+class FakeIMAPServer:
+    """Threaded IMAP server on 127.0.0.1; every user accepts any password."""
+    def __init__(self, port=0):
+        self.mailboxes = {}
+        self.lock = threading.Lock()
+        # (user, folder) -> set of connections currently in IDLE on it
+        self.idlers = {}
+        self.connections = 0
+        # Bytes written to and read from every client, e.g. to compare fetch strategies
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.counter_lock = threading.Lock()
+        self.server = _Server(('127.0.0.1', port), _Connection)
+        self.server.fake = self
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-imap', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def mailbox(self, user, folder):
+        key = (user, folder.strip('"').lower())
+        mailbox = self.mailboxes.get(key)
+        if mailbox is None:
+            mailbox = self.mailboxes[key] = Mailbox()
+        return mailbox
+
+    def idle_count(self):
+        with self.lock:
+            return sum(len(connections) for connections in self.idlers.values())
+
+    def inject(self, user, folder, subject, size=0, seen=False):
+        """Deliver a message and announce it to the IDLE connections of the folder. Returns its UID."""
+        with self.lock:
+            mailbox = self.mailbox(user, folder)
+            uid = mailbox.uidnext
+            mailbox.uidnext += 1
+            mailbox.messages.append([uid, {'\\Seen'} if seen else set(), make_message(uid, subject, size)])
+            exists = len(mailbox.messages)
+            idlers = list(self.idlers.get((user, folder.lower()), ()))
+        for connection in idlers:
+            connection.announce(exists)
+        return uid
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class _Connection(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.fake = self.server.fake
+        self.write_lock = threading.Lock()
+        self.user = None
+        self.folder = None
+        self.idling = None
+        # Messages in the selected folder as last reported to the client
+        self.reported = 0
+        with self.fake.lock:
+            self.fake.connections += 1
+
+    def finish(self):
+        self.stop_idle()
+        super().finish()
+
+    def announce(self, exists):
+        with self.write_lock:
+            if exists <= self.reported:
+                return
+            self.reported = exists
+        self.push(f"* {exists} EXISTS\r\n")
+
+    def pending(self):
+        """The EXISTS response for messages that arrived since the client last heard about the folder."""
+        if self.folder is None:
+            return ""
+        with self.fake.lock:
+            exists = len(self.fake.mailbox(self.user, self.folder).messages)
+        with self.write_lock:
+            if exists <= self.reported:
+                return ""
+            self.reported = exists
+        return f"* {exists} EXISTS\r\n"
+
+    def push(self, data):
+        data = data.encode() if isinstance(data, str) else data
+        with self.fake.counter_lock:
+            self.fake.bytes_sent += len(data)
+        with self.write_lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except OSError:
+                pass
+
+    def handle(self):
+        self.push(f"* OK [CAPABILITY {CAPABILITIES}] fake IMAP server ready\r\n")
+        while True:
+            try:
+                line = self.rfile.readline()
+            except ConnectionResetError:
+                return
+            if not line:
+                return
+            with self.fake.counter_lock:
+                self.fake.bytes_received += len(line)
+            line = line.decode().rstrip('\r\n')
+            if not line:
+                continue
+            if self.idling is not None:
+                if line.upper() == 'DONE':
+                    tag = self.idling
+                    self.stop_idle()
+                    self.push(f"{tag} OK IDLE terminated\r\n")
+                continue
+            tag, _, rest = line.partition(' ')
+            command, _, arguments = rest.partition(' ')
+            if not self.dispatch(tag, command.upper(), arguments):
+                return
+
+    def dispatch(self, tag, command, arguments):
+        if command == 'CAPABILITY':
+            self.push(f"* CAPABILITY {CAPABILITIES}\r\n{tag} OK CAPABILITY completed\r\n")
+        elif command == 'LOGIN':
+            self.user = arguments.split(' ')[0].strip('"')
+            self.push(f"{tag} OK LOGIN completed\r\n")
+        elif command == 'LOGOUT':
+            self.push(f"* BYE logging out\r\n{tag} OK LOGOUT completed\r\n")
+            return False
+        elif command == 'NOOP':
+            self.push(f"{self.pending()}{tag} OK NOOP completed\r\n")
+        elif command == 'LIST':
+            with self.fake.lock:
+                folders = sorted({folder for user, folder in self.fake.mailboxes if user == self.user} | {'inbox'})
+            self.push(''.join(f'* LIST (\\HasNoChildren) "/" "{folder}"\r\n' for folder in folders) + f"{tag} OK LIST completed\r\n")
+        elif command in ('SELECT', 'EXAMINE'):
+            self.folder = arguments.split(' ')[0].strip('"')
+            with self.fake.lock:
+                mailbox = self.fake.mailbox(self.user, self.folder)
+                self.reported = len(mailbox.messages)
+                self.push(f"* {len(mailbox.messages)} EXISTS\r\n* 0 RECENT\r\n* FLAGS (\\Seen)\r\n"
+                          f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid\r\n"
+                          f"* OK [UIDNEXT {mailbox.uidnext}] predicted next UID\r\n"
+                          f"{tag} OK [READ-WRITE] {command} completed\r\n")
+        elif command == 'STATUS':
+            match = re.match(r'("(?:[^"\\]|\\.)*"|\S+) \((.*)\)', arguments)
+            folder = match.group(1).strip('"')
+            with self.fake.lock:
+                mailbox = self.fake.mailbox(self.user, folder)
+                unseen = sum(1 for message in mailbox.messages if '\\Seen' not in message[1])
+                self.push(f'* STATUS "{folder}" (MESSAGES {len(mailbox.messages)} UIDNEXT {mailbox.uidnext} '
+                          f'UIDVALIDITY {mailbox.uidvalidity} UNSEEN {unseen})\r\n{tag} OK STATUS completed\r\n')
+        elif command == 'IDLE':
+            self.idling = tag
+            with self.fake.lock:
+                self.fake.idlers.setdefault((self.user, self.folder.lower()), set()).add(self)
+            self.push("+ idling\r\n" + self.pending())
+        elif command == 'UID':
+            subcommand, _, rest = arguments.partition(' ')
+            if subcommand.upper() == 'SEARCH':
+                self.search(tag, rest)
+            elif subcommand.upper() == 'FETCH':
+                self.fetch(tag, rest)
+            else:
+                self.push(f"{tag} BAD UID {subcommand} not supported\r\n")
+        else:
+            self.push(f"{tag} BAD {command} not supported\r\n")
+        return True
+
+    def stop_idle(self):
+        if self.idling is None:
+            return
+        self.idling = None
+        with self.fake.lock:
+            self.fake.idlers.get((self.user, self.folder.lower()), set()).discard(self)
+
+    def messages(self):
+        with self.fake.lock:
+            return list(self.fake.mailbox(self.user, self.folder).messages)
+
+    def search(self, tag, criteria):
+        messages = self.messages()
+        highest = messages[-1][0] if messages else 0
+        tokens = criteria.split()
+        found = []
+        for uid, flags, _ in messages:
+            matches = True
+            index = 0
+            while index < len(tokens):
+                token = tokens[index].upper()
+                if token == 'UNSEEN':
+                    matches = matches and '\\Seen' not in flags
+                elif token == 'UID':
+                    index += 1
+                    matches = matches and any(start <= uid <= end for start, end in parse_uid_set(tokens[index], highest))
+                index += 1
+            if matches:
+                found.append(str(uid))
+        self.push(f"* SEARCH {' '.join(found)}\r\n{self.pending()}{tag} OK SEARCH completed\r\n")
+
+    def fetch(self, tag, arguments):
+        uid_set, _, items = arguments.partition(' ')
+        messages = self.messages()
+        highest = messages[-1][0] if messages else 0
+        ranges = parse_uid_set(uid_set, highest)
+        header_fields = HEADER_FIELDS_RE.search(items)
+        output = []
+        for sequence, (uid, flags, raw) in enumerate(messages, 1):
+            if not any(start <= uid <= end for start, end in ranges):
+                continue
+            head = f"* {sequence} FETCH (UID {uid} FLAGS ({' '.join(sorted(flags))})"
+            if header_fields:
+                wanted = header_fields.group(1).upper().split()
+                lines = [line for line in raw.split(b'\r\n\r\n', 1)[0].split(b'\r\n')
+                         if line.split(b':', 1)[0].decode().upper() in wanted]
+                data = b'\r\n'.join(lines) + b'\r\n\r\n'
+                name = f"BODY[HEADER.FIELDS ({header_fields.group(1)})]"
+            elif 'BODY.PEEK[]' in items.upper():
+                data, name = raw, "BODY[]"
+            else:
+                output.append(head.encode() + b")\r\n")
+                continue
+            output.append(f"{head} {name} {{{len(data)}}}\r\n".encode() + data + b")\r\n")
+        self.push(b''.join(output) + f"{self.pending()}{tag} OK FETCH completed\r\n".encode())
@@ -0,0 +1,86 @@
+"""
+An in-process HTTP server impersonating ntfy, Gotify and Pushover for the NotiMail benchmarks.
+
+Every request is answered with 200 (or `status`, to simulate a failing provider) and recorded with
+its arrival time and the notification title, which the benchmark uses to match it to an email.
+"""
+
+import http.server
+import json
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+
+class HTTPSink:
+    def __init__(self, port=0, status=200, delay=0):
+        self.status = status
+        # Seconds to wait before answering, to simulate a slow provider
+        self.delay = delay
+        # (arrival time, provider, title)
+        self.received = []
+        self.lock = threading.Condition()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self.server.daemon_threads = True
+        self.server.sink = self
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='http-sink', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, provider):
+        paths = {'ntfy': '/ntfy/bench', 'gotify': '/gotify/message', 'pushover': '/pushover/1/messages.json'}
+        return f"http://127.0.0.1:{self.port}{paths[provider]}"
+
+    def record(self, provider, title):
+        with self.lock:
+            self.received.append((time.time(), provider, title))
+            self.lock.notify_all()
+
+    def wait_for(self, count, timeout):
+        """Wait until `count` notifications arrived; return how many did."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while len(self.received) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.lock.wait(remaining)
+            return len(self.received)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        sink = self.server.sink
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = urlsplit(self.path).path
+        if path.startswith('/ntfy/'):
+            provider, title = 'ntfy', self.headers.get('Title', '')
+        elif path.startswith('/gotify/'):
+            provider, title = 'gotify', json.loads(body or b'{}').get('title', '')
+        elif path.startswith('/pushover/'):
+            message = parse_qs(body.decode()).get('message', [''])[0]
+            subject = [line for line in message.splitlines() if line.startswith('Subject: ')]
+            provider, title = 'pushover', subject[0][len('Subject: '):] if subject else ''
+        else:
+            provider, title = 'unknown', ''
+        if sink.delay:
+            time.sleep(sink.delay)
+        if sink.status == 200:
+            sink.record(provider, title)
+        answer = b'{"id": "bench"}'
+        self.send_response(sink.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer)
+
+    def log_message(self, format, *args):
+        pass